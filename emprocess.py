@@ -9,9 +9,34 @@ Command line json:
     image: "template%d.png", # template name
     minz: 0, # first slice
     maxz: 50, # last slice
-    source: bucket_name # location of stored pngs
+    source: bucket_name # bucket with the stored pngs (the alignment reads the images from google storage, so file:// locations are only supported by the emwrite endpoints)
     downsample_factor: 4 # how much to downsample before aligning
     "id": "name of dataset"
+    "tile-codec": "png" # codec for temporary tiles (png, raw, zlib, or lz4)
+    "tile-codec-level": 1 # compression level for the tile codec (codec default if not set)
+    "brick-depth": 0 # write temporary tiles as z bricks of this many slices (must divide 1024 and requires ingest, 0 writes one set of tiles per slice)
+    "ingest": False # convert raw images to chunked sources so that only the needed regions are read when writing aligned slices
+    "slab-depth": 256 # slices fetched at a time when building the scale pyramid (must divide 1024, smaller fetches less at once but scale 0 writes are still held until a 256-slice layer of shards is complete)
+    "downsample-mode": "mean" # reduction of each 2x2x2 block when building the scale pyramid (mean, mode, min, or max)
+    "downsample-sigma": 0 # Gaussian prefilter (in voxels) applied before mean downsampling (0 disables)
+    "jpeg-quality": 75 # jpeg quality of the scale pyramid, or a list with the quality of each scale (the last applies to the remaining scales)
+    "raw-scales": 1 # number of scales in the raw pyramid (1 to 6, computed with the jpeg pyramid)
+    "raw-layout": "unsharded" # unsharded raw chunks (up to 512^3) or "sharded" (the first 3 scales use the shards of the jpeg pyramid)
+    "raw-codec": "gzip" # compression of raw chunks (gzip or none)
+    "raw-level": 9 # gzip level of unsharded raw chunks (tensorstore compresses shards at its default level)
+    "ts-data-copy-concurrency": 0 # threads used by tensorstore to encode chunks when writing the pyramid (0: number of cores)
+    "ts-gcs-concurrency": 0 # concurrent tensorstore requests to GCS when writing the pyramid (0: 32)
+    "ts-cache-bytes": 0 # tensorstore chunk cache when writing the pyramid (0: no cache)
+    "base-run": run_id # (optional) update the volume of an earlier run: [minz, maxz] are appended or re-processed (see emprocess/incremental.py)
+    "slices": [] # (optional, with base-run) only re-process these slices of [minz, maxz]
+    "keep-tmp": False # keep the temporary tiles of the run (needed by later incremental runs, which reuse the tiles of unchanged slices; always kept by incremental runs)
+    "reserve-maxz": 0 # size the volume for slices up to this z so that later runs can append slices (appends must fit the volume)
+    "shard-chunks": 64 # most chunks in a neuroglancer shard (the sharding of each scale is planned from the volume size)
+    "shard-bytes": 67108864 # largest estimated size of a neuroglancer shard
+    "dispatch": "threads" # how each batch task calls cloud run: 8 threads or "asyncio" (up to max-in-flight requests at once, for narrow DAGs)
+    "max-in-flight": 256 # cloud run requests in flight per batch task with asyncio dispatch
+    "hedge-percentile": 0 # (asyncio dispatch) re-issue affine and alignedslice requests slower than this percentile of recent requests (e.g., 95; 0: never; the ingest, manifest, shard, and reduce stages are never hedged)
+    "work-queue": False # let the batch tasks of the alignment, write, shard, and reduce stages take each other's remaining mini tasks (see emprocess/workqueue.py)
 }
 
 Input: images in a source/raw/*.png
@@ -57,7 +82,7 @@ import logging
 import json
 
 # custom local dependencies
-from emprocess import align, pyramid
+from emprocess import align, pyramid, objectstore, incremental
 
 # check if in testing mode
 import os
@@ -139,10 +164,69 @@ for WORKER_POOL in WORKER_POOLS:
         else:
             logging.info("Disable raw pyramid creation")
 
+        raw_scales = kwargs['dag_run'].conf.get('raw-scales', 1)
+        if not isinstance(raw_scales, int) or raw_scales < 1 or raw_scales > 6:
+            raise AirflowException(f"raw scales {raw_scales} must be between 1 and 6")
+        raw_layout = kwargs['dag_run'].conf.get('raw-layout', 'unsharded')
+        if raw_layout not in ("unsharded", "sharded"):
+            raise AirflowException(f"unknown raw layout {raw_layout}")
+        raw_codec = kwargs['dag_run'].conf.get('raw-codec', 'gzip')
+        if raw_codec not in ("gzip", "none"):
+            raise AirflowException(f"unknown raw codec {raw_codec}")
+        raw_level = kwargs['dag_run'].conf.get('raw-level', 9)
+        if not isinstance(raw_level, int) or raw_level < 0 or raw_level > 9:
+            raise AirflowException(f"raw level {raw_level} must be between 0 and 9")
+        logging.info(f"Raw pyramid: {raw_scales} scales, {raw_layout}, {raw_codec} (level {raw_level})")
+
         # check resolution
         res =  kwargs['dag_run'].conf.get('resolution', 8)
         logging.info(f"Resolution: {res}")
 
+        # check codec for temporary tiles
+        tile_codec = kwargs['dag_run'].conf.get('tile-codec', 'png')
+        if tile_codec not in ("png", "raw", "zlib", "lz4"):
+            raise AirflowException(f"unknown tile codec {tile_codec}")
+        logging.info(f"Tile codec: {tile_codec} (level {kwargs['dag_run'].conf.get('tile-codec-level', 'default')})")
+
+        # check z bricks for temporary tiles
+        brick_depth = kwargs['dag_run'].conf.get('brick-depth', 0)
+        if brick_depth < 0 or (brick_depth > 0 and (SHARD_SIZE % brick_depth) != 0):
+            raise AirflowException(f"brick depth {brick_depth} must divide {SHARD_SIZE}")
+        if brick_depth > 0 and not kwargs['dag_run'].conf.get('ingest', False):
+            # (the bricks are written one tile row at a time, which reads every slice once per row)
+            raise AirflowException("z bricks (brick-depth) require ingest")
+        logging.info(f"Brick depth: {brick_depth}")
+
+        # check pyramid slab depth
+        slab_depth = kwargs['dag_run'].conf.get('slab-depth', 256)
+        if slab_depth <= 0 or (SHARD_SIZE % slab_depth) != 0:
+            raise AirflowException(f"slab depth {slab_depth} must divide {SHARD_SIZE}")
+        logging.info(f"Slab depth: {slab_depth}")
+
+        # check pyramid downsampling
+        downsample_mode = kwargs['dag_run'].conf.get('downsample-mode', 'mean')
+        if downsample_mode not in ("mean", "mode", "min", "max"):
+            raise AirflowException(f"unknown downsample mode {downsample_mode}")
+        downsample_sigma = kwargs['dag_run'].conf.get('downsample-sigma', 0)
+        if downsample_sigma < 0 or (downsample_sigma > 0 and downsample_mode != "mean"):
+            raise AirflowException("downsample-sigma must be non-negative and requires mean downsampling")
+        logging.info(f"Downsampling: {downsample_mode} (sigma {downsample_sigma})")
+
+        # check pyramid encoding and tensorstore options
+        jpeg_quality = kwargs['dag_run'].conf.get('jpeg-quality', 75)
+        qualities = jpeg_quality if isinstance(jpeg_quality, list) else [jpeg_quality]
+        if len(qualities) == 0 or any(not isinstance(quality, int) or quality < 0 or quality > 100 for quality in qualities):
+            raise AirflowException(f"jpeg quality {jpeg_quality} must be an integer (or list of integers) between 0 and 100")
+        for option in ("ts-data-copy-concurrency", "ts-gcs-concurrency", "ts-cache-bytes"):
+            value = kwargs['dag_run'].conf.get(option, 0)
+            if not isinstance(value, int) or value < 0:
+                raise AirflowException(f"{option} must be a non-negative integer")
+        logging.info(f"JPEG quality: {jpeg_quality}")
+
+        # check source ingest
+        if kwargs['dag_run'].conf.get('ingest', False):
+            logging.info("Enable chunked source ingest")
+
         # log downsample factor
         downsample_factor = kwargs['dag_run'].conf.get('downsample_factor', 1)
         logging.info(f"Downsample factor: {downsample_factor}")
@@ -164,10 +248,25 @@ for WORKER_POOL in WORKER_POOLS:
         if minz > maxz:
             raise AirflowException("no maxz should be greater than minz")
 
+        # check incremental update
+        base_run = kwargs['dag_run'].conf.get('base-run')
+        slices = kwargs['dag_run'].conf.get('slices', [])
+        if slices and base_run is None:
+            raise AirflowException("slices can only be re-processed for a base-run")
+        if any(not isinstance(slice, int) or slice < minz or slice > maxz for slice in slices):
+            raise AirflowException(f"slices must be within {minz}-{maxz}")
+        if base_run is not None:
+            if TEST_MODE:
+                raise AirflowException("incremental runs are not supported in test mode")
+            logging.info(f"Update volume of run {base_run} with slices {slices if slices else [minz, maxz]}")
+
         # location of storage (i.e., storage bucket name)
         location = kwargs['dag_run'].conf.get('source')
         if location is None:
             raise AirflowException("no location exists")
+        if not objectstore.is_gcs(location):
+            # (fiji in the alignment service fetches gs:// images)
+            raise AirflowException(f"source {location} must be a google storage bucket")
         
     # validate parameters
     validate_t = PythonOperator(
@@ -213,36 +312,36 @@ for WORKER_POOL in WORKER_POOLS:
                 pass
             """
 
-            # interface does not support enabling uniform IAM. 
-            # create bucket for configs (ignore if it already existss
-            try:
-                ghook.create_bucket(bucket_name=bucket_name + "_process", project_id=project_id, storage_class="REGIONAL", location="US-EAST4")
-            except AirflowException as e:
-                # ignore if the erorr is the bucket exists
-                if not str(e).startswith("409"):
-                    raise
-
-            # other buckets should not have been created before
-
-            # this data can be used for chunk-based image processing)
-            ghook.create_bucket(bucket_name=bucket_name + "_chunk_" + run_id, project_id=project_id, storage_class="REGIONAL", location="US-EAST4")
-            
-            # will be auto deleted
-            ghook.create_bucket(bucket_name=bucket_name + "_tmp_" + run_id, project_id=project_id) #, storage_class="REGIONAL", location="US-EAST4")
-            
-            # will be made public readable
-            ghook.create_bucket(bucket_name=bucket_name + "_ng_" + run_id, project_id=project_id, storage_class="REGIONAL", location="US-EAST4")
+            # buckets are only needed for google storage (local directories are created on write)
+            # (incremental runs write to the buckets of the base run)
+            if objectstore.is_gcs(bucket_name) and context["dag_run"].conf.get("base-run") is None:
+                # interface does not support enabling uniform IAM. 
+                # create bucket for configs (ignore if it already existss
+                try:
+                    ghook.create_bucket(bucket_name=bucket_name + "_process", project_id=project_id, storage_class="REGIONAL", location="US-EAST4")
+                except AirflowException as e:
+                    # ignore if the erorr is the bucket exists
+                    if not str(e).startswith("409"):
+                        raise
+
+                # other buckets should not have been created before
+
+                # this data can be used for chunk-based image processing)
+                ghook.create_bucket(bucket_name=bucket_name + "_chunk_" + run_id, project_id=project_id, storage_class="REGIONAL", location="US-EAST4")
+                
+                # will be auto deleted
+                ghook.create_bucket(bucket_name=bucket_name + "_tmp_" + run_id, project_id=project_id) #, storage_class="REGIONAL", location="US-EAST4")
+                
+                # will be made public readable
+                ghook.create_bucket(bucket_name=bucket_name + "_ng_" + run_id, project_id=project_id, storage_class="REGIONAL", location="US-EAST4")
 
             # dump configuration
-            client = ghook.get_conn()
             source = context["dag_run"].conf.get("source")
-            bucket = client.bucket(source + "_process")
-            blob = bucket.blob(blob_name=f"{context['dag_run'].run_id}/init.json")
 
             data = context["dag_run"].conf
             data["execution_date"] = str(context.get("execution_date")) 
             data = json.dumps(data)
-            blob.upload_from_string(data) 
+            objectstore.open_store(source + "_process").write(f"{context['dag_run'].run_id}/init.json", data)
 
 
 
@@ -261,7 +360,7 @@ for WORKER_POOL in WORKER_POOLS:
     
     # expects dag run configruation with "image", "minz", "maxz", "source"
     ngingest_start_t, ngingest_end_t = pyramid.export_dataset_psubdag(dag, DAG_NAME+".ngingest", WORKER_POOL,
-            align_end_t.task_id, "http_requests", TEST_MODE, SHARD_SIZE)
+            align_end_t.task_id, "http_requests", TEST_MODE, SHARD_SIZE, volume_task_id=align_start_t.task_id)
 
     # pull xcom from a subdag to see if data was written
     def iswritten(value, **context):
@@ -296,7 +395,8 @@ for WORKER_POOL in WORKER_POOLS:
                         }
     commands = f"echo '{json.dumps(lifecycle_config)}' > life.json;\n"
     if not TEST_MODE:
-        commands += "gsutil lifecycle set life.json gs://{{ dag_run.conf['source'] }}_tmp_{{ run_id }};\n"
+        # (only for google storage, skipped if later runs will update the volume or if this run updates one)
+        commands += "{% if '://' not in dag_run.conf['source'] and not dag_run.conf.get('keep-tmp', False) and 'base-run' not in dag_run.conf %}gsutil lifecycle set life.json gs://{{ dag_run.conf['source'] }}_tmp_" + incremental.VOLUME_ID + ";{% endif %}\n"
     commands += "rm life.json;"
 
     cleanup_t = BashOperator(
@@ -328,7 +428,7 @@ for WORKER_POOL in WORKER_POOLS:
 
     read_commands = f"echo '{json.dumps(read_config)}' > read.json;\n"
     if not TEST_MODE:
-        read_commands += "gsutil iam ch allUsers:objectViewer gs://{{ dag_run.conf['source'] }}_ng_{{ run_id }}; gsutil cors set read.json gs://{{ dag_run.conf['source'] }}_ng_{{ run_id }};\n"
+        read_commands += "{% if '://' not in dag_run.conf['source'] %}gsutil iam ch allUsers:objectViewer gs://{{ dag_run.conf['source'] }}_ng_" + incremental.VOLUME_ID + "; gsutil cors set read.json gs://{{ dag_run.conf['source'] }}_ng_" + incremental.VOLUME_ID + ";{% endif %}\n"
     read_commands += "rm read.json;"
 
     set_public_read_t = BashOperator(
@@ -341,17 +441,12 @@ for WORKER_POOL in WORKER_POOLS:
         # test mode disable
         if not TEST_MODE:
             # write config and time stamp
-            ghook = GoogleCloudStorageHook() # uses default gcp connection
-            client = ghook.get_conn()
             source = context["dag_run"].conf.get("source")
-            bucket = client.bucket(source + "_process")
-            blob = bucket.blob(blob_name=f"{context['dag_run'].run_id}/complete.json")
-            project_id = context["dag_run"].conf.get("project_id")
 
             data = context["dag_run"].conf
             data["execution_date"] = str(context.get("execution_date")) 
             data = json.dumps(data)
-            blob.upload_from_string(data) 
+            objectstore.open_store(source + "_process").write(f"{context['dag_run'].run_id}/complete.json", data)
 
     # write results to gbucket
     write_status_t = PythonOperator(
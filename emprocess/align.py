@@ -22,11 +22,10 @@ subdag operator.
 from airflow.models import Variable
 from airflow import AirflowException
 from airflow.operators.python_operator import PythonOperator
-from airflow.contrib.hooks.gcs_hook import GoogleCloudStorageHook
 
 import json
 import logging
-from emprocess import fiji_script
+from emprocess import fiji_script, objectstore, incremental
 from emprocess.cloudrun_operator import CloudRunOperator, CloudRunBatchOperator
 
 import numpy as np
@@ -37,6 +36,8 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
 
     Note:
         ending dag task returns extents under the key "bbox" if it succeeds.
+        The starting task pushes the slice range of the volume under the key
+        "volume" (larger than [minz, maxz] for incremental runs, see incremental.py).
 
     Args:
         name (str): dag_id.name is the prefix for all tasks
@@ -52,30 +53,45 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
   
     # starting task (check for the existence of the raw/*.png data
     def check_data(**context):
-        """Check if images exist.
+        """Check if images exist and push the slice range of the volume.
         """
 
-        # skip if testing workflow
-        if TEST_MODE:
-            return
-
         source = context["dag_run"].conf.get("source")
         image = context["dag_run"].conf.get("image")
         minz = context["dag_run"].conf.get("minz")
         maxz = context["dag_run"].conf.get("maxz")
+        base_run = context["dag_run"].conf.get("base-run")
+        slices = incremental.dirty_slices(minz, maxz, context["dag_run"].conf.get("slices"))
+
+        volume = [minz, maxz]
+        if base_run is not None:
+            if TEST_MODE:
+                raise AirflowException("incremental runs read the state of the base run (not available in test mode)")
+            state = incremental.read_volume_state(source, base_run)
+            if minz < state["minz"] or minz > state["maxz"] + 1:
+                raise AirflowException(f"slices {minz}-{maxz} must start within or right after slices {state['minz']}-{state['maxz']} of run {base_run}")
+            if not state.get("keep-tmp", False):
+                raise AirflowException(f"run {base_run} did not keep its temporary tiles (keep-tmp), which incremental runs read")
+            volume = [state["minz"], max(state["maxz"], maxz)]
+            if set(range(state["maxz"]+1, maxz+1)) - set(slices):
+                raise AirflowException(f"all slices after {state['maxz']} must be processed")
+        context["task_instance"].xcom_push(key="volume", value=volume)
+
+        # skip if testing workflow
+        if TEST_MODE:
+            return
 
         # grab all files in raw
-        ghook = GoogleCloudStorageHook() # uses default gcp connection
-        file_names = ghook.list(source, prefix="")
-        file_names = set(file_names)
+        file_names = set(objectstore.open_store(source).list())
 
-        for slice in range(minz, maxz):
+        for slice in slices if base_run is not None else range(minz, maxz):
             if ((image % slice)) not in file_names:  
                 raise AirflowException(f"raw data not loaded properly.  Missing raw/{image % slice}")
 
     # find global coordinate system and write transforms
+    start_id = f"{name}.start_align"
     start_t = PythonOperator(
-        task_id=f"{name}.start_align",
+        task_id=start_id,
         provide_context=True,
         python_callable=check_data,
         dag=dag,
@@ -153,6 +169,20 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
                 affine = translation
             return affine, [width, height], [width0, height0]
 
+        def compose(last_affine, curr_affine):
+            """Apply curr_affine and then last_affine.
+            """
+            mod_affine = []
+            mod_affine.append(last_affine[0]*curr_affine[0] + last_affine[2]*curr_affine[1])
+            mod_affine.append(last_affine[1]*curr_affine[0] + last_affine[3]*curr_affine[1])
+            
+            mod_affine.append(last_affine[0]*curr_affine[2] + last_affine[2]*curr_affine[3])
+            mod_affine.append(last_affine[1]*curr_affine[2] + last_affine[3]*curr_affine[3])
+            
+            mod_affine.append(last_affine[0]*curr_affine[4] + last_affine[2]*curr_affine[5] + last_affine[4])
+            mod_affine.append(last_affine[1]*curr_affine[4] + last_affine[3]*curr_affine[5] + last_affine[5])
+            return mod_affine
+
         # read each transform and create global coordinate system
         # (note: each transform is applied to n+1 slice, image sizes are assumed to have identical dims)
         last_affine = [1, 0, 0, 1, 0, 0]
@@ -163,20 +193,51 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
         global_bbox = None
     
         all_results = {}
-        ghook = GoogleCloudStorageHook() # uses default gcp connection
-        client = ghook.get_conn()
-        bucket = client.bucket(bucket_name)
+        store = objectstore.open_store(bucket_name)
 
         for worker_id in range(0, NUM_WORKERS):
-            blob = bucket.blob(blob_name=f"{context['dag_run'].run_id}/align/affine_cache/worker-{worker_id}")
             # raises error if not found
-            res = json.loads(blob.download_as_string().decode())
+            res = json.loads(store.read(f"{context['dag_run'].run_id}/align/affine_cache/worker-{worker_id}").decode())
 
             #res = context['task_instance'].xcom_pull(task_ids=f"{name}.affine_{worker_id}")
             all_results.update(res)
 
+        def affine_result(slice):
+            # (with a work queue, a result cached by a failed try of another task is only in the cache)
+            if str(slice) not in all_results:
+                all_results[str(slice)] = store.read(f"{context['dag_run'].run_id}/align/affine_cache/{slice}").decode()
+            return json.loads(all_results[str(slice)])
+
+        base_run = context["dag_run"].conf.get("base-run")
+        if base_run is not None:
+            # align each dirty slice to the slice before it in the frame of the volume
+            volume = context["task_instance"].xcom_pull(task_ids=start_id, key="volume")
+            state = incremental.read_volume_state(context["dag_run"].conf.get("source"), base_run)
+            transforms_out = json.loads(store.read(state["transforms"]).decode())
+            for slice in incremental.dirty_slices(minz, maxz, context["dag_run"].conf.get("slices")):
+                # the first slice of the volume defines the frame
+                if slice == volume[0]:
+                    continue
+                curr_affine, bbox, bbox0 = process_results(affine_result(slice-1))
+                transforms_out[str(slice)] = compose(transforms_out[str(slice-1)], curr_affine)
+
+            affines_csv = ""
+            for slice in range(volume[0], volume[1]+1):
+                affines_csv += f"{slice} , '{transforms_out[str(slice)]}'\n"
+
+            context['task_instance'].xcom_push(key="bbox", value=state["bbox"])
+            store.write_many([
+                (f"{context['dag_run'].run_id}/align/transforms.csv", affines_csv),
+                (f"{context['dag_run'].run_id}/align/transforms.json", json.dumps(transforms_out))
+            ])
+            incremental.write_volume_state(context["dag_run"].conf.get("source"), base_run, {
+                "minz": volume[0], "maxz": volume[1], "bbox": state["bbox"],
+                "transforms": f"{context['dag_run'].run_id}/align/transforms.json",
+                "keep-tmp": True})
+            return
+
         for slice in range(minz, maxz):
-            res = json.loads(all_results[str(slice)])
+            res = affine_result(slice)
             # affine has already been modified to treat top-left of image as origin
 
             # process results
@@ -195,15 +256,7 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
             """
 
             # multiply matrices
-            mod_affine = []
-            mod_affine.append(last_affine[0]*curr_affine[0] + last_affine[2]*curr_affine[1])
-            mod_affine.append(last_affine[1]*curr_affine[0] + last_affine[3]*curr_affine[1])
-            
-            mod_affine.append(last_affine[0]*curr_affine[2] + last_affine[2]*curr_affine[3])
-            mod_affine.append(last_affine[1]*curr_affine[2] + last_affine[3]*curr_affine[3])
-            
-            mod_affine.append(last_affine[0]*curr_affine[4] + last_affine[2]*curr_affine[5] + last_affine[4])
-            mod_affine.append(last_affine[1]*curr_affine[4] + last_affine[3]*curr_affine[5] + last_affine[5])
+            mod_affine = compose(last_affine, curr_affine)
          
             last_affine = mod_affine
             # add affine to list
@@ -247,16 +300,17 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
 
         # test mode disable
         if not TEST_MODE:
-            # write transforms to align/tranforms.csv
-            ghook = GoogleCloudStorageHook() # uses default gcp connection
-            client = ghook.get_conn()
-            bucket = client.bucket(source)
-            blob = bucket.blob(blob_name=f"{context['dag_run'].run_id}/align/transforms.csv")
-            blob.upload_from_string(affines_csv) 
-           
-            # write the json parseable transforms to align/transforms.json
-            blob = bucket.blob(blob_name=f"{context['dag_run'].run_id}/align/transforms.json")
-            blob.upload_from_string(json.dumps(transforms_out)) 
+            # write transforms to align/tranforms.csv and the json parseable transforms to align/transforms.json
+            objectstore.open_store(source).write_many([
+                (f"{context['dag_run'].run_id}/align/transforms.csv", affines_csv),
+                (f"{context['dag_run'].run_id}/align/transforms.json", json.dumps(transforms_out))
+            ])
+
+            # later runs can append to or update this volume
+            incremental.write_volume_state(context["dag_run"].conf.get("source"), context["dag_run"].run_id, {
+                "minz": minz, "maxz": maxz, "bbox": [global_bbox[1]-global_bbox[0], global_bbox[3]-global_bbox[2]],
+                "transforms": f"{context['dag_run'].run_id}/align/transforms.json",
+                "keep-tmp": bool(context["dag_run"].conf.get("keep-tmp", False))})
 
     # find global coordinate system and write transforms
     collect_id = f"{name}.collect"
@@ -305,8 +359,12 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
         if downsample_factor > 1:
             downsample_postfix = f"?downsample={downsample_factor}"
 
+        # transform from each slice to the next (for each dirty slice except the first slice of the volume)
+        volume = context["task_instance"].xcom_pull(task_ids=start_id, key="volume")
+        pairs = [slice-1 for slice in incremental.dirty_slices(minz, maxz, data["slices"]) if slice > volume[0]]
+
         task_list = []
-        for slice in range(minz, maxz):
+        for slice in pairs:
             if (slice % num_workers) == worker_id:
                 img1 = "gs://" + source + "/" + image % slice + downsample_postfix
                 img2 = "gs://" + source + "/" + image % (slice+1) + downsample_postfix 
@@ -324,6 +382,31 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
         return task_list
 
 
+    # task callable that generates batch assignment to convert raw images to chunked sources
+    # (no tasks unless ingest is enabled, in which case alignedslice reads the chunked source)
+    def ingest_worker(worker_id, num_workers, data, **context):
+        if not json.loads(data["ingest"].lower()):
+            return []
+        minz = int(data["minz"])
+        maxz = int(data["maxz"])
+        image = data["image"]
+
+        # every slice whose tiles are written
+        volume = context["task_instance"].xcom_pull(task_ids=start_id, key="volume")
+        slices = incremental.written_slices(incremental.dirty_slices(minz, maxz, data["slices"]), volume, int(data["brick-depth"]))
+
+        task_list = []
+        for slice in slices:
+            if (slice % num_workers) == worker_id:
+                params = {
+                        "img": image % slice,
+                        "dest": data["dest"],
+                        "ingest-bucket": data["ingest-bucket"]
+                }
+                task_list.append([f"{slice}", params])
+        return task_list
+
+
     # task callable that generates batch assignment to write image data for the provided worker
     def writeslice_worker(worker_id, num_workers, data, **context):
         minz = int(data["minz"])
@@ -334,6 +417,11 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
         dest_tmp = data["dest-tmp"]
         shard_size = data["shard-size"]
         bucket_name = data["bucket_name"]
+        clip_limit = float(data["clip-limit"])
+        tile_codec = data["tile-codec"]
+        tile_codec_level = int(data["tile-codec-level"]) if data["tile-codec-level"] != "" else None
+        ingest_bucket = data["ingest-bucket"] if json.loads(data["ingest"].lower()) else ""
+        brick_depth = int(data["brick-depth"])
 
         bbox_val = json.dumps(context["task_instance"].xcom_pull(task_ids=collect_id, key="bbox"))
         bbox = json.loads(bbox_val)
@@ -341,21 +429,48 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
         transform_vals = {}
         # fetch data from google storage
         if not TEST_MODE:
-            ghook = GoogleCloudStorageHook() # uses default gcp connection
-            client = ghook.get_conn()
-            bucket = client.bucket(bucket_name + "_process")
-            blob = bucket.blob(blob_name=f"{context['dag_run'].run_id}/align/transforms.json")
-            trans_str = blob.download_as_string().decode() 
+            store = objectstore.open_store(bucket_name + "_process")
+            trans_str = store.read(f"{context['dag_run'].run_id}/align/transforms.json").decode()
             transform_vals = json.loads(trans_str)
 
+        def get_transform(slice):
+            if TEST_MODE:
+                # slow with many slices
+                return json.dumps(context["task_instance"].xcom_pull(task_ids=collect_id, key=str(slice)))
+            return json.dumps(transform_vals[str(slice)])
+
+        # dirty slices (and the other slices of their z bricks)
+        volume = context["task_instance"].xcom_pull(task_ids=start_id, key="volume")
+        written = incremental.written_slices(incremental.dirty_slices(minz, maxz, data["slices"]), volume, brick_depth)
+
         task_list = []
-        for slice in range(minz, maxz+1):
+        if brick_depth > 0:
+            # each task aligns the contiguous slices of one z brick (alignedslices)
+            for zbrick in sorted(set(slice // brick_depth for slice in written)):
+                if (zbrick % num_workers) == worker_id:
+                    slices = []
+                    for slice in range(max(zbrick*brick_depth, volume[0]), min((zbrick+1)*brick_depth - 1, volume[1]) + 1):
+                        slices.append({"img": image % slice, "slice": slice, "transform": get_transform(slice)})
+                    params = {
+                            "slices": slices,
+                            "bbox": bbox_val,
+                            "dest-tmp": dest_tmp,
+                            "shard-size": shard_size,
+                            "dest": dest,
+                            "run_id": context["dag_run"].run_id,
+                            "clip-limit": clip_limit,
+                            "thumbnail": data["thumbnail"],
+                            "tile-codec": tile_codec,
+                            "tile-codec-level": tile_codec_level,
+                            "ingest-bucket": ingest_bucket,
+                            "brick-depth": brick_depth
+                    }
+                    task_list.append([f"brick_{zbrick}", params])
+            return task_list
+
+        for slice in written:
             if (slice % num_workers) == worker_id:
-                if TEST_MODE:
-                    # slow with many slices
-                    transform_val = json.dumps(context["task_instance"].xcom_pull(task_ids=collect_id, key=str(slice)))
-                else:
-                    transform_val = json.dumps(transform_vals[str(slice)])
+                transform_val = get_transform(slice)
 
                 params = {
                         "img": image % slice,
@@ -365,7 +480,12 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
                         "slice": slice,
                         "shard-size": shard_size,
                         "dest": dest,
-                        "run_id": context["dag_run"].run_id
+                        "run_id": context["dag_run"].run_id,
+                        "clip-limit": clip_limit,
+                        "thumbnail": data["thumbnail"],
+                        "tile-codec": tile_codec,
+                        "tile-codec-level": tile_codec_level,
+                        "ingest-bucket": ingest_bucket
                 }        
                 task_list.append([f"{slice}", params])
 
@@ -402,6 +522,7 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
                     "minz": "{{ dag_run.conf['minz'] }}",
                     "maxz": "{{ dag_run.conf['maxz'] }}",
                     "image": "{{ dag_run.conf['image'] }}",
+                    "slices": "{{ dag_run.conf.get('slices', '') }}",
                     "downsample_factor": "{{ dag_run.conf.get('downsample_factor', 1) }}"
             },
             conn_id="ALIGN_CLOUD_RUN",
@@ -410,15 +531,51 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
             log_response=False,
             num_http_tries=10,
             xcom_push=True,
-            cache="gs://" + "{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/affine_cache" if not TEST_MODE else "",
+            cache="{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/affine_cache" if not TEST_MODE else "",
+            work_queue="{% if dag_run.conf.get('work-queue', False) %}{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/affine_queue{% endif %}" if not TEST_MODE else "",
             validate_output=validate_output,
             try_number = "{{ task_instance.try_number }}",
+            dispatch="{{ dag_run.conf.get('dispatch', 'threads') }}",
+            max_in_flight="{{ dag_run.conf.get('max-in-flight', 256) }}",
+            hedge_percentile="{{ dag_run.conf.get('hedge-percentile', 0) }}",
+            concurrency_state="{{ dag_run.conf['source'] }}_process/{{ run_id }}/concurrency" if not TEST_MODE else "",
             pool=pool,
             dag=dag,
         )
 
         start_t >> affine_t >> collect_t
 
+        # ingest runs alongside the alignment (same slice assignment as the write worker)
+        ingest_t = CloudRunBatchOperator(
+            task_id=f"{name}.ingest_{worker_id}",
+            gen_callable=ingest_worker,
+            worker_id=worker_id,
+            num_workers=NUM_WORKERS,
+            data={
+                    "dest": "{{ dag_run.conf['source'] }}",
+                    "minz": "{{ dag_run.conf['minz'] }}",
+                    "maxz": "{{ dag_run.conf['maxz'] }}",
+                    "image": "{{ dag_run.conf['image'] }}",
+                    "ingest": "{{ dag_run.conf.get('ingest', False) }}",
+                    "slices": "{{ dag_run.conf.get('slices', '') }}",
+                    "brick-depth": "{{ dag_run.conf.get('brick-depth', 0) }}",
+                    "ingest-bucket": "{{ dag_run.conf['source'] }}_chunk_" + incremental.VOLUME_ID
+            },
+            conn_id="IMG_WRITE",
+            endpoint="/ingestslice",
+            headers=headers,
+            log_response=False,
+            cache="{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/ingest_cache" if not TEST_MODE else "",
+            num_http_tries=15,
+            xcom_push=False,
+            try_number = "{{ task_instance.try_number }}",
+            dispatch="{{ dag_run.conf.get('dispatch', 'threads') }}",
+            max_in_flight="{{ dag_run.conf.get('max-in-flight', 256) }}",
+            concurrency_state="{{ dag_run.conf['source'] }}_process/{{ run_id }}/concurrency" if not TEST_MODE else "",
+            pool=pool,
+            dag=dag,
+        )
+
         write_aligned_image_t = CloudRunBatchOperator(
             task_id=f"{name}.write_{worker_id}",
             gen_callable=writeslice_worker,
@@ -429,24 +586,37 @@ def align_dataset_psubdag(dag, name, NUM_WORKERS, pool=None, TEST_MODE=False, SH
                     "minz": "{{ dag_run.conf['minz'] }}",
                     "maxz": "{{ dag_run.conf['maxz'] }}",
                     "image": "{{ dag_run.conf['image'] }}",
-                    "clip-limit": "{{ dag_run.conf.get('clip-limit', 0.02) }}"
-                    "dest-tmp": "{{ dag_run.conf['source'] }}_tmp_{{ run_id }}",
+                    "clip-limit": "{{ dag_run.conf.get('clip-limit', 0.02) }}",
+                    "thumbnail": "{{ dag_run.conf.get('thumbnail', 'sync') }}",
+                    "tile-codec": "{{ dag_run.conf.get('tile-codec', 'png') }}",
+                    "tile-codec-level": "{{ dag_run.conf.get('tile-codec-level', '') }}",
+                    "ingest": "{{ dag_run.conf.get('ingest', False) }}",
+                    "ingest-bucket": "{{ dag_run.conf['source'] }}_chunk_" + incremental.VOLUME_ID,
+                    "brick-depth": "{{ dag_run.conf.get('brick-depth', 0) }}",
+                    "slices": "{{ dag_run.conf.get('slices', '') }}",
+                    "dest-tmp": "{{ dag_run.conf['source'] }}_tmp_" + incremental.VOLUME_ID,
                     "shard-size": SHARD_SIZE,
                     "collect_id": collect_id,
                     "bucket_name": "{{ dag_run.conf['source'] }}"
             },
             conn_id="IMG_WRITE",
-            endpoint="/alignedslice",
+            endpoint="{{ '/alignedslices' if dag_run.conf.get('brick-depth', 0) else '/alignedslice' }}",
             headers=headers,
             log_response=False,
-            cache="gs://" + "{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/write_cache" if not TEST_MODE else "",
+            cache="{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/write_cache" if not TEST_MODE else "",
+            work_queue="{% if dag_run.conf.get('work-queue', False) %}{{ dag_run.conf['source'] }}_process/{{ run_id }}/align/write_queue{% endif %}" if not TEST_MODE else "",
             num_http_tries=15,
             xcom_push=False,
             try_number = "{{ task_instance.try_number }}",
+            dispatch="{{ dag_run.conf.get('dispatch', 'threads') }}",
+            max_in_flight="{{ dag_run.conf.get('max-in-flight', 256) }}",
+            hedge_percentile="{{ dag_run.conf.get('hedge-percentile', 0) }}",
+            concurrency_state="{{ dag_run.conf['source'] }}_process/{{ run_id }}/concurrency" if not TEST_MODE else "",
             pool=pool,
             dag=dag,
         )       
         collect_t >> write_aligned_image_t >> finish_t
+        start_t >> ingest_t >> write_aligned_image_t
 
     # provide bookend tasks to caller
     return start_t, finish_t
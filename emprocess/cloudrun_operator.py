@@ -9,13 +9,30 @@ from airflow.utils.decorators import apply_defaults
 from airflow.models import BaseOperator
 from airflow.hooks.http_hook import HttpHook
 from airflow import AirflowException
-from airflow.contrib.hooks.gcs_hook import GoogleCloudStorageHook
+from emprocess import objectstore
+from emprocess.concurrency import AdaptiveLimit, is_overload, retry_delay
+from emprocess.workqueue import WorkQueue
 import subprocess
 import json
 import time
 import threading
-import random
 import signal
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+CLOUDRUN_TIMEOUT = 901 # force termination if request hangs
+TOKEN_TIMEOUT = 1800 # how often to refresh token
+
+# latencies of recent requests used to find stragglers (see hedge_percentile)
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 20
+
+# threads of the asyncio dispatch for reading and writing results (in addition to the requests)
+STORE_THREADS = 8
+
+# how mini tasks are dispatched (see CloudRunBatchOperator)
+DISPATCH_MODES = ("threads", "asyncio")
 
 class CloudRunOperator(SimpleHttpOperator):
     @apply_defaults
@@ -43,8 +60,42 @@ class CloudRunBatchOperator(BaseOperator):
     This callable is passed the context and any 'data' which is
     teemplated.
 
+    Mini tasks are dispatched by num_threads threads ("threads") or by an
+    asyncio event loop ("asyncio") that keeps up to max_in_flight requests
+    in flight and handles each result as soon as it completes.  The event
+    loop runs the blocking http calls on a thread pool of max_in_flight
+    threads, so a mini task waiting for its turn or for a retry does not
+    hold a thread.  This lets a single Airflow worker slot drive hundreds of
+    cloud run requests.
+
+    In both modes, the requests in flight are bounded by an adaptive limit
+    (up to num_threads or max_in_flight) that grows while cloud run keeps
+    up and backs off on overload.  The limit is shared by the batch tasks
+    of a run through the concurrency_state location (see concurrency.py).
+    Failed requests are retried with capped exponential backoff and jitter.
+
+    With asyncio dispatch, a request that is still running after the
+    hedge_percentile of recent latencies can be re-issued once (if the
+    limit allows another request), and the first successful response
+    wins.  This cuts the tail of a batch that is set by a few stragglers,
+    but requires mini tasks that can safely run twice (e.g., writes of the
+    same data).
+
+    The ids of the results saved in the cache are listed once at the start,
+    so mini tasks without a result are dispatched without a lookup, and
+    the results of completed mini tasks are only read if they are pushed
+    or logged.
+
+    If work_queue is set, the mini tasks are not split statically between
+    the num_workers tasks of a stage.  Each task generates all of them, runs
+    its own share first, and then takes the mini tasks that no other task
+    has claimed until the stage drains (see workqueue.py).  The tasks of a
+    stage must share the work queue and the cache.  A task only pushes the
+    results of the mini tasks that it ran and the cached results of its own
+    share.
+
     """
-    template_fields = ['data', 'cache', 'try_number']
+    template_fields = ['data', 'endpoint', 'cache', 'try_number', 'dispatch', 'max_in_flight', 'concurrency_state', 'hedge_percentile', 'work_queue']
 
     @apply_defaults
     def __init__(
@@ -54,15 +105,20 @@ class CloudRunBatchOperator(BaseOperator):
         num_workers=0, # int
         data=None,  # dict (templated)
         conn_id=None, # string for connection
-        endpoint="", # string for endpoint
+        endpoint="", # string for endpoint (templated)
         headers=None, # dict with http headers
-        cache="", # directory location for storing results
+        cache="", # location for storing results (see objectstore.open_store)
         log_response = False,
         num_http_tries = 1, # int
         xcom_push = False,
         num_threads=8, # default threading for low-compute jobs
         validate_output=None, # callable with response as parameter
         try_number=1,
+        concurrency_state="", # location of the concurrency limit shared by the tasks of a run (templated)
+        dispatch="threads", # "threads" or "asyncio" (templated)
+        max_in_flight=256, # requests in flight for asyncio dispatch (templated)
+        hedge_percentile=0, # re-issue requests slower than this percentile of recent latencies (0 disables, asyncio only, templated)
+        work_queue="", # location of the leases shared by the tasks of a stage ("" splits the mini tasks statically, templated)
         *args,
         **kwargs
     ):
@@ -84,48 +140,169 @@ class CloudRunBatchOperator(BaseOperator):
         self.validate_output = validate_output
         self.cache = cache
         self.try_number = try_number
+        self.dispatch = dispatch
+        self.max_in_flight = max_in_flight
+        self.concurrency_state = concurrency_state
+        self.hedge_percentile = hedge_percentile
+        self.work_queue = work_queue
 
     def execute(self, context):
-        CLOUDRUN_TIMEOUT = 901 # force termination if request hangs
-        TOKEN_TIMEOUT = 1800 # how often to refresh token
-
         self.try_number = int(self.try_number)
-        # generate mini tasks
-        mini_tasks = self.gen_callable(self.worker_id, self.num_workers, self.data, **context)
+        self.max_in_flight = int(self.max_in_flight)
+        self.hedge_percentile = float(self.hedge_percentile)
+        if self.hedge_percentile < 0 or self.hedge_percentile >= 100:
+            raise AirflowException("hedge percentile must be between 0 and 100")
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        if self.dispatch not in DISPATCH_MODES:
+            raise AirflowException(f"unknown dispatch {self.dispatch}")
+
+        if self.work_queue != "" and self.cache == "":
+            raise AirflowException("a work queue requires a cache")
+
+        # generate mini tasks (all of them with a work queue)
+        if self.work_queue != "":
+            mini_tasks = self.gen_callable(0, 1, self.data, **context)
+        else:
+            mini_tasks = self.gen_callable(self.worker_id, self.num_workers, self.data, **context)
+
+        # results saved by earlier tries (one listing instead of a lookup per mini task)
+        self._stores = {}
+        self._cached_ids = set()
+        if self.cache != "":
+            try:
+                self._cached_ids = set(self._store(self.cache).list())
+            except Exception as e:
+                self.log.info(f"no cached results: {e}")
+            self.log.info(f"{len(self._cached_ids)} cached results")
+
+        # run the own share first and then the mini tasks left by the other tasks of the stage
+        self._queue = None
+        if self.work_queue != "":
+            self._queue = WorkQueue(self.work_queue, [id for id, _ in mini_tasks], self.worker_id, self.num_workers,
+                    self.task_id, self.try_number, self._cached_ids, self.log)
+            mini_tasks = [mini_tasks[idx] for idx in self._queue.order]
     
         # -- call cloud run for each task --
-         # add authorization if not presen and gcloud is available
+        # add authorization if not presen and gcloud is available
+        self._token_lock = threading.Lock()
+        self._token_time = time.time()
         if "Authorization" not in self.headers:
-            # extract auth token from gcloud
-            try:
-                token = subprocess.check_output(["gcloud auth print-identity-token"], shell=True).decode()
-                self.headers["Authorization"] = f"Bearer {token[:-1]}"
-            except Exception:
-                pass      
+            self._set_token()
 
-        # ramp up time guesstimate
-        ramp_up = 60
+        if len(mini_tasks) > 0:
+            self.log.info(f"Params: {json.dumps(mini_tasks[0])}")
 
-        # start randomly
-        if self.num_workers > 4 and self.try_number == 1:
-            import math
-            # assume there is some doubling rate for workers to come online
-            # (probably should sample an exponential)
-            sample_bound = round(math.log2(self.num_workers)*ramp_up*2)
-            delay = random.randint(0, sample_bound)
-            time.sleep(delay)
+        # requests in flight grow while cloud run keeps up (shared by the tasks of the run, see concurrency.py)
+        self._limit = AdaptiveLimit(self.max_in_flight if self.dispatch == "asyncio" else self.num_threads,
+                self.concurrency_state, str(self.conn_id), self.log)
+        self._limit.start_sync()
 
         results = {}
-        assigned = set()
+        try:
+            if self.dispatch == "asyncio":
+                self._execute_async(mini_tasks, results)
+            else:
+                self._execute_threads(mini_tasks, results)
+        finally:
+            self._limit.stop_sync()
+
+        if self.xcom_push_flag:
+            self.serialize_results(self.cache, f"worker-{self.worker_id}", json.dumps(results))
+            #return results
+
+    def _set_token(self):
+        """Set the authorization header from gcloud (if available).
+        """
+        try:
+            token = subprocess.check_output(["gcloud auth print-identity-token"], shell=True).decode()
+            self.headers["Authorization"] = f"Bearer {token[:-1]}"
+        except Exception:
+            pass
+
+    def _auth_headers(self):
+        """Copy of the headers (the token is refreshed every TOKEN_TIMEOUT seconds).
+        """
+        with self._token_lock:
+            if (time.time() - self._token_time) > TOKEN_TIMEOUT:
+                self._token_time = time.time()
+                self.log.info("setting token")
+                self._set_token()
+            return self.headers.copy()
+
+    def _is_cached(self, id):
+        return str(id) in self._cached_ids
+
+    def _is_skipped(self, id):
+        """True if the mini task was completed by another task of the stage (see work_queue).
+        """
+        return self._queue is not None and self._is_cached(id) and not self._queue.owns(id)
+
+    def _cached_result(self, id):
+        """Result of a mini task computed by an earlier try (None if not cached).
+
+        The result is only read if it is pushed or logged ("" otherwise).
+        """
+        if not self._is_cached(id):
+            return None
+        self.log.info(f"cached result {id}")
+        if not self.xcom_push_flag and not self.log_response:
+            return ""
+        try:
+            return self.deserialize_results(self.cache, str(id))
+        except Exception:
+            # (deleted since the listing)
+            return None
+
+    def _call(self, id, params):
+        """Call cloud run once for a mini task (raises on failure).
+
+        The request must have been started with the adaptive limit, which is
+        released with its outcome.
+        """
+        start = time.time()
+        try:
+            http = HttpHook("POST", http_conn_id=self.conn_id)
+            response = http.run(
+                        self.endpoint,
+                        params,
+                        self._auth_headers(),
+                        {"timeout": CLOUDRUN_TIMEOUT}
+                        )
+        except Exception as e:
+            self._limit.release(overload=is_overload(e))
+            raise
+        latency = time.time() - start
+        self._limit.release(latency=latency)
+        self._latencies.append(latency)
+        self.log.info(f"completed call {id}") 
+        return response
+
+    def _complete(self, id, final_resp, response, results):
+        """Validate, log, and save the result of a mini task (response is None if cached).
+        """
+        # check if output is valid
+        if self.validate_output is not None and response is not None:
+            if not self.validate_output(response):
+                raise AirflowException(f"output test failed {id}")
+
+        if self.log_response:
+            self.log.info(f"task: {id} {final_resp}") 
+        
+        # save result if there is a failure
+        if self.cache != "" and response is not None:
+            self.serialize_results(self.cache, str(id), final_resp)
+
+        if self.xcom_push_flag:
+            results[id] = final_resp
 
+    def _execute_threads(self, mini_tasks, results):
+        """Run the mini tasks on num_threads threads that claim tasks in order.
+        """
         failure = None
         remaining_threads = self.num_threads
-        num_workers = self.num_workers
-
-        if len(mini_tasks) > 0:
-            self.log.info(f"Params: {json.dumps(mini_tasks[0])}")
 
         glb_lock = threading.Lock()
+        assigned = set()
 
         def is_available(id):
             with glb_lock:
@@ -138,76 +315,36 @@ class CloudRunBatchOperator(BaseOperator):
         def run_query(thread_id):
             nonlocal failure
             nonlocal remaining_threads
-            start_time = time.time()
 
             try:
                 self.log.info(f"start thread {thread_id}") 
-                factor = 1
-                spot = thread_id
-            
-                if num_workers > 4 and self.try_number == 1:
-                    while spot > 0:
-                        delay = random.randint(0, ramp_up*2)
-                        time.sleep(delay)
-
-                        factor *= 2
-                        spot -= factor
-                headers = self.headers.copy()
 
                 for idx, [id, task] in enumerate(mini_tasks):
                     if failure is not None:
                         break # exit thread if a failure is detected
-                    #if (idx % self.num_threads) == thread_id:
                     if is_available(idx):
+                        if self._is_skipped(id):
+                            continue
                         params = json.dumps(task)
-                        #self.log.info(f"(thread {thread_id}) start http {id} {params}") 
-                        self.log.info(f"(thread {thread_id}) start http {id}") 
 
-                        final_resp = None
-                        cached_result = False
-
-                        # save result if there is a failure
-                        if self.cache != "":
-                            try:
-                                # see if result was already computed
-                                final_resp = self.deserialize_results(self.cache, str(id))
-                                self.log.info(f"(thread {thread_id}) cached result {id}")
-                                cached_result = True
-                            except Exception as e:
-                                # not in cache
-                                pass
+                        response = None
+                        final_resp = self._cached_result(id)
+
+                        # another task of the stage may have claimed it
+                        if final_resp is None and self._queue is not None and not self._queue.claim(id):
+                            continue
+                        self.log.info(f"(thread {thread_id}) start http {id}") 
                         
                         # fetch if no cache
                         if final_resp is None:
-                            http = HttpHook("POST", http_conn_id=self.conn_id)
-                            
                             # enable unconditional retries at mini task level
                             # to avoid problems with the whole batch crashing
                             num_tries = 0
-                            success = False
-                            while not success and num_tries < self.num_http_tries:
-                                # reset token if expired
-                                if (time.time() - start_time) > TOKEN_TIMEOUT:
-                                    start_time = time.time()
-                                    # set token if expired
-                                    # extract auth token from gcloud
-                                    try:
-                                        token = subprocess.check_output(["gcloud auth print-identity-token"], shell=True).decode()
-                                        self.log.info("setting token")
-                                        headers["Authorization"] = f"Bearer {token[:-1]}"
-                                    except Exception:
-                                        pass
-
+                            while final_resp is None:
                                 num_tries += 1
-                                success = True
                                 try:
-                                    response = http.run(
-                                                self.endpoint,
-                                                params,
-                                                headers,
-                                                {"timeout": CLOUDRUN_TIMEOUT}
-                                                )
-                                    self.log.info(f"(thread {thread_id}) completed call {id}") 
+                                    self._limit.acquire()
+                                    response = self._call(id, params)
                                     final_resp = response.text
                                 except Exception as e:
                                     if num_tries >= self.num_http_tries:
@@ -215,26 +352,11 @@ class CloudRunBatchOperator(BaseOperator):
                                         failure = e
                                         break
                                     self.log.error(f"(thread {thread_id}) http failure {id}: " + str(e))
-                                    time.sleep(120) # wait a minute to try again
-                                    success = False
+                                    time.sleep(retry_delay(num_tries-1, e))
 
                         # only log result if no error
                         if failure is None:
-                            # check if output is valid
-                            if self.validate_output is not None and not cached_result:
-                                if not self.validate_output(response):
-                                    failure = AirflowException(f"output test failed {id}")
-                                    break
-
-                            if self.log_response:
-                                self.log.info(f"task: {id} {final_resp}") 
-                            
-                            # save result if there is a failure
-                            if self.cache != "" and not cached_result:
-                                self.serialize_results(self.cache, str(id), final_resp)
-
-                            if self.xcom_push_flag:
-                                results[id] = final_resp
+                            self._complete(id, final_resp, response, results)
 
             except Exception as e:
                 failure = e
@@ -265,64 +387,193 @@ class CloudRunBatchOperator(BaseOperator):
         if failure is not None:
             raise failure
 
-        if self.xcom_push_flag:
-            self.serialize_results(self.cache, f"worker-{self.worker_id}", json.dumps(results))
-            #return results
-
+    def _hedge_delay(self):
+        """Seconds after which a request is re-issued (None if hedging is off or there are too few samples).
+        """
+        if self.hedge_percentile == 0 or len(self._latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies)-1, int(len(latencies)*self.hedge_percentile/100))]
 
-    def serialize_results(self, dir, loc, res):
-        """Serialize to locaiton on disk.
+    def _execute_async(self, mini_tasks, results):
+        """Run the mini tasks with up to max_in_flight requests in flight.
 
-        Note: only support gs:// endpoints.
+        Results are validated and cached as they complete.  The first
+        failure cancels the remaining mini tasks and is raised once the
+        requests in flight have returned.
         """
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight + STORE_THREADS)
+
+        async def notify(gate, n):
+            async with gate:
+                gate.notify(n)
+
+        async def acquire(gate):
+            async with gate:
+                await gate.wait_for(self._limit.try_acquire)
+
+        async def claim(gate, id):
+            """Claim a mini task from the queue once it could start (the limit is kept if claimed).
+            """
+            await acquire(gate)
+            claimed = False
+            try:
+                claimed = await loop.run_in_executor(executor, self._queue.claim, id)
+            finally:
+                if not claimed:
+                    self._limit.release()
+                    asyncio.ensure_future(notify(gate, 1))
+            return claimed
+
+        async def run_task(gate, id, task):
+            if self._is_skipped(id):
+                return None
+            if self._is_cached(id):
+                final_resp = await loop.run_in_executor(executor, self._cached_result, id)
+                if final_resp is not None:
+                    return id, final_resp, None
+
+            # another task of the stage may have claimed it
+            acquired = False
+            if self._queue is not None:
+                if not await claim(gate, id):
+                    return None
+                acquired = True
+
+            # enable unconditional retries at mini task level
+            # to avoid problems with the whole batch crashing
+            params = json.dumps(task)
+            num_tries = 0
+            while True:
+                num_tries += 1
+                try:
+                    if not acquired:
+                        await acquire(gate)
+                    acquired = False
+                    self.log.info(f"start http {id}") 
+                    response = await call(gate, id, params)
+                    return id, response.text, response
+                except Exception as e:
+                    if num_tries >= self.num_http_tries:
+                        self.log.error(f"http final failure {id}: " + str(e))
+                        raise
+                    self.log.error(f"http failure {id}: " + str(e))
+                    delay = retry_delay(num_tries-1, e)
+                await asyncio.sleep(delay)
+
+        def start_call(gate, id, params):
+            """Run _call on the executor for a request that holds a slot of the limit.
+            """
+            request = executor.submit(self._call, id, params)
+            future = asyncio.wrap_future(request, loop=loop)
+            def wake(future):
+                if future.cancelled():
+                    # a request cancelled while still queued (e.g., a losing hedge)
+                    # never runs _call, which would release its slot
+                    if request.cancel():
+                        self._limit.release()
+                else:
+                    future.exception() # (a losing hedge may fail unobserved)
+                # (a completed request frees its slot and can grow the limit by one)
+                asyncio.ensure_future(notify(gate, 2))
+            future.add_done_callback(wake)
+            return future
+
+        async def call(gate, id, params):
+            """Response of the first successful request (the limit was acquired for the first).
+            """
+            first = start_call(gate, id, params)
+            pending = {first}
+            hedge_delay = self._hedge_delay()
+            if hedge_delay is not None:
+                done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+                if done:
+                    return first.result()
+
+                async def hedge():
+                    # the hedge waits for the limit like any other request
+                    await acquire(gate)
+                    self.log.info(f"hedge http {id} (after {hedge_delay:.1f} seconds)")
+                    return await start_call(gate, id, params)
+                pending.add(asyncio.ensure_future(hedge()))
+
+            error = None
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        if future.exception() is None:
+                            # (a slower request keeps running and is ignored)
+                            return future.result()
+                        error = future.exception()
+                raise error
+            finally:
+                # stop a hedge that is still waiting for the limit
+                for future in pending:
+                    if future is not first:
+                        future.cancel()
+
+        async def dispatch():
+            gate = asyncio.Condition()
+            tasks = [asyncio.ensure_future(run_task(gate, id, task)) for id, task in mini_tasks]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    result = await next_done
+                    if result is None:
+                        continue # (run by another task of the stage)
+                    id, final_resp, response = result
+                    await loop.run_in_executor(executor, self._complete, id, final_resp, response, results)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        main_task = loop.create_task(dispatch())
 
-        # strip gs prefix if it exists
-        if dir.startswith("gs://"):
-            dir  = dir[5:]
-        dir_path = dir.split("/")
+        # create signal catcher to properly catch errors
+        interrupted = False
+        def sighandler(signum, frame):
+            nonlocal interrupted
+            self.log.info("interrupt caught") 
+            interrupted = True
+            loop.call_soon_threadsafe(main_task.cancel)
 
-        # grab bucket name
-        bucket_name = dir_path[0]
-        
-        # get path
-        path = "/".join(dir_path[1:])
-        if path[-1] != "/":
-            path += "/"
-        path += loc
-
-        ghook = GoogleCloudStorageHook() # uses default gcp connection
-        client = ghook.get_conn()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(blob_name=path)
-        blob.upload_from_string(res) 
+        signal.signal(signal.SIGINT, sighandler)
 
-    def deserialize_results(self, dir, loc):
-        """Deserialize to locaiton on disk.
+        try:
+            loop.run_until_complete(main_task)
+        except asyncio.CancelledError:
+            if interrupted:
+                raise AirflowException("CloudRunBatch was interrupted")
+            raise
+        finally:
+            # wait for the requests in flight (they cannot be cancelled)
+            executor.shutdown(wait=True)
+            loop.close()
 
-        Note: only support gs:// endpoints.
-        """
 
-        # strip gs prefix if it exists
-        if dir.startswith("gs://"):
-            dir  = dir[5:]
-        dir_path = dir.split("/")
+    def serialize_results(self, dir, loc, res):
+        """Serialize to location dir/loc.
 
-        # grab bucket name
-        bucket_name = dir_path[0]
-        
-        # get path
-        path = "/".join(dir_path[1:])
-        if path[-1] != "/":
-            path += "/"
-        path += loc
-
-        ghook = GoogleCloudStorageHook() # uses default gcp connection
-        client = ghook.get_conn()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(blob_name=path)
-        # raises error if not found
-        return blob.download_as_string().decode()
+        Note: dir can be any location supported by objectstore (gs://, file://, mem://, or a bucket name).
+        """
+        self._store(dir).write(loc, res)
 
+    def deserialize_results(self, dir, loc):
+        """Deserialize from location dir/loc.
 
+        Note: dir can be any location supported by objectstore (gs://, file://, mem://, or a bucket name).
+        """
+        # raises error if not found
+        return self._store(dir).read(loc).decode()
 
-  
+    def _store(self, dir):
+        """Store for dir (opened once per execution and shared by the threads).
+        """
+        stores = getattr(self, "_stores", None)
+        if stores is None:
+            return objectstore.open_store(dir)
+        if dir not in stores:
+            stores[dir] = objectstore.open_store(dir)
+        return stores[dir]
@@ -0,0 +1,184 @@
+"""Adaptive limit on the cloud run requests in flight.
+
+CloudRunBatchOperator used to sleep for a random time (up to
+log2(num_workers)*120 seconds) before its first request, and each of its
+threads slept again before starting, to give cloud run time to scale
+up.  The limit here instead reacts to how the service is doing:
+
+* the limit starts small and grows by one for every successful request
+  (doubling per round trip) until the first sign of overload, and then by
+  about one per round trip (additive increase)
+* a 429, 502, 503 or 504 response or a timeout halves the limit
+  (multiplicative decrease), at most once per DECREASE_INTERVAL so that a
+  burst of failures from the same overload counts once
+* a request that takes more than LATENCY_FACTOR times the fastest
+  request seen does not grow the limit (queueing in the service)
+
+The limit can be shared by all batch tasks of a DAG run through a small
+state object in an object store (see objectstore.py).  A task that backs
+off publishes its limit, other tasks adopt it when they sync (every
+SYNC_INTERVAL seconds), and tasks that start later begin at the
+published limit instead of starting over.
+
+Failed requests are retried after a capped exponential backoff with full
+jitter (see retry_delay), longer for overload than for other errors so
+that an overloaded service is given time to scale up while a transient
+error is retried quickly.
+"""
+
+import json
+import random
+import threading
+import time
+
+from emprocess import objectstore
+
+# requests in flight per task at the start (without a published limit)
+INITIAL_LIMIT = 2
+
+# seconds between decreases and between syncs with the shared state
+DECREASE_INTERVAL = 10
+SYNC_INTERVAL = 30
+
+# requests slower than this multiple of the fastest request do not grow the limit
+LATENCY_FACTOR = 4
+
+# http status codes that signal an overloaded service
+OVERLOAD_CODES = ("429", "502", "503", "504")
+
+# backoff (base, cap) in seconds for each class of error: the delay before
+# retry n (from 0) is uniform in [0, min(cap, base*2**n)]
+BACKOFF_OVERLOAD = (5, 240)
+BACKOFF_ERROR = (1, 60)
+
+
+def is_overload(error):
+    """True if a failed request signals overload (throttling, unavailable service, or a timeout).
+    """
+    try:
+        import requests
+        if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return True
+    except ImportError:
+        pass
+    # (HttpHook raises "{status code}:{reason}")
+    return str(error).split(":")[0].strip() in OVERLOAD_CODES
+
+
+def retry_delay(attempt, error):
+    """Seconds to wait before retrying after the given (0-based) failed attempt.
+    """
+    base, cap = BACKOFF_OVERLOAD if is_overload(error) else BACKOFF_ERROR
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveLimit:
+    """AIMD limit on requests in flight.
+
+    Args:
+        maximum (int): largest limit
+        state (str): location of the shared state (see objectstore.open_store, "" for a local limit)
+        name (str): name of the state object (one limit per name)
+        log (logger): logs changes of the limit (optional)
+    """
+
+    def __init__(self, maximum, state="", name="limit", log=None):
+        self.maximum = max(maximum, 1)
+        self.limit = float(min(INITIAL_LIMIT, self.maximum))
+        self.slow_start = True
+        self.in_flight = 0
+        self.min_latency = None
+        self.last_decrease = 0
+        self.log = log
+        self.cond = threading.Condition()
+
+        self.store = None
+        self.name = name + ".json"
+        self.synced = time.time()
+        self._stop = threading.Event()
+        if state != "":
+            self.store = objectstore.open_store(state)
+            shared = self._read_state()
+            if shared is not None:
+                # continue from the limit of the tasks that ran before
+                self.limit = float(max(1, min(shared["limit"], self.maximum)))
+                self.slow_start = False
+
+    def try_acquire(self):
+        """Start a request if the limit allows it (True if started).
+        """
+        with self.cond:
+            if self.in_flight < max(1, int(self.limit)):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Wait until a request can start.
+        """
+        with self.cond:
+            self.cond.wait_for(self.try_acquire)
+
+    def release(self, latency=None, overload=False):
+        """Finish a request (latency in seconds if it succeeded, overload if it failed with overload).
+        """
+        with self.cond:
+            self.in_flight -= 1
+            if overload:
+                self._decrease()
+            elif latency is not None:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency <= LATENCY_FACTOR*self.min_latency:
+                    self.limit = min(self.maximum, self.limit + (1 if self.slow_start else 1/self.limit))
+            self.cond.notify_all()
+
+    def _decrease(self):
+        now = time.time()
+        if (now - self.last_decrease) < DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+        self.slow_start = False
+        self.limit = max(1.0, self.limit/2)
+        if self.log is not None:
+            self.log.info(f"overload: limit {int(self.limit)} requests in flight")
+
+    def _read_state(self):
+        try:
+            return json.loads(self.store.read(self.name).decode())
+        except Exception:
+            return None
+
+    def sync(self):
+        """Adopt a lower limit published by another task and publish our own decreases.
+        """
+        if self.store is None:
+            return
+        shared = self._read_state()
+        with self.cond:
+            if shared is not None and shared["time"] > self.synced and shared["limit"] < self.limit:
+                self.limit = float(max(1, shared["limit"]))
+                self.slow_start = False
+            decreased = self.last_decrease > self.synced
+            self.synced = time.time()
+            limit = int(self.limit)
+        if decreased:
+            try:
+                # (writes to the object are rate limited, a lost update is adopted at the next decrease)
+                self.store.write(self.name, json.dumps({"limit": limit, "time": time.time()}))
+            except Exception:
+                pass
+
+    def start_sync(self):
+        """Sync with the shared state every SYNC_INTERVAL seconds until stop_sync.
+        """
+        if self.store is None:
+            return
+        def run():
+            while not self._stop.wait(SYNC_INTERVAL):
+                self.sync()
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_sync(self):
+        self._stop.set()
+        self.sync()
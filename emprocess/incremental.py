@@ -0,0 +1,89 @@
+"""Helpers for incremental runs that update the volume of an earlier run.
+
+A run with "base-run" set does not create new buckets.  It writes into
+the temporary, chunk, and neuroglancer buckets of the base run, and it
+only processes the "dirty" slices.  These are the slices in [minz, maxz],
+or the slices listed in "slices".  It can append slices after the last
+slice of the volume, or re-process slices that changed.
+
+Each run records the state of its volume in
+source_process/{volume id}/align/volume.json: the slice range, the
+bounding box, the location of the latest transforms, and whether the
+temporary tiles are kept ("keep-tmp").  ngshard re-reads the tiles of
+unchanged slices, so a base run must have kept them, and an incremental
+run never schedules them for deletion.  An incremental
+run reads this state and aligns each dirty slice to the slice before it,
+in the coordinate frame of the volume.  The bounding box therefore never
+changes, and appended content outside of it is cropped.  The following
+slices keep their transforms.  The pyramid is then rewritten only where
+the dirty slices fall (see pyramid.py).
+"""
+
+import json
+
+from airflow import AirflowException
+
+from emprocess import objectstore
+
+# location of the volume state within source_process/{volume id}/
+VOLUME_STATE = "align/volume.json"
+
+# template for the id of the run whose buckets hold the volume
+VOLUME_ID = "{{ dag_run.conf.get('base-run', run_id) }}"
+
+
+def dirty_slices(minz, maxz, slices=None):
+    """Sorted slices processed by a run.
+
+    Args:
+        minz (int): first slice of the run
+        maxz (int): last slice of the run
+        slices (list or str): changed slices (json string accepted, empty for all of [minz, maxz])
+    Returns:
+        list of slices
+    """
+    if isinstance(slices, str):
+        slices = json.loads(slices) if slices.strip() not in ("", "None") else None
+    if not slices:
+        return list(range(minz, maxz+1))
+    return sorted(set(int(slice) for slice in slices))
+
+
+def dirty_ranges(slices):
+    """Merge sorted slices into [first, last] ranges.
+    """
+    ranges = []
+    for slice in slices:
+        if ranges and ranges[-1][1] + 1 == slice:
+            ranges[-1][1] = slice
+        else:
+            ranges.append([slice, slice])
+    return ranges
+
+
+def written_slices(slices, volume, brick_depth=0):
+    """Slices whose temporary tiles are rewritten for the dirty slices.
+
+    A z brick holds brick_depth slices, so it is rewritten with all of its
+    slices that belong to the volume.
+    """
+    if brick_depth <= 0:
+        return list(slices)
+    written = set()
+    for zbrick in sorted(set(slice // brick_depth for slice in slices)):
+        written.update(range(max(zbrick*brick_depth, volume[0]), min((zbrick+1)*brick_depth - 1, volume[1]) + 1))
+    return sorted(written)
+
+
+def read_volume_state(source, volume_id):
+    """State of the volume written by an earlier run (raises if it was not recorded).
+    """
+    store = objectstore.open_store(source + "_process")
+    try:
+        return json.loads(store.read(f"{volume_id}/{VOLUME_STATE}").decode())
+    except Exception as e:
+        raise AirflowException(f"no volume state for run {volume_id} (recorded by runs that support incremental updates): {e}")
+
+
+def write_volume_state(source, volume_id, state):
+    objectstore.open_store(source + "_process").write(f"{volume_id}/{VOLUME_STATE}", json.dumps(state))
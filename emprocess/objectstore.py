@@ -0,0 +1,246 @@
+"""Object storage backends used by the DAG tasks.
+
+Mirrors emwrite_docker/objectstore.py so that locations mean the same
+thing to the DAG and to the emwrite endpoints.  The two files cannot be
+shared because they run in different images: this one uses the Airflow
+gcp connection and no tensorstore.  Keep the LocalStore and MemoryStore
+behavior of both in sync.  Deliberate differences: this copy adds
+create (leases of workqueue.py) and is_gcs, and the emwrite copy adds
+read_into, content encodings, and the tensorstore kvstore specs.
+
+* a bucket name or gs://bucket[/prefix]: Google cloud storage (through the default gcp connection)
+* file:///path: a local (or shared NFS/Lustre) filesystem, reads use mmap
+* mem://name: an in-memory store shared by the process (for testing)
+"""
+
+import mmap
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from airflow.contrib.hooks.gcs_hook import GoogleCloudStorageHook
+from google.api_core.exceptions import PreconditionFailed
+
+# threads used by write_many for remote stores
+WRITE_THREADS = 8
+
+_memory_stores = {}
+_memory_lock = threading.Lock()
+
+
+def open_store(location):
+    """Open the store for a location (see module documentation).
+    """
+    if location.startswith("file://"):
+        return LocalStore(location[len("file://"):])
+    if location.startswith("mem://"):
+        name = location[len("mem://"):]
+        with _memory_lock:
+            if name not in _memory_stores:
+                _memory_stores[name] = MemoryStore()
+            return _memory_stores[name]
+    if location.startswith("gs://"):
+        location = location[len("gs://"):]
+    bucket, _, prefix = location.partition("/")
+    return GCSStore(bucket, prefix)
+
+
+def is_gcs(location):
+    """True if the location is stored in Google cloud storage.
+    """
+    return not location.startswith("file://") and not location.startswith("mem://")
+
+
+class ObjectStore:
+    """Interface implemented by all storage backends.
+
+    Ranges are given as [start, end) byte offsets (end=None reads to the end).
+    """
+
+    def read(self, name, start=0, end=None):
+        """Read an object (or a range of it) as bytes.
+        """
+        raise NotImplementedError
+
+    def write(self, name, data, content_type="application/octet-stream"):
+        """Write (replace) an object.
+        """
+        raise NotImplementedError
+
+    def write_many(self, items, content_type="application/octet-stream"):
+        """Write several objects given as (name, data) pairs.
+        """
+        for name, data in items:
+            self.write(name, data, content_type)
+
+    def create(self, name, data, content_type="application/octet-stream"):
+        """Write an object only if it does not exist (True if it was written).
+
+        Only one of several concurrent calls for the same name succeeds.
+        """
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Names of all objects starting with prefix.
+        """
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+
+class GCSStore(ObjectStore):
+    """Google cloud storage bucket (optionally restricted to a prefix).
+    """
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket_name = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") != "" else ""
+        self.client = GoogleCloudStorageHook().get_conn() # uses default gcp connection
+        self.bucket = self.client.bucket(bucket)
+
+    def _blob(self, name):
+        return self.bucket.blob(blob_name=self.prefix + name)
+
+    def read(self, name, start=0, end=None):
+        if start == 0 and end is None:
+            return self._blob(name).download_as_string()
+        return self._blob(name).download_as_string(start=start, end=(end-1 if end is not None else None))
+
+    def write(self, name, data, content_type="application/octet-stream"):
+        self._blob(name).upload_from_string(data, content_type=content_type)
+
+    def write_many(self, items, content_type="application/octet-stream"):
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=min(WRITE_THREADS, max(len(items), 1))) as executor:
+            list(executor.map(lambda item: self.write(item[0], item[1], content_type), items))
+
+    def create(self, name, data, content_type="application/octet-stream"):
+        # (generation 0 matches only an object that does not exist)
+        try:
+            self._blob(name).upload_from_string(data, content_type=content_type, if_generation_match=0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def list(self, prefix=""):
+        return [blob.name[len(self.prefix):] for blob in self.client.list_blobs(self.bucket_name, prefix=self.prefix + prefix)]
+
+    def exists(self, name):
+        return self._blob(name).exists()
+
+    def delete(self, name):
+        self._blob(name).delete()
+
+
+class LocalStore(ObjectStore):
+    """Directory on a POSIX filesystem (writes are atomic renames).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def read(self, name, start=0, end=None):
+        with open(self._path(name), "rb") as fin:
+            size = os.fstat(fin.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return b""
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[start:end]
+
+    def write(self, name, data, content_type="application/octet-stream"):
+        if isinstance(data, str):
+            data = data.encode()
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def create(self, name, data, content_type="application/octet-stream"):
+        if isinstance(data, str):
+            data = data.encode()
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(data)
+            # (a hard link fails if the object exists, and the object appears complete)
+            os.link(temp_path, path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+        return True
+
+    def list(self, prefix=""):
+        names = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def delete(self, name):
+        os.remove(self._path(name))
+
+
+class MemoryStore(ObjectStore):
+    """Objects held in a dictionary.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def read(self, name, start=0, end=None):
+        with self.lock:
+            data = self.objects[name]
+        return data[start:end]
+
+    def write(self, name, data, content_type="application/octet-stream"):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            self.objects[name] = bytes(data)
+
+    def create(self, name, data, content_type="application/octet-stream"):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            if name in self.objects:
+                return False
+            self.objects[name] = bytes(data)
+            return True
+
+    def list(self, prefix=""):
+        with self.lock:
+            return sorted(name for name in self.objects if name.startswith(prefix))
+
+    def exists(self, name):
+        with self.lock:
+            return name in self.objects
+
+    def delete(self, name):
+        with self.lock:
+            del self.objects[name]
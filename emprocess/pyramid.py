@@ -2,21 +2,52 @@
 
 This module creates an image pyramid in neuroglancer format from a
 list of aligned images.  The images are stored in a temporary bucket
-called source_{{ ds_nodash }}, where each image is encoded as an 
-array of 1024x1024 tiles.  The tiles are located encoded in the file
-as deterimined by the header.  The header is N*4 bytes (N is
-the number of tiles) which gives the offset for each tile in the larger file.
+called source_tmp_{{ run_id }} (the run id of the base run for incremental
+runs, see incremental.py), where each 4096x4096 region of an image
+is stored as a container of 1024x1024 tiles.  The container starts with
+a fixed-size header and index (offset, size, codec, and checksum of each
+tile) followed by the encoded tiles (see emwrite_docker/tilecontainer.py).
+If "brick-depth" is set, each 1024x1024 tile column is instead stored
+for brick-depth consecutive slices in one container (a z brick), which
+reduces the number of requests per cube.
+
+Before the shards are written, the index fragments published with each
+slice are merged into one manifest per 1024-slice z range, so ngshard
+can fetch tile data without first reading every container index.
 
 A scale pyramid in jpeg and no compression is created using sharded
-neeuroglancer format.  The sharding options correspond to what will
-minimize writes to the same object.  In this case, 1024x1024x1024
-cubes are extracted allowing scales 0 through 4 to be written disjointly
-by changing the number of shard bits.
+neeuroglancer format.  The raw pyramid ("raw-scales" scales, unsharded
+gzip chunks by default or the jpeg shards if "raw-layout" is sharded) is
+written from the same downsampled scales.  Each cube is streamed through the pyramid in
+slabs of "slab-depth" slices (see emwrite_docker/slabpyramid.py).  The
+sharding of each scale is planned by ngmeta from the volume size
+("shard-chunks" and "shard-bytes", see emwrite_docker/shardplan.py) so
+that no shard crosses a 1024x1024x1024 cube, and the cubes are written
+disjointly.
 
 This module creates 500 worker tasks that iterate through all 1024x1024x1024
 subvolumes.  It would be hard to know the number of tasks beforehand
 since the alignment could affect this.
 
+Incremental runs only write the manifests and cubes that contain dirty
+slices, and ngshard only rewrites the layers of shards (and raw chunks)
+that contain them.  The coarser scales of a cube are recomputed from all
+of its slices.
+
+ngshard builds 6 scales within each cube, so the coarsest of these still
+has a 32x32x32 chunk per cube.  The info also lists coarser scales that
+halve the volume until it fits in a single chunk.  After the shards are
+written, up to REDUCE_STAGES stages build them across cubes (ngreduce):
+each stage reads its source scale in blocks of REDUCE_BLOCK_SIZE voxels
+and writes the next REDUCE_LEVELS scales of each block, and the next
+stage starts from the last of these.  Incremental runs only reduce the
+blocks that contain dirty slices.
+
+The stages here are never hedged (see hedge_percentile in
+cloudrun_operator.py): a duplicate ngshard or ngreduce request would
+rebuild a whole cube or block and commit the same shards concurrently,
+doubling the largest requests when the service is already slow.
+
 Note: this module defines related tasks and not a subdag.  See the documentation
 in align.py for more details regarding this decision.
 """
@@ -28,11 +59,27 @@ from airflow.operators.dummy_operator import DummyOperator
 from airflow.contrib.hooks.gcs_hook import GoogleCloudStorageHook
 from airflow.hooks.http_hook import HttpHook
 from emprocess.cloudrun_operator import CloudRunOperator, CloudRunBatchOperator
+from emprocess import incremental, objectstore
 
 import json
 import logging
 
-def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST_MODE=False, SHARD_SIZE=1024):
+# each manifest task merges up to SHARD_SIZE slice fragments
+MANIFEST_WORKERS = 4
+
+# scales written by ngshard within each cube (coarser scales are reduced across cubes)
+NUM_SHARD_SCALES = 6
+
+# each ngreduce request reads a block of REDUCE_BLOCK_SIZE^3 voxels and writes
+# REDUCE_LEVELS scales (must match emwrite_docker/emwrite.py); REDUCE_STAGES
+# stages reduce volumes of up to 2^(NUM_SHARD_SCALES-1+REDUCE_STAGES*REDUCE_LEVELS)
+# chunks of 64 per dimension
+REDUCE_BLOCK_SIZE = 512
+REDUCE_LEVELS = 3
+REDUCE_STAGES = 4
+REDUCE_WORKERS = 4
+
+def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST_MODE=False, SHARD_SIZE=1024, volume_task_id=None):
     """Creates ingsetion tasks for creating neuroglancer precomputed volumees.
 
     Args:
@@ -42,25 +89,43 @@ def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST
         pool (str): name of high throughput queue for http requests
         TEST_MODE (boolean): if true disable requests to gbucket
         SHARD_SIZE (int): chunk size used for saving data
+        volume_task_id (str): task id for task containing the slice range of the volume
+            (see align.py, [minz, maxz] if not set)
     Returns:
         (starting dag task, ending dag task)
 
     """
-    
+
+    # slice range of the whole volume (only the dirty slices are processed in incremental runs)
+    volume_minz = "{{ dag_run.conf['minz'] }}"
+    volume_maxz = "{{ dag_run.conf['maxz'] }}"
+    if volume_task_id is not None:
+        volume_minz = f"{{{{ task_instance.xcom_pull(task_ids='{volume_task_id}', key='volume')[0] }}}}"
+        volume_maxz = f"{{{{ task_instance.xcom_pull(task_ids='{volume_task_id}', key='volume')[1] }}}}"
+    volume = f"[{volume_minz}, {volume_maxz}]"
+
     # write meta data for location/ng/jpeg and location/ng/raw
     create_ngmeta_t = CloudRunOperator(
         task_id=f"{name}.write_ngmeta",
         http_conn_id="IMG_WRITE",
         endpoint="/ngmeta",
         data=json.dumps({
-                "dest": "{{ dag_run.conf['source'] }}_ng_{{ run_id }}",
-                "dest_raw": "{{ dag_run.conf['source'] }}_chunk_{{ run_id }}",
-                "minz": "{{ dag_run.conf['minz'] }}",
-                "maxz": "{{ dag_run.conf['maxz'] }}",
+                "dest": "{{ dag_run.conf['source'] }}_ng_" + incremental.VOLUME_ID,
+                "dest_raw": "{{ dag_run.conf['source'] }}_chunk_" + incremental.VOLUME_ID,
+                "minz": volume_minz,
+                "maxz": volume_maxz,
+                "update": "{{ 'base-run' in dag_run.conf }}",
+                "reserve-maxz": "{{ dag_run.conf.get('reserve-maxz', 0) }}",
+                "shard-chunks": "{{ dag_run.conf.get('shard-chunks', 64) }}",
+                "shard-bytes": "{{ dag_run.conf.get('shard-bytes', 67108864) }}",
                 "bbox": f"{{{{ task_instance.xcom_pull(task_ids='{bbox_task_id}') }}}}",
                 "shard-size": SHARD_SIZE,
                 "writeRaw": "{{ dag_run.conf.get('createRawPyramid', True) }}",
-                "resolution": "{{ dag_run.conf.get('resolution', 8) }}"
+                "resolution": "{{ dag_run.conf.get('resolution', 8) }}",
+                "jpeg-quality": "{{ dag_run.conf.get('jpeg-quality', 75) }}",
+                "raw-layout": "{{ dag_run.conf.get('raw-layout', 'unsharded') }}",
+                "raw-scales": "{{ dag_run.conf.get('raw-scales', 1) }}",
+                "raw-codec": "{{ dag_run.conf.get('raw-codec', 'gzip') }}"
         }),
         headers={"Content-Type": "application/json", "Accept": "application/json, text/plain, */*"},
         dag=dag
@@ -73,19 +138,21 @@ def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST
         """
         bbox = json.loads(data["bbox"])
         writeRaw = json.loads(data["writeRaw"].lower())
+        volume = json.loads(data["volume"])
+        slices = incremental.dirty_slices(int(data["minz"]), int(data["maxz"]), data["slices"])
 
         def extract_range(pt1, pt2):
             start = pt1 // SHARD_SIZE
             finish = pt2 // SHARD_SIZE
             return start, finish
 
-        zstart, zfinish = extract_range(int(data["minz"]), int(data["maxz"]))
         ystart, yfinish = extract_range(0, bbox[1]-1)
         xstart, xfinish = extract_range(0, bbox[0]-1)
         
         glb_iter = 0
         task_list = []
-        for iterz in range(zstart, zfinish+1):
+        # cubes with dirty slices
+        for iterz in sorted(set(slice // SHARD_SIZE for slice in slices)):
             for itery in range(ystart, yfinish+1):
                 for iterx in range(xstart, xfinish+1):
                     if (glb_iter % num_workers) == worker_id:
@@ -97,20 +164,137 @@ def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST
                                     "shard-size": data["shard-size"],
                                     "bbox": data["bbox"],
                                     "resolution": data["resolution"],
-                                    "minz": int(data["minz"]),
-                                    "maxz": int(data["maxz"]),
-                                    "writeRaw": data["writeRaw"] 
+                                    "minz": volume[0],
+                                    "maxz": volume[1],
+                                    "writeRaw": data["writeRaw"],
+                                    "raw-layout": data["raw-layout"],
+                                    "raw-scales": int(data["raw-scales"]),
+                                    "raw-codec": data["raw-codec"],
+                                    "raw-level": int(data["raw-level"]),
+                                    "tile-codec": data["tile-codec"],
+                                    "brick-depth": int(data["brick-depth"]),
+                                    "slab-depth": int(data["slab-depth"]),
+                                    "downsample-mode": data["downsample-mode"],
+                                    "downsample-sigma": float(data["downsample-sigma"]),
+                                    "ts-data-copy-concurrency": int(data["ts-data-copy-concurrency"]),
+                                    "ts-gcs-concurrency": int(data["ts-gcs-concurrency"]),
+                                    "ts-cache-bytes": int(data["ts-cache-bytes"]),
+                                    "manifest": True
                             }
+                        if json.loads(data["incremental"].lower()):
+                            # only shards and raw chunks with dirty slices are rewritten
+                            params["dirty-slices"] = incremental.dirty_ranges(slices)
                         task_list.append([glb_iter, params])
                     glb_iter += 1
 
         return task_list
 
-    finish_t = DummyOperator(task_id=f"{name}.finish_ngwrite", dag=dag)
+    # merge the index fragments of each z range into a manifest read by ngshard
+    def write_manifests(worker_id, num_workers, data, **context):
+        """Write one manifest per z range of SHARD_SIZE slices (with dirty slices).
+        """
+        volume = json.loads(data["volume"])
+        slices = incremental.dirty_slices(int(data["minz"]), int(data["maxz"]), data["slices"])
+
+        task_list = []
+        for iterz in sorted(set(slice // SHARD_SIZE for slice in slices)):
+            if (iterz % num_workers) == worker_id:
+                params = {
+                            "source": data["temp_location"],
+                            "zcube": iterz,
+                            "minz": volume[0],
+                            "maxz": volume[1],
+                            "bbox": data["bbox"],
+                            "shard-size": data["shard-size"],
+                            "brick-depth": int(data["brick-depth"])
+                        }
+                task_list.append([iterz, params])
+        return task_list
+
+    # reduce coarse scales across cubes (see ngreduce)
+    def reduce_blocks(worker_id, num_workers, data, **context):
+        """Generate the blocks of one reduction stage (none once the volume fits in a chunk).
+        """
+        # the scales are listed in the info written by ngmeta
+        if TEST_MODE:
+            return []
+        info = json.loads(objectstore.open_store(data["dest"]).read("neuroglancer/jpeg/info").decode())
+        stage = int(data["stage"])
+        level = NUM_SHARD_SCALES - 1 + stage*REDUCE_LEVELS
+        num_levels = min(REDUCE_LEVELS, len(info["scales"]) - 1 - level)
+        if num_levels <= 0:
+            return []
+        if stage == REDUCE_STAGES - 1 and num_levels < len(info["scales"]) - 1 - level:
+            raise AirflowException(f"the volume needs more than {REDUCE_STAGES} reduction stages")
+
+        # only blocks with dirty slices are rewritten
+        slices = incremental.dirty_slices(int(data["minz"]), int(data["maxz"]), data["slices"])
+        size = info["scales"][level]["size"]
+        def num_blocks(dim):
+            return (size[dim] + REDUCE_BLOCK_SIZE - 1) // REDUCE_BLOCK_SIZE
+
+        glb_iter = 0
+        task_list = []
+        for iterz in range(num_blocks(2)):
+            first = (iterz*REDUCE_BLOCK_SIZE) << level
+            last = ((iterz+1)*REDUCE_BLOCK_SIZE << level) - 1
+            if not any(first <= slice <= last for slice in slices):
+                continue
+            for itery in range(num_blocks(1)):
+                for iterx in range(num_blocks(0)):
+                    if (glb_iter % num_workers) == worker_id:
+                        params = {
+                                    "dest": data["dest"],
+                                    "level": level,
+                                    "levels": num_levels,
+                                    "start": [iterx, itery, iterz],
+                                    "downsample-mode": data["downsample-mode"],
+                                    "ts-data-copy-concurrency": int(data["ts-data-copy-concurrency"]),
+                                    "ts-gcs-concurrency": int(data["ts-gcs-concurrency"]),
+                                    "ts-cache-bytes": int(data["ts-cache-bytes"])
+                                }
+                        task_list.append([f"{level}_{iterx}_{itery}_{iterz}", params])
+                    glb_iter += 1
+        return task_list
 
-    
+    shards_finish_t = DummyOperator(task_id=f"{name}.finish_ngshards", dag=dag)
+    finish_t = DummyOperator(task_id=f"{name}.finish_ngwrite", dag=dag)
+    manifest_finish_t = DummyOperator(task_id=f"{name}.finish_manifest", dag=dag)
 
     headers = {"Content-Type": "application/json", "Accept": "application/json, text/plain, */*"}
+    for worker_id in range(MANIFEST_WORKERS):
+        write_manifest_t = CloudRunBatchOperator(
+            task_id=f"{name}.write_manifest_{worker_id}",
+            gen_callable=write_manifests,
+            worker_id=worker_id,
+            num_workers=MANIFEST_WORKERS,
+            data={
+                    "temp_location": "{{ dag_run.conf['source'] }}_tmp_" + incremental.VOLUME_ID,
+                    "minz": "{{ dag_run.conf['minz'] }}",
+                    "maxz": "{{ dag_run.conf['maxz'] }}",
+                    "slices": "{{ dag_run.conf.get('slices', '') }}",
+                    "volume": volume,
+                    "bbox": f"{{{{ task_instance.xcom_pull(task_ids='{bbox_task_id}') }}}}",
+                    "brick-depth": "{{ dag_run.conf.get('brick-depth', 0) }}",
+                    "shard-size": SHARD_SIZE
+            },
+            conn_id="IMG_WRITE",
+            endpoint="/slicemanifest",
+            headers=headers,
+            log_response=False,
+            num_http_tries=15,
+            cache="{{ dag_run.conf['source'] }}_process/{{ run_id }}/manifest/cache" if not TEST_MODE else "",
+            xcom_push=False,
+            pool=pool,
+            try_number = "{{ task_instance.try_number }}",
+            dispatch="{{ dag_run.conf.get('dispatch', 'threads') }}",
+            max_in_flight="{{ dag_run.conf.get('max-in-flight', 256) }}",
+            concurrency_state="{{ dag_run.conf['source'] }}_process/{{ run_id }}/concurrency" if not TEST_MODE else "",
+            dag=dag,
+        )
+
+        create_ngmeta_t >> write_manifest_t >> manifest_finish_t
+
     for worker_id in range(NUM_WORKERS):
         write_shards_t = CloudRunBatchOperator(
             task_id=f"{name}.write_ng_shards_{worker_id}",
@@ -118,14 +302,29 @@ def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST
             worker_id=worker_id,
             num_workers=NUM_WORKERS,
             data={
-                    "source": "{{ dag_run.conf['source'] }}_ng_{{ run_id }}",
-                    "source_raw": "{{ dag_run.conf['source'] }}_chunk_{{ run_id }}",
-                    "temp_location": f"{{{{ dag_run.conf['source'] }}}}_tmp_{{{{ run_id }}}}",
+                    "source": "{{ dag_run.conf['source'] }}_ng_" + incremental.VOLUME_ID,
+                    "source_raw": "{{ dag_run.conf['source'] }}_chunk_" + incremental.VOLUME_ID,
+                    "temp_location": "{{ dag_run.conf['source'] }}_tmp_" + incremental.VOLUME_ID,
                     "minz": "{{ dag_run.conf['minz'] }}",
                     "maxz": "{{ dag_run.conf['maxz'] }}",
+                    "slices": "{{ dag_run.conf.get('slices', '') }}",
+                    "incremental": "{{ 'base-run' in dag_run.conf }}",
+                    "volume": volume,
                     "bbox": f"{{{{ task_instance.xcom_pull(task_ids='{bbox_task_id}') }}}}",
                     "writeRaw": "{{ dag_run.conf.get('createRawPyramid', True) }}",
+                    "raw-layout": "{{ dag_run.conf.get('raw-layout', 'unsharded') }}",
+                    "raw-scales": "{{ dag_run.conf.get('raw-scales', 1) }}",
+                    "raw-codec": "{{ dag_run.conf.get('raw-codec', 'gzip') }}",
+                    "raw-level": "{{ dag_run.conf.get('raw-level', 9) }}",
                     "resolution": "{{ dag_run.conf.get('resolution', 8) }}",
+                    "tile-codec": "{{ dag_run.conf.get('tile-codec', 'png') }}",
+                    "brick-depth": "{{ dag_run.conf.get('brick-depth', 0) }}",
+                    "slab-depth": "{{ dag_run.conf.get('slab-depth', 256) }}",
+                    "downsample-mode": "{{ dag_run.conf.get('downsample-mode', 'mean') }}",
+                    "downsample-sigma": "{{ dag_run.conf.get('downsample-sigma', 0) }}",
+                    "ts-data-copy-concurrency": "{{ dag_run.conf.get('ts-data-copy-concurrency', 0) }}",
+                    "ts-gcs-concurrency": "{{ dag_run.conf.get('ts-gcs-concurrency', 0) }}",
+                    "ts-cache-bytes": "{{ dag_run.conf.get('ts-cache-bytes', 0) }}",
                     "shard-size": SHARD_SIZE
             },
             conn_id="IMG_WRITE",
@@ -133,14 +332,58 @@ def export_dataset_psubdag(dag, name, NUM_WORKERS, bbox_task_id, pool=None, TEST
             headers=headers,
             log_response=False,
             num_http_tries=15, # retrying works okay now
-            cache="gs://" + "{{ dag_run.conf['source'] }}_process/{{ run_id }}/neuroglancer/cache" if not TEST_MODE else "",
+            cache="{{ dag_run.conf['source'] }}_process/{{ run_id }}/neuroglancer/cache" if not TEST_MODE else "",
+            work_queue="{% if dag_run.conf.get('work-queue', False) %}{{ dag_run.conf['source'] }}_process/{{ run_id }}/neuroglancer/queue{% endif %}" if not TEST_MODE else "",
             xcom_push=False,
             pool=pool,
             try_number = "{{ task_instance.try_number }}",
+            dispatch="{{ dag_run.conf.get('dispatch', 'threads') }}",
+            max_in_flight="{{ dag_run.conf.get('max-in-flight', 256) }}",
+            concurrency_state="{{ dag_run.conf['source'] }}_process/{{ run_id }}/concurrency" if not TEST_MODE else "",
             dag=dag,
         )
 
-        create_ngmeta_t >> write_shards_t >> finish_t
+        manifest_finish_t >> write_shards_t >> shards_finish_t
+
+    # each stage reads the last scale written by the stage before it
+    stage_start_t = shards_finish_t
+    for stage in range(REDUCE_STAGES):
+        stage_finish_t = finish_t if stage == REDUCE_STAGES - 1 else DummyOperator(
+                task_id=f"{name}.finish_reduce_{stage}", dag=dag)
+        for worker_id in range(REDUCE_WORKERS):
+            reduce_t = CloudRunBatchOperator(
+                task_id=f"{name}.reduce_{stage}_{worker_id}",
+                gen_callable=reduce_blocks,
+                worker_id=worker_id,
+                num_workers=REDUCE_WORKERS,
+                data={
+                        "dest": "{{ dag_run.conf['source'] }}_ng_" + incremental.VOLUME_ID,
+                        "stage": stage,
+                        "minz": "{{ dag_run.conf['minz'] }}",
+                        "maxz": "{{ dag_run.conf['maxz'] }}",
+                        "slices": "{{ dag_run.conf.get('slices', '') }}",
+                        "downsample-mode": "{{ dag_run.conf.get('downsample-mode', 'mean') }}",
+                        "ts-data-copy-concurrency": "{{ dag_run.conf.get('ts-data-copy-concurrency', 0) }}",
+                        "ts-gcs-concurrency": "{{ dag_run.conf.get('ts-gcs-concurrency', 0) }}",
+                        "ts-cache-bytes": "{{ dag_run.conf.get('ts-cache-bytes', 0) }}"
+                },
+                conn_id="IMG_WRITE",
+                endpoint="/ngreduce",
+                headers=headers,
+                log_response=False,
+                num_http_tries=15,
+                cache="{{ dag_run.conf['source'] }}_process/{{ run_id }}/neuroglancer/reduce_cache" if not TEST_MODE else "",
+                work_queue="{% if dag_run.conf.get('work-queue', False) %}{{ dag_run.conf['source'] }}_process/{{ run_id }}/neuroglancer/reduce_queue{% endif %}" if not TEST_MODE else "",
+                xcom_push=False,
+                pool=pool,
+                try_number = "{{ task_instance.try_number }}",
+                dispatch="{{ dag_run.conf.get('dispatch', 'threads') }}",
+                max_in_flight="{{ dag_run.conf.get('max-in-flight', 256) }}",
+                concurrency_state="{{ dag_run.conf['source'] }}_process/{{ run_id }}/concurrency" if not TEST_MODE else "",
+                dag=dag,
+            )
+            stage_start_t >> reduce_t >> stage_finish_t
+        stage_start_t = stage_finish_t
 
     # provide bookend tasks to caller
     return create_ngmeta_t, finish_t
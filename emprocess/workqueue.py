@@ -0,0 +1,97 @@
+"""Work queue shared by the batch tasks of a stage.
+
+Each CloudRunBatchOperator of a stage used to run a fixed share of the
+mini tasks (e.g., slice % num_workers), so a slow or retried Airflow task
+held up the whole stage while the other tasks sat idle.  With a work
+queue, every task of the stage generates all of the mini tasks and claims
+each one just before running it:
+
+* a mini task is claimed by creating its lease object in the queue
+  location, which only one task can do, and which appears complete (see
+  ObjectStore.create)
+* each task runs its own share first (every num_workers-th mini task in
+  the order of the generator, starting at worker_id, which need not be
+  the static split of the generator, e.g., slice % num_workers), and
+  then takes the mini tasks of the other tasks that nobody has claimed
+  yet, starting from the end of each share so that it rarely contends
+  with the owner working from the front
+* the stage drains when every mini task is claimed and finished
+
+Leases are never released.  A lease records the task that holds it, and
+a retry of that task takes back the leases of its failed try that have
+no result in the cache (Airflow runs one try of a task at a time).
+
+The locations are those of objectstore.py, so a queue can be tested with
+file:// or mem:// locations instead of GCS.
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from emprocess import objectstore
+
+# threads used to read the leases held by the failed try of a task
+READ_THREADS = 8
+
+
+class WorkQueue:
+    """Leases on the mini tasks of a stage.
+
+    Args:
+        location (str): location of the leases (see objectstore.open_store, one per stage)
+        ids (list): ids of all mini tasks of the stage (in the order of the generator)
+        worker_id (int): task of the stage
+        num_workers (int): tasks in the stage
+        owner (str): name recorded in the leases of this task (e.g., the task id)
+        try_number (int): try of this task (a retry takes back the leases of earlier tries)
+        done (set): ids (str) of the mini tasks with a cached result
+        log (logger): logs the leases taken back (optional)
+    """
+
+    def __init__(self, location, ids, worker_id, num_workers, owner, try_number=1, done=(), log=None):
+        self.store = objectstore.open_store(location)
+        self.owner = owner
+        self.try_number = try_number
+        num_workers = max(num_workers, 1)
+
+        # own share first, then the shares of the next tasks from their ends
+        self.order = list(range(worker_id, len(ids), num_workers))
+        self.own = set(str(ids[idx]) for idx in self.order)
+        for offset in range(1, num_workers):
+            self.order.extend(reversed(range((worker_id + offset) % num_workers, len(ids), num_workers)))
+
+        # (mini tasks leased before the task started are not claimed again)
+        self.leased = set(self.store.list())
+        self.reclaimed = set()
+        if try_number > 1:
+            pending = [id for id in self.leased if id not in done]
+            with ThreadPoolExecutor(max_workers=READ_THREADS) as executor:
+                for id, lease in zip(pending, executor.map(self._read_lease, pending)):
+                    if lease is not None and lease["owner"] == owner:
+                        self.reclaimed.add(id)
+            if log is not None:
+                log.info(f"{len(self.reclaimed)} leases taken back from earlier tries")
+
+    def _read_lease(self, id):
+        try:
+            return json.loads(self.store.read(id).decode())
+        except Exception:
+            # (leases are created complete, so an unreadable lease belongs to another task)
+            return None
+
+    def owns(self, id):
+        """True if the mini task is in the share of this task.
+        """
+        return str(id) in self.own
+
+    def claim(self, id):
+        """Lease a mini task (True if this task should run it).
+        """
+        id = str(id)
+        if id in self.reclaimed:
+            return True
+        if id in self.leased:
+            return False
+        lease = json.dumps({"owner": self.owner, "try": self.try_number, "time": time.time()})
+        return self.store.create(id, lease, "application/json")
@@ -0,0 +1,228 @@
+"""Contrast limited adaptive histogram equalization (CLAHE) for aligned slices.
+
+The slice is divided into a global grid of contextual tiles (kernel_size
+pixels on a side, anchored at the slice origin).  A clipped histogram and
+lookup table (LUT) is computed once per tile and kept for the life of the
+slice, so regions of the slice that are processed separately (e.g., the
+rendered tiles in alignedslice) share the LUTs of the tiles along their
+borders instead of recomputing them, which also avoids seams between regions.
+
+Each pixel is mapped with a bilinear interpolation of the LUTs of the four
+nearest tile centers.  All arithmetic is done in integers on uint8 data and
+the work is split over a thread pool (numpy releases the GIL for the heavy
+operations).
+
+Zero-valued pixels are treated as background (fill value of the affine
+transform) and always map to zero.
+"""
+
+import os
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+NBINS = 256
+NUM_THREADS = os.cpu_count() or 1
+
+
+def clip_histogram(hist, clip_limit):
+    """Clip histogram at clip_limit and redistribute the excess over all bins.
+    """
+    hist = hist.astype(np.int64)
+    excess = int(np.maximum(hist - clip_limit, 0).sum())
+    hist = np.minimum(hist, clip_limit)
+
+    while excess > 0:
+        room = clip_limit - hist
+        candidates = np.flatnonzero(room > 0)
+        if len(candidates) == 0:
+            break
+        incr = excess // len(candidates)
+        if incr > 0:
+            add = np.minimum(room[candidates], incr)
+            hist[candidates] += add
+            excess -= int(add.sum())
+        else:
+            # spread the remainder evenly over bins that are not full
+            step = max(len(candidates) // excess, 1)
+            candidates = candidates[::step][:excess]
+            hist[candidates] += 1
+            excess -= len(candidates)
+    return hist
+
+
+def tile_lut(tile, clip_limit):
+    """Compute the uint8 equalization LUT for a single contextual tile.
+
+    Args:
+        tile (np.array): uint8 tile
+        clip_limit (float): normalized clip limit (fraction of tile pixels), 0 disables clipping
+    Returns:
+        np.array of 256 uint8 values
+    """
+    n_pixels = tile.size
+    hist = np.bincount(tile.ravel(), minlength=NBINS)
+    if clip_limit > 0:
+        hist = clip_histogram(hist, max(int(clip_limit * n_pixels), 1))
+    cdf = np.cumsum(hist)
+    lut = np.minimum((cdf * 255 + n_pixels // 2) // n_pixels, 255).astype(np.uint8)
+    lut[0] = 0 # background stays background
+    return lut
+
+
+def _map(fn, items, num_threads):
+    """Apply fn to all items in a thread pool (inline for a single thread).
+    """
+    if num_threads <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(fn, items))
+
+
+class SliceClahe:
+    """CLAHE over a full slice with LUTs cached by global tile index.
+
+    Regions are given in global slice coordinates.  The typical use is to
+    call add_region for every warped region as it becomes available and
+    then apply to the part of the region that is kept.  apply requires that
+    the LUTs for all tiles whose centers surround the requested region have
+    already been computed (i.e., the region passed to add_region must extend
+    by at least kernel_size beyond the area to be equalized, unless at the
+    slice border).
+
+    When the caller already parallelizes over regions, num_threads should be
+    set to 1.  The LUT cache itself is safe to share between threads.
+    """
+
+    def __init__(self, width, height, kernel_size=1024, clip_limit=0.02, num_threads=NUM_THREADS):
+        self.width = width
+        self.height = height
+        self.kernel_size = kernel_size
+        self.clip_limit = clip_limit
+        self.num_threads = num_threads
+        self.ntiles_x = ceil(width / kernel_size)
+        self.ntiles_y = ceil(height / kernel_size)
+        self.luts = {}
+
+    def _tile_extent(self, tx, ty):
+        k = self.kernel_size
+        return tx*k, ty*k, min((tx+1)*k, self.width), min((ty+1)*k, self.height)
+
+    def add_region(self, im, x0, y0):
+        """Compute LUTs for all tiles fully contained in the region.
+
+        Args:
+            im (np.array): uint8 image region
+            x0, y0 (int): global location of im[0, 0] (can be negative)
+        """
+        k = self.kernel_size
+        h, w = im.shape
+        missing = []
+        for ty in range(max(0, y0 // k), min(self.ntiles_y, ceil((y0 + h) / k))):
+            for tx in range(max(0, x0 // k), min(self.ntiles_x, ceil((x0 + w) / k))):
+                if (tx, ty) in self.luts:
+                    continue
+                xs, ys, xe, ye = self._tile_extent(tx, ty)
+                if xs >= x0 and ys >= y0 and xe <= (x0 + w) and ye <= (y0 + h):
+                    missing.append((tx, ty))
+
+        def compute(tile_id):
+            xs, ys, xe, ye = self._tile_extent(*tile_id)
+            return tile_id, tile_lut(im[(ys-y0):(ye-y0), (xs-x0):(xe-x0)], self.clip_limit)
+
+        for tile_id, lut in _map(compute, missing, self.num_threads):
+            self.luts[tile_id] = lut
+
+    def _neighbors(self, start, finish, ntiles):
+        """Split [start, finish) into runs sharing the same pair of tile centers.
+
+        Returns list of (run start, run finish, tile0, tile1, weight offset), where
+        the weight of tile1 for pixel p is p - weight offset (0 if tile0 == tile1).
+        """
+        k = self.kernel_size
+        half = k // 2
+        runs = []
+        pos = start
+        while pos < finish:
+            t0 = (pos - half) // k
+            if t0 < 0:
+                run_end = min(finish, half)
+                runs.append((pos, run_end, 0, 0, pos))
+            elif t0 >= ntiles - 1:
+                run_end = finish
+                runs.append((pos, run_end, ntiles-1, ntiles-1, pos))
+            else:
+                run_end = min(finish, (t0+1)*k + half)
+                runs.append((pos, run_end, t0, t0+1, t0*k + half))
+            pos = run_end
+        return runs
+
+    def apply(self, im, x0, y0, bbox=None, out=None):
+        """Equalize (part of) a region using the cached LUTs.
+
+        Args:
+            im (np.array): uint8 image region
+            x0, y0 (int): global location of im[0, 0]
+            bbox (tuple): (xstart, ystart, xend, yend) in im coordinates to equalize (default: all of im)
+            out (np.array): optional uint8 destination with the same shape as im (can be im)
+        Returns:
+            out (pixels outside of bbox are left untouched)
+        """
+        k = self.kernel_size
+        h, w = im.shape
+        if out is None:
+            out = np.zeros_like(im)
+        if bbox is None:
+            bbox = (0, 0, w, h)
+        xstart, ystart, xend, yend = bbox
+
+        # restrict to the slice extent (everything else is padding)
+        gx0 = max(x0 + xstart, 0)
+        gy0 = max(y0 + ystart, 0)
+        gx1 = min(x0 + xend, self.width)
+        gy1 = min(y0 + yend, self.height)
+        if gx0 >= gx1 or gy0 >= gy1:
+            return out
+
+        xruns = self._neighbors(gx0, gx1, self.ntiles_x)
+        yruns = self._neighbors(gy0, gy1, self.ntiles_y)
+        norm = k * k
+
+        def interpolate(cell):
+            (ys, ye, ty0, ty1, yoff), (xs, xe, tx0, tx1, xoff) = cell
+            try:
+                lut00 = self.luts[(tx0, ty0)]
+                lut01 = self.luts[(tx1, ty0)]
+                lut10 = self.luts[(tx0, ty1)]
+                lut11 = self.luts[(tx1, ty1)]
+            except KeyError as e:
+                raise RuntimeError(f"CLAHE tile {e} has not been computed") from None
+
+            block = im[(ys-y0):(ye-y0), (xs-x0):(xe-x0)]
+            wx = np.arange(xs, xe, dtype=np.uint32) - np.uint32(xoff) if tx0 != tx1 else np.zeros(xe-xs, dtype=np.uint32)
+            wy = np.arange(ys, ye, dtype=np.uint32) - np.uint32(yoff) if ty0 != ty1 else np.zeros(ye-ys, dtype=np.uint32)
+            wy = wy[:, None]
+
+            top = lut00[block].astype(np.uint32)
+            top *= (k - wx)
+            top += lut01[block].astype(np.uint32) * wx
+            top *= (k - wy)
+            bottom = lut10[block].astype(np.uint32)
+            bottom *= (k - wx)
+            bottom += lut11[block].astype(np.uint32) * wx
+            bottom *= wy
+            top += bottom
+            top += norm // 2
+            top //= norm
+            out[(ys-y0):(ye-y0), (xs-x0):(xe-x0)] = top
+
+        cells = [(yrun, xrun) for yrun in yruns for xrun in xruns]
+        _map(interpolate, cells, self.num_threads)
+        return out
+
+    def equalize(self, im):
+        """Equalize a full slice held in memory.
+        """
+        self.add_region(im, 0, 0)
+        return self.apply(im, 0, 0)
@@ -0,0 +1,65 @@
+"""Process-wide clients for cloud storage and tensorstore.
+
+Creating a storage.Client (and its authorized HTTP session) per request,
+or per fetched slice, costs a credential lookup and a new TLS connection
+every time.  The clients here are created once per process and reused
+across requests on a warm instance.  The HTTP connection pool is sized
+for the largest number of threads that issue requests at once (the
+ngshard fetch threads plus the upload threads).
+"""
+
+import threading
+
+from google.cloud import storage
+import tensorstore as ts
+from requests.adapters import HTTPAdapter
+
+# connections kept alive per host
+POOL_SIZE = 32
+
+_lock = threading.Lock()
+_storage_client = None
+_ts_contexts = {}
+
+
+def storage_client():
+    """Shared storage.Client with a keep-alive connection pool of POOL_SIZE.
+    """
+    global _storage_client
+    with _lock:
+        if _storage_client is None:
+            client = storage.Client()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            client._http.mount("https://", adapter)
+            _storage_client = client
+        return _storage_client
+
+
+def ts_context(data_copy_concurrency=0, gcs_concurrency=0, cache_bytes=0):
+    """Shared tensorstore context (GCS connections and request limits are reused by all handles).
+
+    Contexts with other limits (0 keeps the default) are created once per
+    combination as children of the default context, so they still share
+    its other resources (e.g., the in-memory kvstore).
+
+    Args:
+        data_copy_concurrency (int): threads used to encode and decode chunks (default: number of cores)
+        gcs_concurrency (int): concurrent GCS requests (default: POOL_SIZE)
+        cache_bytes (int): size of the chunk cache (default: no cache)
+    """
+    key = (data_copy_concurrency, gcs_concurrency, cache_bytes)
+    with _lock:
+        if () not in _ts_contexts:
+            _ts_contexts[()] = ts.Context({"gcs_request_concurrency": {"limit": POOL_SIZE}})
+        if key == (0, 0, 0):
+            return _ts_contexts[()]
+        if key not in _ts_contexts:
+            spec = {}
+            if data_copy_concurrency > 0:
+                spec["data_copy_concurrency"] = {"limit": data_copy_concurrency}
+            if gcs_concurrency > 0:
+                spec["gcs_request_concurrency"] = {"limit": gcs_concurrency}
+            if cache_bytes > 0:
+                spec["cache_pool"] = {"total_bytes_limit": cache_bytes}
+            _ts_contexts[key] = ts.Context(spec, parent=_ts_contexts[()])
+        return _ts_contexts[key]
@@ -0,0 +1,146 @@
+"""2x2x2 downsampling kernels used to build the scale pyramids.
+
+Every voxel of a dataset is downsampled once per scale, so the kernels
+avoid floating point entirely: 2x2x2 blocks are reduced by combining
+strided views of even and odd planes one dimension at a time, with an
+integer accumulator for sums (uint16 for uint8 data).  This is an order
+of magnitude faster than reducing a 6D reshape over three axes.  Volumes
+are split into blocks of z pairs that are reduced in parallel (numpy
+releases the GIL in the element-wise loops).
+
+Reductions:
+
+* mean: average truncated to an integer (same as the float mean cast back to the data type)
+* mode: most frequent value of the block (for label volumes, ties pick the smallest value)
+* min, max: smallest or largest value of the block
+
+An optional Gaussian prefilter (sigma in voxels, mean only) reduces
+aliasing at the cost of a float32 pass over each block.
+
+Volumes are indexed (z, y, x) and odd dimensions drop their last plane
+(as with cropping the padded result).
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+MODES = ("mean", "mode", "min", "max")
+
+# input bytes reduced per block (blocks hold whole z pairs)
+BLOCK_BYTES = 32*1024*1024
+
+NUM_THREADS = os.cpu_count() or 1
+
+# accumulator for the sum of 8 values
+_ACCUMULATORS = {np.dtype(np.uint8): np.uint16, np.dtype(np.uint16): np.uint32}
+
+
+def check_mode(mode):
+    if mode not in MODES:
+        raise RuntimeError(f"unknown downsample mode {mode}")
+
+
+def _pairs(vol):
+    # even planes and odd planes along each dimension (strided views, odd planes dropped)
+    z, y, x = vol.shape
+    return vol[:(z//2*2), :(y//2*2), :(x//2*2)]
+
+
+def _reduce_pairs(vol, combine, first):
+    # combine z pairs, then y pairs, then x pairs (each step halves the data)
+    vol = _pairs(vol)
+    result = first(vol[0::2], vol[1::2])
+    result = combine(result[:, 0::2], result[:, 1::2])
+    return combine(result[:, :, 0::2], result[:, :, 1::2])
+
+
+def _mean(vol, out):
+    accumulator = _ACCUMULATORS.get(vol.dtype)
+    if accumulator is None:
+        raise RuntimeError(f"mean downsampling is not supported for {vol.dtype}")
+    sums = _reduce_pairs(vol, np.add, lambda even, odd: np.add(even, odd, dtype=accumulator))
+    np.right_shift(sums, 3, out=sums)
+    out[...] = sums
+
+
+def _min(vol, out):
+    out[...] = _reduce_pairs(vol, np.minimum, np.minimum)
+
+
+def _max(vol, out):
+    out[...] = _reduce_pairs(vol, np.maximum, np.maximum)
+
+
+def _mode(vol, out):
+    # the 8 values of each block as strided views
+    vol = _pairs(vol)
+    values = [vol[dz::2, dy::2, dx::2] for dz in (0, 1) for dy in (0, 1) for dx in (0, 1)]
+
+    # occurrences of each value within its block
+    counts = [np.ones(out.shape, dtype=np.uint8) for _ in values]
+    for j in range(len(values)):
+        for k in range(j+1, len(values)):
+            equal = values[j] == values[k]
+            counts[j] += equal
+            counts[k] += equal
+
+    # most frequent value (the smallest value among ties)
+    best_count = counts[0]
+    out[...] = values[0]
+    for value, count in zip(values[1:], counts[1:]):
+        better = (count > best_count) | ((count == best_count) & (value < out))
+        np.copyto(out, value, where=better)
+        np.maximum(best_count, count, out=best_count)
+
+
+_KERNELS = {"mean": _mean, "mode": _mode, "min": _min, "max": _max}
+
+
+def downsample(vol, mode="mean", sigma=0, num_threads=NUM_THREADS):
+    """Downsample a (z, y, x) volume by 2 in every dimension.
+
+    Args:
+        vol (numpy array): integer volume (mean requires uint8 or uint16)
+        mode (str): reduction (see MODES)
+        sigma (float): standard deviation of a Gaussian prefilter (0 disables; mean only)
+        num_threads (int): blocks reduced at once
+    Returns:
+        numpy array with the dtype of vol
+    """
+    check_mode(mode)
+    if sigma > 0 and mode != "mean":
+        raise RuntimeError("the Gaussian prefilter is only supported for mean downsampling")
+
+    z, y, x = vol.shape
+    out = np.empty((z//2, y//2, x//2), dtype=vol.dtype)
+    if out.size == 0:
+        return out
+
+    kernel = _KERNELS[mode]
+    block_pairs = max(1, BLOCK_BYTES // (2*y*x*vol.itemsize))
+    # planes on each side of a block that affect the prefilter (scipy truncates at 4 sigma)
+    halo = int(4*sigma + 0.5) if sigma > 0 else 0
+
+    def reduce_block(pair_start):
+        pair_end = min(pair_start + block_pairs, z//2)
+        if halo == 0:
+            kernel(vol[(pair_start*2):(pair_end*2)], out[pair_start:pair_end])
+            return
+        zstart = max(pair_start*2 - halo, 0)
+        zfinish = min(pair_end*2 + halo, z)
+        smoothed = gaussian_filter(vol[zstart:zfinish].astype(np.float32), sigma, mode="nearest")
+        np.clip(np.rint(smoothed, out=smoothed), 0, np.iinfo(vol.dtype).max, out=smoothed)
+        offset = pair_start*2 - zstart
+        kernel(smoothed[offset:(offset + (pair_end-pair_start)*2)].astype(vol.dtype), out[pair_start:pair_end])
+
+    starts = range(0, z//2, block_pairs)
+    if num_threads <= 1 or len(starts) == 1:
+        for pair_start in starts:
+            reduce_block(pair_start)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(reduce_block, starts))
+    return out
@@ -7,24 +7,34 @@ from flask import Flask, Response, request, make_response, abort
 from flask_cors import CORS
 import json
 import logging
+import zlib
 import pwd
 from PIL import Image
-from google.cloud import storage
 import numpy as np
 import tensorstore as ts
 from math import ceil
 from scipy import ndimage
 import io
 import traceback
-import threading
-from skimage import exposure
+from concurrent.futures import ThreadPoolExecutor
 import gc
-import gzip
-from skimage.transform import downscale_local_mean
-from scipy.ndimage import gaussian_filter
+import threading
+from collections import OrderedDict
 
-import time
 import psutil
+
+from clahe import SliceClahe
+from warp import AffineWarp
+from sourcestore import ChunkedSource, write_source
+import tilecodec
+import tilecontainer
+import manifest
+import transfers
+from slabpyramid import SlabPyramid, RawChunkStream, SHARD_DEPTH, RAW_CHUNK_SIZE, RAW_CODECS
+from downsample import check_mode, downsample
+from shardplan import plan_sharding, shard_extent, validate, BYTES_PER_VOXEL, TARGET_SHARD_CHUNKS, TARGET_SHARD_BYTES
+import clients
+from objectstore import open_store
 from datetime import datetime
 def profile(tag):
     mem = str(psutil.virtual_memory())
@@ -40,11 +50,304 @@ CORS(app)
 logger = logging.getLogger(__name__)
 
 MAX_IMAGE_SIZE = 4096
-MAX_SUPERIMAGE_SIZE = 12288
-OVERLAP_SIZE = 512
+CLAHE_KERNEL_SIZE = 1024
+
+# largest estimated memory for the tile rows, thumbnails, and source caches of
+# the slices of a brick (see alignedslices), out of the 2GB of an instance
+BRICK_MEMORY_BYTES = 1536*1024*1024
+
+# slices of a brick encoded at once (the chunks of one are read while the other is encoded)
+BRICK_SLICE_THREADS = 2
+
+# decoded source chunks kept for each slice of a brick (the chunks shared by neighboring tiles)
+BRICK_SOURCE_CACHE_BYTES = 8*1024*1024
+
+DEFAULT_JPEG_QUALITY = 75 # tensorstore default
+
+# layouts of the raw pyramid (sharded uses the shards of the jpeg pyramid for
+# the first RAW_SHARDED_SCALES scales, the scales above are always unsharded)
+RAW_LAYOUTS = ("unsharded", "sharded")
+RAW_SHARDED_SCALES = 3
+NUM_SCALES = 6
+
+# scales above the NUM_SCALES built within each cube are reduced across cubes
+# by ngreduce (COARSE_CHUNK_SIZE chunks, sharded like the other scales) until
+# the volume fits in one chunk; each request reads a block of REDUCE_BLOCK_SIZE^3
+# voxels of its source scale and writes the next REDUCE_LEVELS scales (down to
+# one chunk per block)
+COARSE_CHUNK_SIZE = 64
+REDUCE_BLOCK_SIZE = 512
+REDUCE_LEVELS = 3
+
+# neuroglancer scales opened by ngshard are reused by later requests
+MAX_OPEN_SCALES = 64
+_open_scales = OrderedDict()
+_open_scales_lock = threading.Lock()
+
+def _check_raw_options(layout, num_scales, codec, level):
+    if layout not in RAW_LAYOUTS:
+        raise RuntimeError(f"unknown raw layout {layout}")
+    if num_scales < 1 or num_scales > NUM_SCALES:
+        raise RuntimeError(f"raw scales must be between 1 and {NUM_SCALES}")
+    if codec not in RAW_CODECS:
+        raise RuntimeError(f"unknown raw codec {codec}")
+    if level < 0 or level > 9:
+        raise RuntimeError("raw compression level must be between 0 and 9")
+
+def _check_geometry(store, name, config):
+    """Raise if the scales of config do not match the existing info (the chunks written by earlier runs would be misplaced).
+    """
+    def geometry(info):
+        return [(scale["key"], scale["size"], scale["chunk_sizes"], scale.get("sharding")) for scale in info["scales"]]
+    if geometry(json.loads(store.read(name))) != geometry(config):
+        raise RuntimeError(f"{name} does not match the volume of the earlier run (the slices must fit its size, see reserve-maxz)")
+
+def _info_version(info_bytes):
+    """Version of an info file given to _ng_scale (changes when ngmeta rewrites the info).
+    """
+    return zlib.crc32(info_bytes)
+
+def _ng_scale(bucket_name, format, level, context_limits=(0, 0, 0), version=0):
+    """tensorstore handle for scale level of bucket/neuroglancer/format (channel 0).
+
+    Handles are cached per process by (bucket, format, scale), the context
+    limits (see clients.ts_context), and the version of the info read by
+    the request (see _info_version).  Incremental runs write into the
+    buckets of their base run, and ngmeta may rewrite the info there
+    (e.g., the jpeg quality), so a warm instance opens a new handle once
+    the info changes.  They also rewrite chunks, so cached chunks (with
+    ts-cache-bytes) are revalidated on every read.
+    """
+    key = (bucket_name, format, level, context_limits, version)
+    with _open_scales_lock:
+        if key in _open_scales:
+            _open_scales.move_to_end(key)
+            return _open_scales[key]
+
+    dataset = ts.open({
+        'driver': 'neuroglancer_precomputed',
+        'kvstore': open_store(bucket_name).kvstore(),
+        'path': f"neuroglancer/{format}",
+        'recheck_cached_data': True,
+        'scale_index': level
+    }, context=clients.ts_context(*context_limits)).result()
+    dataset = dataset[ts.d['channel'][0]]
+
+    with _open_scales_lock:
+        _open_scales[key] = dataset
+        while len(_open_scales) > MAX_OPEN_SCALES:
+            _open_scales.popitem(last=False)
+    return dataset
+
+@app.route('/ingestslice', methods=["POST"])
+def ingestslice():
+    """Convert the raw image bucket/image into a chunked source in ingest-bucket/source/image.
+    """
+    try:
+        config_file  = request.get_json()
+        name = config_file["img"]
+        bucket_name = config_file["dest"] # contains source
+        bucket_name_ingest = config_file["ingest-bucket"] # destination for chunked source
+
+        # read file
+        pre_image_bin = open_store(bucket_name).read(name)
+        curr_im = Image.open(io.BytesIO(pre_image_bin))
+        curr_im.load()
+        del pre_image_bin
+
+        write_source(np.asarray(curr_im), open_store(bucket_name_ingest), "source/" + name)
+
+        r = make_response("success".encode())
+        r.headers.set('Content-Type', 'text/html')
+        return r
+    except Exception as e:
+        return Response(str(e), 400)
+
+def _read_source(bucket_name, name, bucket_name_ingest, image_bin=None):
+    """Source image of a slice for AffineWarp.
+
+    Args:
+        bucket_name (str): location of the raw image
+        name (str): name of the raw image
+        bucket_name_ingest (str): location of the chunked source written by ingestslice ("" to use the raw image)
+        image_bin (bytes): raw image if already downloaded
+    """
+    if bucket_name_ingest != "":
+        # only the chunks under each tile's footprint are fetched
+        return ChunkedSource(open_store(bucket_name_ingest), "source/" + name)
+
+    # read file
+    if image_bin is None:
+        image_bin = open_store(bucket_name).read(name)
+    curr_im = Image.open(io.BytesIO(image_bin))
+    curr_im.load() # decode once before tiles are rendered in parallel
+    del image_bin
+    # pure translations are served from the array without resampling
+    return np.asarray(curr_im)
+
+def _upload_job(store, name, data):
+    """Transfer (see transfers.py) that writes data to name in store.
+    """
+    return f"write {name}", lambda: store.write(name, data)
+
+class _SliceAligner:
+    """Render, normalize, and encode a slice one band of tile rows at a time.
+
+    The CLAHE LUTs and the thumbnail are kept for the whole slice, so the
+    bands can be encoded in separate calls, each with its own source (see
+    alignedslices).
+
+    Args:
+        config_file (dict): alignedslice configuration (options shared by all slices)
+        name (str): name of the raw image (used for the thumbnail)
+        affine_trans (list): affine transform of the slice
+        band_rows (int): tile rows in each band (default: the rows of a MAX_IMAGE_SIZE image)
+    """
+
+    def __init__(self, config_file, name, affine_trans, band_rows=None):
+        self.name = name
+        self.affine_trans = affine_trans
+        self.clip_limit = config_file.get("clip-limit", 0.02)
+        self.bucket_name = config_file["dest"] # contains source
+        self.run_id = config_file["run_id"] # contains id for job run for caching thumbnails
+        [self.width, self.height]  = json.loads(config_file["bbox"])
+        self.shard_size  = config_file["shard-size"]
+        self.tile_codec = config_file.get("tile-codec", tilecodec.DEFAULT_CODEC) # codec for temporary tiles
+        self.tile_codec_level = config_file.get("tile-codec-level") # None for codec default
+        tilecodec.check_codec(self.tile_codec)
+
+        # small thumbnail of the aligned slice (mostly for debugging or quick viewing
+        # in something like fiji) is block-averaged from the normalized tiles
+        # (sync: written after the tiles, async: written while the last tiles upload, off: not written)
+        self.thumbnail_mode = config_file.get("thumbnail", "sync")
+        if self.thumbnail_mode not in ("sync", "async", "off"):
+            raise RuntimeError(f"unknown thumbnail mode {self.thumbnail_mode}")
+        TARGET_SIZE = 4096
+        max_dim = max(self.width, self.height)
+        self.factor = 1
+        while max_dim > TARGET_SIZE:
+            max_dim = max_dim // 2
+            self.factor *= 2
+        self.thumbnail = None
+        if self.thumbnail_mode != "off":
+            if (self.shard_size % self.factor) != 0:
+                raise RuntimeError(f"shard size must be a multiple of the thumbnail factor {self.factor}")
+            self.thumbnail = np.zeros((self.height//self.factor, self.width//self.factor), dtype=np.uint8)
+
+        # Each tile is rendered directly from the source region it maps to.
+        # Only the tile rows of the current band (plus one row of look-ahead
+        # for the CLAHE tiles below the band) are kept in memory.
+        if self.clip_limit > 0 and (self.shard_size % CLAHE_KERNEL_SIZE) != 0:
+            raise RuntimeError(f"shard size must be a multiple of {CLAHE_KERNEL_SIZE}")
+
+        # LUTs are shared by all tiles of the slice (threading is done per tile)
+        self.slice_clahe = SliceClahe(self.width, self.height, CLAHE_KERNEL_SIZE, self.clip_limit, num_threads=1)
+
+        self.ntiles_x = ceil(self.width / self.shard_size)
+        self.ntiles_y = ceil(self.height / self.shard_size)
+        self.band_rows = band_rows if band_rows is not None else MAX_IMAGE_SIZE // self.shard_size
+        self.lookahead = 1 if self.clip_limit > 0 else 0
+        self.tiles = {}
+
+    def bands(self):
+        """[band_y, band_end) tile rows of every band.
+        """
+        return [(band_y, min(band_y + self.band_rows, self.ntiles_y)) for band_y in range(0, self.ntiles_y, self.band_rows)]
+
+    def encode_band(self, executor, source, band_y, band_end):
+        """Encoded tiles of a band (maps (tx, ty) to the encoded tile, None if empty).
+
+        The look-ahead row is kept for the next band.
+
+        Args:
+            executor (ThreadPoolExecutor): renders and encodes the tiles
+            source: source image (see _read_source)
+            band_y, band_end (int): tile rows of the band (bands must be encoded in order)
+        """
+        shard_size = self.shard_size
+        warper = AffineWarp(source, self.affine_trans)
+
+        def render_tile(tile_id):
+            tx, ty = tile_id
+            tile = warper.render(tx*shard_size, ty*shard_size, shard_size, shard_size)
+            if self.clip_limit > 0:
+                self.slice_clahe.add_region(tile, tx*shard_size, ty*shard_size)
+            return tile_id, tile
+
+        def encode_tile(tile_id):
+            tx, ty = tile_id
+            tile = self.tiles[tile_id]
+            if self.clip_limit > 0:
+                tile = self.slice_clahe.apply(tile, tx*shard_size, ty*shard_size)
+            if self.thumbnail is not None:
+                # block average into the thumbnail (clipped to the slice extent)
+                factor = self.factor
+                small_size = shard_size // factor
+                small = tile.reshape(small_size, factor, small_size, factor).sum(axis=(1, 3), dtype=np.uint32)
+                small = ((small + (factor*factor)//2) // (factor*factor)).astype(np.uint8)
+                ys, xs = ty*small_size, tx*small_size
+                small = small[:max(self.thumbnail.shape[0]-ys, 0), :max(self.thumbnail.shape[1]-xs, 0)]
+                self.thumbnail[ys:(ys+small.shape[0]), xs:(xs+small.shape[1])] = small
+            # all-zero tiles (outside of the aligned image) are only flagged
+            if not tile.any():
+                return tile_id, None
+            return tile_id, tilecodec.encode(tile, self.tile_codec, self.tile_codec_level)
+
+        # render tiles that are not already available from the previous band
+        needed = [(tx, ty) for ty in range(band_y, min(band_end + self.lookahead, self.ntiles_y))
+                for tx in range(self.ntiles_x) if (tx, ty) not in self.tiles]
+        for tile_id, tile in executor.map(render_tile, needed):
+            self.tiles[tile_id] = tile
+
+        band = [(tx, ty) for ty in range(band_y, band_end) for tx in range(self.ntiles_x)]
+        encoded = dict(executor.map(encode_tile, band))
+        for tile_id in band:
+            del self.tiles[tile_id]
+        return encoded
+
+    def write_thumbnail(self):
+        with io.BytesIO() as output:
+            Image.fromarray(self.thumbnail).save(output, format="PNG")
+            open_store(self.bucket_name + "_process").write(self.run_id + "/align/" + self.name, output.getvalue(), content_type="image/png")
+
+def _align_slice(config_file, name, affine_trans, source, write_band):
+    """Render, normalize, and encode a slice one band of tile rows at a time.
+
+    Args:
+        config_file (dict): alignedslice configuration (options shared by all slices)
+        name (str): name of the raw image (used for the thumbnail)
+        affine_trans (list): affine transform of the slice
+        source: source image (see _read_source)
+        write_band (callable): called with (executor, band_y, band_end, encoded) for every band,
+            where encoded maps (tx, ty) to the encoded tile (None if empty); returns a list of
+            futures that must complete before the next band is written
+    """
+    aligner = _SliceAligner(config_file, name, affine_trans)
+
+    ####### Render, normalize, and write one band of images at a time #######
+
+    NUM_THREADS = 4
+    with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
+        uploads = []
+        for band_y, band_end in aligner.bands():
+            encoded = aligner.encode_band(executor, source, band_y, band_end)
+
+            # limit buffered output to one band
+            for upload in uploads:
+                upload.result()
+
+            uploads = write_band(executor, band_y, band_end, encoded)
+            del encoded
+            gc.collect()
 
-# modify clahe to return re-scaled 16 bit image
-#exposure._adapthist.img_as_float = lambda x: x
+        # thumbnail is complete once the last band has been encoded
+        if aligner.thumbnail_mode == "async":
+            uploads.append(executor.submit(aligner.write_thumbnail))
+        for upload in uploads:
+            upload.result()
+
+    if aligner.thumbnail_mode == "sync":
+        aligner.write_thumbnail()
 
 @app.route('/alignedslice', methods=["POST"])
 def alignedslice():
@@ -53,281 +356,183 @@ def alignedslice():
     """
     try:
         config_file  = request.get_json()
-        clip_limit = config_file.get("clip-limit", 0.02)
-
-        def clahe(im, pad_x0, pad_x1, pad_y0, pad_y1, glb_min, glb_max, is_xstart=True, is_ystart=True, is_xend=True, is_yend=True):
-            im = np.array(im)
-            gc.collect()
-
-            # tile size
-            CLAHE_SIZE = 3072
-            h, w = im.shape
-            target = np.zeros_like(im)
-
-            for y in range(pad_y0, h-pad_y1, CLAHE_SIZE):
-                for x in range(pad_x0, w-pad_x1, CLAHE_SIZE):
-                    ystart = max(0, y-OVERLAP_SIZE)
-                    xstart = max(0, x-OVERLAP_SIZE)
-
-                    # spread out 0 first over range
-                    im_sub = im[ystart:(y+CLAHE_SIZE+OVERLAP_SIZE), xstart:(x+CLAHE_SIZE+OVERLAP_SIZE)]
-            
-                    # if all 0 skip
-                    if len(im_sub[im_sub != 0]) == 0:
-                        continue
-
-                    # make sure range is the same for all images
-                    if ystart  > 0 or xstart > 0:
-                        im_sub[0, 0] = glb_min
-                        im_sub[1, 0] = glb_max
-                    elif ((y + CLAHE_SIZE + OVERLAP_SIZE) < h) or ((x + CLAHE_SIZE + OVERLAP_SIZE) < w):
-                        im_sub[-1, -1] = glb_min
-                        im_sub[-1, -2] = glb_max
-
-                    """Erase 0s from iamge
-                    min_val = im_sub[im_sub != 0].min()
-                    max_val = im_sub.max()
-                    
-                    # create a random matrix between min and max to spread out values
-                    im_sub = np.random.randint(min_val, max_val + 1, im_sub.shape, np.uint8)
-                    im_sub[ im[ystart:(y+CLAHE_SIZE+OVERLAP_SIZE), xstart:(x+CLAHE_SIZE+OVERLAP_SIZE)] != 0 ] = 0
-                    im_sub = im_sub + im[ystart:(y+CLAHE_SIZE+OVERLAP_SIZE), xstart:(x+CLAHE_SIZE+OVERLAP_SIZE)] 
-                    """
-
-                    # use modified image to run clahe
-                    #im_sub = gaussian_filter(im_sub, sigma=1)
-                    im_sub = (exposure.equalize_adapthist(im_sub, kernel_size = 1024, clip_limit=clip_limit)*255).astype(np.uint8)
-                    
-                    # reset zeros
-                    im_sub[ im[ystart:(y+CLAHE_SIZE+OVERLAP_SIZE), xstart:(x+CLAHE_SIZE+OVERLAP_SIZE)] == 0 ] = 0
-
-                    #ys, xs = im_sub.shape
-                    #target[ystart:(ystart+ys), xstart:(xstart+xs)] = im_sub
-
-                    t_ystart = y
-                    t_xstart = x
-                    t_yend = y+CLAHE_SIZE
-                    t_xend = x+CLAHE_SIZE
-                    if ystart == 0 and is_ystart:
-                        t_ystart = 0
-                    if xstart == 0 and is_xstart:
-                        t_xstart = 0
-
-                    if t_yend >= (h - OVERLAP_SIZE) and is_yend:
-                        t_yend = h
-                    if t_xend >= (w - OVERLAP_SIZE) and is_xend:
-                        t_xend = w
-
-                    target[t_ystart:t_yend, t_xstart:t_xend] = im_sub[(t_ystart-ystart):((t_ystart-ystart)+(t_yend-t_ystart)), (t_xstart-xstart):((t_xstart-xstart)+(t_xend-t_xstart))]
-
-
-            im = Image.fromarray(target)
-            del target
-            gc.collect()
-            return im
 
         name = config_file["img"] 
         bucket_name = config_file["dest"] # contains source
-        run_id = config_file["run_id"] # contains id for job run for caching thumbnails
-
         bucket_name_temp = config_file["dest-tmp"] # destination for tiles
         affine_trans = json.loads(config_file["transform"])
         [width, height]  = json.loads(config_file["bbox"])
         slicenum  = config_file["slice"]
         shard_size  = config_file["shard-size"]
+        tile_codec = config_file.get("tile-codec", tilecodec.DEFAULT_CODEC) # codec for temporary tiles
+        bucket_name_ingest = config_file.get("ingest-bucket", "") # chunked source written by ingestslice
+
+        source = _read_source(bucket_name, name, bucket_name_ingest)
+
+        ntiles_x = ceil(width / shard_size)
+        ntiles_y = ceil(height / shard_size)
+        tiles_per_image = MAX_IMAGE_SIZE // shard_size
+
+        # index entries of all tiles for the slice manifest
+        entries = {}
+
+        store_temp = open_store(bucket_name_temp)
+        def pack_image(columns, tile_ids, tile_bytes):
+            # pack binary
+            container = tilecontainer.ContainerWriter(width, height, shard_size, columns)
+            for data in tile_bytes:
+                container.add(data, tile_codec, (shard_size, shard_size), empty=(data is None))
+            container_entries = container.entries()
+            entries.update(zip(tile_ids, container_entries))
+            return container.tobytes(container_entries)
+
+        def write_band(executor, band_y, band_end, encoded):
+            # write band into images of MAX_IMAGE_SIZE (group together to reduce IO)
+            uploads = []
+            for band_x in range(0, ntiles_x, tiles_per_image):
+                columns = min(band_x + tiles_per_image, ntiles_x) - band_x
+                tile_ids = [(tx, ty) for ty in range(band_y, band_end) for tx in range(band_x, band_x + columns)]
+                data = pack_image(columns, tile_ids, [encoded[tile_id] for tile_id in tile_ids])
+                description, job = _upload_job(store_temp, f"{slicenum}_{band_x // tiles_per_image}_{band_y // tiles_per_image}", data)
+                uploads.append(transfers.engine().submit(job, description))
+            return uploads
+
+        _align_slice(config_file, name, affine_trans, source, write_band)
+
+        # publish the index once all containers of the slice are written
+        store_temp.write(manifest.fragment_name(slicenum), manifest.fragment_bytes(slicenum, ntiles_x, ntiles_y, entries))
 
-        # read file
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(name)
-        pre_image_bin = blob.download_as_string()
-        curr_im = Image.open(io.BytesIO(pre_image_bin))
-        del pre_image_bin
+        r = make_response("success".encode())
+        r.headers.set('Content-Type', 'text/html')
+        return r
+    except Exception as e:
+        return Response(str(e), 400)
 
+@app.route('/alignedslices', methods=["POST"])
+def alignedslices():
+    """Align a contiguous run of slices that belong to the same z brick and write
+    bucket_temp/brick_{z}_{x}_{y} containers with the brick-depth slices of each tile.
+
+    The slices are encoded one tile row at a time, and the bricks of a row
+    are written before the next row, so only one row of every slice (and
+    its CLAHE look-ahead row) is held in memory.  Each slice is read one
+    row at a time from the chunked sources written by ingestslice, and
+    BRICK_SLICE_THREADS slices are encoded at once so that the chunk reads
+    of one slice overlap the warping and encoding of another.
+    """
+    try:
+        config_file  = request.get_json()
 
-        GLB_MIN, GLB_MAX =  curr_im.getextrema()
-        GLB_MIN = 0 # always assume pressence of 0 pixel somewhere
-        GLB_MAX = 255 # stretch distribution for now
+        slices = config_file["slices"] # list of {"img", "slice", "transform"}
+        bucket_name = config_file["dest"] # contains source
+        bucket_name_temp = config_file["dest-tmp"] # destination for bricks
+        [width, height]  = json.loads(config_file["bbox"])
+        shard_size  = config_file["shard-size"]
+        brick_depth = config_file["brick-depth"]
+        tile_codec = config_file.get("tile-codec", tilecodec.DEFAULT_CODEC) # codec for temporary tiles
+        bucket_name_ingest = config_file.get("ingest-bucket", "") # chunked source written by ingestslice
+
+        if bucket_name_ingest == "":
+            raise RuntimeError("alignedslices requires the chunked sources written by ingestslice (ingest-bucket)")
+        zbrick = slices[0]["slice"] // brick_depth
+        for slice_config in slices:
+            if (slice_config["slice"] // brick_depth) != zbrick:
+                raise RuntimeError(f"slice {slice_config['slice']} is not in brick {zbrick}")
+
+        # one tile row per band
+        aligners = [_SliceAligner(config_file, slice_config["img"], json.loads(slice_config["transform"]), band_rows=1)
+                for slice_config in slices]
+
+        # for every slice: the encoded tiles of one row, the rendered look-ahead row,
+        # the thumbnail, and the source cache are held until the slices are done
+        ntiles_x = ceil(width / shard_size)
+        ntiles_y = ceil(height / shard_size)
+        row_bytes = ntiles_x*shard_size*shard_size
+        lookahead_bytes = row_bytes if aligners[0].lookahead else 0
+        thumbnail_bytes = aligners[0].thumbnail.nbytes if aligners[0].thumbnail is not None else 0
+        needed_bytes = len(slices) * (row_bytes + lookahead_bytes + thumbnail_bytes + BRICK_SOURCE_CACHE_BYTES)
+        if needed_bytes > BRICK_MEMORY_BYTES:
+            raise RuntimeError(f"a brick of {len(slices)} slices of width {width} needs about {needed_bytes} bytes (more than {BRICK_MEMORY_BYTES}), use a smaller brick depth")
+
+        # index entries of all tiles of each slice for the slice manifest
+        entries = {slice_config["slice"]: {} for slice_config in slices}
+
+        def pack_brick(tile_id, tiles):
+            # slices that were not provided (outside of the dataset) are empty
+            container = tilecontainer.ContainerWriter(width, height, shard_size, 1)
+            for data in tiles:
+                container.add(data, tile_codec, (shard_size, shard_size), empty=(data is None))
+            container_entries = container.entries()
+            for slicenum in entries:
+                entries[slicenum][tile_id] = container_entries[slicenum - zbrick*brick_depth]
+            return f"brick_{zbrick}_{tile_id[0]}_{tile_id[1]}", container.tobytes(container_entries)
+
+        # each source is opened once (with a small cache, since one is kept for every slice)
+        store_ingest = open_store(bucket_name_ingest)
+        sources = [ChunkedSource(store_ingest, "source/" + slice_config["img"], BRICK_SOURCE_CACHE_BYTES)
+                for slice_config in slices]
+
+        store_temp = open_store(bucket_name_temp)
+        NUM_THREADS = 4
+        with ThreadPoolExecutor(max_workers=NUM_THREADS) as executor, \
+                ThreadPoolExecutor(max_workers=BRICK_SLICE_THREADS) as slice_executor:
+            for band_y, band_end in aligners[0].bands():
+                # the slices share the tile threads (each slice is encoded by one slice thread)
+                rows = [slice_executor.submit(aligner.encode_band, executor, source, band_y, band_end)
+                        for aligner, source in zip(aligners, sources)]
+                bricks = {}
+                for slice_config, row in zip(slices, rows):
+                    for tile_id, data in row.result().items():
+                        bricks.setdefault(tile_id, [None]*brick_depth)[slice_config["slice"] - zbrick*brick_depth] = data
+                del rows
+
+                transfers.engine().run(_upload_job(store_temp, *pack_brick(tile_id, bricks.pop(tile_id)))
+                        for tile_id in list(bricks.keys()))
+                gc.collect()
+
+            # thumbnails are complete once the last row has been encoded
+            list(executor.map(lambda aligner: aligner.write_thumbnail(),
+                    [aligner for aligner in aligners if aligner.thumbnail is not None]))
+
+        # publish the indices once all bricks are written
+        transfers.engine().run(_upload_job(store_temp, manifest.fragment_name(slicenum),
+                manifest.fragment_bytes(slicenum, ntiles_x, ntiles_y, slice_entries)) for slicenum, slice_entries in entries.items())
 
-        # make small thumbnail for first tile or only tile
-        # (mostly for debugging or quick viewing in something like fiji)
-        bucket_thumb = storage_client.bucket(bucket_name + "_process")
-        blob = bucket_thumb.blob(run_id + "/align/" + name)
-        TARGET_SIZE = 4096
-        with io.BytesIO() as output:
-            max_dim = max(width, height)
-            factor = 1
-            while max_dim > TARGET_SIZE:
-                max_dim = max_dim // 2
-                factor *= 2
-            im_small = curr_im
-            if factor > 1:
-                im_small = curr_im.resize((width//factor, height//factor), resample=Image.BICUBIC)
-           
-            affine_mat = np.array([[affine_trans[0], affine_trans[2], affine_trans[4]//factor],
-            [affine_trans[1], affine_trans[3], affine_trans[5]//factor],
-            [0, 0, 1]])
-            mat_inv = np.linalg.inv(affine_mat)
-            im_small = im_small.transform((width//factor, height//factor), Image.AFFINE, data=mat_inv.flatten()[:6], resample=Image.BICUBIC, fillcolor=0)
-            
-        
-            # normalize image (even though potentially downsampled heavily)
-            
-            if clip_limit > 0:
-                im_small = clahe(im_small, 0, 0, 0, 0, GLB_MIN, GLB_MAX) 
-                #im_small = Image.fromarray((exposure.equalize_adapthist(np.array(im_small), kernel_size=1024)*255).astype(np.uint8))
-        
-            # write output to bucket
-            im_small.save(output, format="PNG")
-            blob.upload_from_string(output.getvalue(), content_type="image/png")
-        
-        ####### Iterate per super tile chunk #######
+        r = make_response("success".encode())
+        r.headers.set('Content-Type', 'text/html')
+        return r
+    except Exception as e:
+        return Response(str(e), 400)
 
-        #super_tile_chunk = config_file["super-tile-chunk"]
-        super_tile_chunks = []
-        
-        for itery in range(0, height, MAX_SUPERIMAGE_SIZE):
-            for iterx in range(0, width, MAX_SUPERIMAGE_SIZE):
-                super_tile_chunks.append([iterx//MAX_SUPERIMAGE_SIZE, itery//MAX_SUPERIMAGE_SIZE])
-        orig_width, orig_height = width, height
-        master_im = curr_im
-        orig_affine_trans = affine_trans.copy()
-
-        for super_tile_chunk in super_tile_chunks:
-            # modify width and heigh if tiled
-            startx = starty = trail_x = trail_y = 0
-            curr_im = master_im
-            width, height = orig_width, orig_height
-            affine_trans = orig_affine_trans.copy()
-
-            # new width and height
-            if width > (MAX_SUPERIMAGE_SIZE):
-                width = width - super_tile_chunk[0]*MAX_SUPERIMAGE_SIZE
-
-                # add buffer if needed
-                if width > MAX_SUPERIMAGE_SIZE:
-                    width = MAX_SUPERIMAGE_SIZE + OVERLAP_SIZE
-                    trail_x = OVERLAP_SIZE
-                
-                width += OVERLAP_SIZE
-                startx = OVERLAP_SIZE
-                affine_trans[4] -= (super_tile_chunk[0]*MAX_SUPERIMAGE_SIZE - OVERLAP_SIZE)
-
-                if width % shard_size != 0:
-                    leftover = (shard_size - (width % shard_size))
-                    width += leftover
-                    trail_x += leftover
-
-            if height > (MAX_SUPERIMAGE_SIZE):
-                height = height - super_tile_chunk[1]*MAX_SUPERIMAGE_SIZE
-
-                # add buffer if needed
-                if height > MAX_SUPERIMAGE_SIZE:
-                    height = MAX_SUPERIMAGE_SIZE + OVERLAP_SIZE 
-                    trail_y = OVERLAP_SIZE
-                
-                height += OVERLAP_SIZE
-                starty = OVERLAP_SIZE
-                affine_trans[5] -= (super_tile_chunk[1]*MAX_SUPERIMAGE_SIZE - OVERLAP_SIZE)
-                
-                if height % shard_size != 0:
-                    leftover = (shard_size - (height % shard_size))
-                    height += leftover
-                    trail_y += leftover
-
-            # modify affine to satisfy the pil transform interface
-            # (origin should be center -- not the case actually, row1 then row2, and use inverse affine
-            # since transform implements a pull transform and not a push transform).
-            # create affine matrix and invert
-            affine_mat = np.array([[affine_trans[0], affine_trans[2], affine_trans[4]],
-                    [affine_trans[1], affine_trans[3], affine_trans[5]],
-                    [0, 0, 1]])
-            mat_inv = np.linalg.inv(affine_mat)
-            curr_im = curr_im.transform((width, height), Image.AFFINE, data=mat_inv.flatten()[:6], resample=Image.BICUBIC, fillcolor=0)
-          
-            is_startx = is_starty = is_endx = is_endy = False
-            if super_tile_chunk[0] == 0:
-                is_startx = True
-            if super_tile_chunk[1] == 0:
-                is_starty = True
-            if super_tile_chunk[0] == super_tile_chunks[-1][0]:
-                is_endx = True
-            if super_tile_chunk[1] == super_tile_chunks[-1][1]:
-                is_endy = True
-
-
-            if clip_limit > 0:
-                curr_im = clahe(curr_im, startx, trail_x, starty, trail_y, GLB_MIN, GLB_MAX, is_startx, is_starty, is_endx, is_endy)
-                #curr_im = Image.fromarray((exposure.equalize_adapthist(np.array(curr_im), kernel_size=1024)//255).astype(np.uint8))
-
-            # ?? is result better with single thread, single clahe, single write
-            NUM_THREADS = 4
-            # write sub-image into tile chunks (group together to reduce IO)
-            # TODO: add overlap betwen tiles for CLAHE calculation
-            failure = None
-            def write_sub_image_tiles(thread_id):
-                nonlocal failure
-                try:
-                    # write temp png tiles
-                    job_id = -1
-                    
-                    for y in range(starty, (height - trail_y), MAX_IMAGE_SIZE):
-                        for x in range(startx, (width - trail_x), MAX_IMAGE_SIZE):
-                            # determine which thread gets the job
-                            job_id += 1
-                            if (job_id % NUM_THREADS) != thread_id:
-                                continue
-
-                            binary_volume = "".encode()
-                            sizes = []
-                            for chunky in range(y, min(y+MAX_IMAGE_SIZE, (height-trail_y)), shard_size):
-                                for chunkx in range(x, min(x+MAX_IMAGE_SIZE, (width-trail_x)), shard_size):
-                                    tile = np.array(curr_im.crop((chunkx-OVERLAP_SIZE, chunky-OVERLAP_SIZE, chunkx+shard_size+OVERLAP_SIZE, chunky+shard_size+OVERLAP_SIZE)))
-                                    #tile = (exposure.equalize_adapthist(tile, kernel_size=1024)*255).astype(np.uint8)
-                                    tile = tile[OVERLAP_SIZE:-OVERLAP_SIZE, OVERLAP_SIZE:-OVERLAP_SIZE]
-                                    tile_bytes_io = io.BytesIO()
-                                    # save as png
-                                    tile_im = Image.fromarray(tile)
-                                    tile_im.save(tile_bytes_io, format="PNG")
-                                    tile_bytes = tile_bytes_io.getvalue()
-
-                                    sizes.append(len(tile_bytes))
-                                    binary_volume += tile_bytes
-
-                            # pack binary
-                            final_binary = orig_width.to_bytes(8, byteorder="little")
-                            final_binary += orig_height.to_bytes(8, byteorder="little")
-                            final_binary += shard_size.to_bytes(8, byteorder="little")
-
-                            start_pos = 24 + (len(sizes)+1)*8
-                            final_binary += start_pos.to_bytes(8, byteorder="little")
-                            for val in sizes:
-                                start_pos += val
-                                final_binary += start_pos.to_bytes(8, byteorder="little")
-                            final_binary += binary_volume
-
-                            # file offset
-                            xoffset = x // MAX_IMAGE_SIZE
-                            yoffset = y // MAX_IMAGE_SIZE
-                            xoffset = (super_tile_chunk[0] * MAX_SUPERIMAGE_SIZE) // MAX_IMAGE_SIZE + xoffset 
-                            yoffset = (super_tile_chunk[1] * MAX_SUPERIMAGE_SIZE) // MAX_IMAGE_SIZE + yoffset 
-
-                            # write to cloud
-                            bucket_temp = storage_client.bucket(bucket_name_temp)
-                            blob = bucket_temp.blob(f"{slicenum}_{xoffset}_{yoffset}")
-                            blob.upload_from_string(final_binary, content_type="application/octet-stream")
-                except Exception as e:
-                    failure = e
-                    raise
-            # write superblocks to disk in chunks of MAX_IMAGE_SIZE
-            threads = [threading.Thread(target=write_sub_image_tiles, args=(thread_id,)) for thread_id in range(NUM_THREADS)]
-            for thread in threads:
-                thread.start()
-            for thread in threads:
-                thread.join()
-            #write_sub_image_tiles(0)
-            if failure is not None:
-                raise failure
+@app.route('/slicemanifest', methods=["POST"])
+def slicemanifest():
+    """Merge the index fragments of the slices in one shard-size z range
+    into source/manifest/{zcube} (see manifest.py).
+    """
+    try:
+        config_file  = request.get_json()
+        bucket_tiled_name = config_file["source"] # contains image tiles and index fragments
+        zcube = config_file["zcube"]
+        minz  = int(config_file["minz"])
+        maxz  = int(config_file["maxz"])
+        [width, height]  = json.loads(config_file["bbox"])
+        shard_size  = config_file["shard-size"]
+        brick_depth = config_file.get("brick-depth", 0)
+
+        zstart = max(shard_size*zcube, minz)
+        zfinish = min(maxz, shard_size*(zcube+1) - 1)
+        if zfinish < zstart:
+            raise RuntimeError(f"no slices in z cube {zcube}")
+
+        # every slice must have been written (raises if a fragment is missing)
+        store_temp = open_store(bucket_tiled_name)
+        with ThreadPoolExecutor(max_workers=clients.POOL_SIZE) as executor:
+            slices = list(range(zstart, zfinish+1))
+            fragments = dict(zip(slices, executor.map(lambda slice: store_temp.read(manifest.fragment_name(slice)), slices)))
+
+        data = manifest.manifest_bytes(zstart, len(slices), ceil(width / shard_size), ceil(height / shard_size),
+                shard_size, brick_depth, fragments)
+        store_temp.write(manifest.manifest_name(zcube), data)
 
         r = make_response("success".encode())
         r.headers.set('Content-Type', 'text/html')
@@ -351,20 +556,46 @@ def ngmeta():
         if shard_size != 1024:
             raise RuntimeError("shard size must be 1024x1024x1024")
         write_raw  = json.loads(config_file["writeRaw"].lower())
-
-        # write jpeg config to bucket/neuroglancer/jpeg/info
-        storage_client = storage.Client()
-        config = create_meta(width, height, minz, maxz, shard_size, False, res)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob("neuroglancer/jpeg/info")
-        blob.upload_from_string(json.dumps(config))
+        raw_layout = config_file.get("raw-layout", "unsharded")
+        raw_scales = int(config_file.get("raw-scales", 1))
+        raw_codec = config_file.get("raw-codec", "gzip")
+        _check_raw_options(raw_layout, raw_scales, raw_codec, 0)
+        update = json.loads(str(config_file.get("update", False)).lower()) # volume written by an earlier run
+        reserve_maxz = int(config_file.get("reserve-maxz", 0)) # size the volume for later appends
+        shard_chunks = int(config_file.get("shard-chunks", TARGET_SHARD_CHUNKS)) # largest number of chunks per shard
+        shard_bytes = int(config_file.get("shard-bytes", TARGET_SHARD_BYTES)) # largest estimated shard size
+        store = open_store(bucket_name)
+        size_maxz = max(maxz, reserve_maxz)
+        if update:
+            # the volume keeps its size (shard names depend on it)
+            size_maxz = max(size_maxz, json.loads(store.read("neuroglancer/jpeg/info"))["scales"][0]["size"][2] - 1)
+        # quality for all scales or a list with the quality of each scale (the last applies to the rest)
+        jpeg_quality = json.loads(str(config_file.get("jpeg-quality", DEFAULT_JPEG_QUALITY)))
+        if isinstance(jpeg_quality, int):
+            jpeg_quality = [jpeg_quality]
+        if len(jpeg_quality) == 0 or any(quality < 0 or quality > 100 for quality in jpeg_quality):
+            raise RuntimeError("jpeg quality must be between 0 and 100")
+
+        # write jpeg config to bucket/neuroglancer/jpeg/info (tensorstore encodes
+        # each scale with its jpeg_quality, neuroglancer ignores it)
+        config = create_meta(width, height, minz, size_maxz, shard_size, False, res, shard_chunks, shard_bytes,
+                "raw" if write_raw and raw_layout == "sharded" else "jpeg")
+        for level, scale in enumerate(config["scales"]):
+            scale["jpeg_quality"] = jpeg_quality[min(level, len(jpeg_quality)-1)]
+        validate(config)
+        if update:
+            _check_geometry(store, "neuroglancer/jpeg/info", config)
+        store.write("neuroglancer/jpeg/info", json.dumps(config), content_type="application/json")
        
         # write raw config to bucket/neuroglancer/raw/info
         if write_raw:
-            config = create_meta(width, height, minz, maxz, shard_size, True, res)
-            bucket = storage_client.bucket(bucket_name_raw)
-            blob = bucket.blob("neuroglancer/raw/info")
-            blob.upload_from_string(json.dumps(config))
+            config = create_raw_meta(width, height, minz, size_maxz, shard_size, res, raw_scales, raw_layout, raw_codec,
+                    shard_chunks, shard_bytes)
+            validate(config)
+            store_raw = open_store(bucket_name_raw)
+            if update:
+                _check_geometry(store_raw, "neuroglancer/raw/info", config)
+            store_raw.write("neuroglancer/raw/info", json.dumps(config), content_type="application/json")
 
         r = make_response("success".encode())
         r.headers.set('Content-Type', 'text/html')
@@ -391,225 +622,299 @@ def ngshard():
         if shard_size != 1024:
             raise RuntimeError("shard size must be 1024x1024x1024")
         write_raw  = json.loads(config_file["writeRaw"].lower())
+        raw_layout = config_file.get("raw-layout", "unsharded") # must match the raw info written by ngmeta
+        raw_scales = int(config_file.get("raw-scales", 1))
+        raw_codec = config_file.get("raw-codec", "gzip")
+        raw_level = int(config_file.get("raw-level", 9)) # gzip level of unsharded chunks
+        _check_raw_options(raw_layout, raw_scales, raw_codec, raw_level)
+        dirty_slices = config_file.get("dirty-slices") # [first, last] ranges of changed slices (None: all)
+        tile_codec = config_file.get("tile-codec", tilecodec.DEFAULT_CODEC) # codec of temporary tiles
+        tilecodec.check_codec(tile_codec)
+        brick_depth = config_file.get("brick-depth", 0) # z bricks written by alignedslices (0: one container per slice)
+        use_manifest = config_file.get("manifest", False) # read tile locations from the slice manifest
+        slab_depth = config_file.get("slab-depth", SHARD_DEPTH) # slices fetched and added to the pyramid at once
+        downsample_mode = config_file.get("downsample-mode", "mean") # reduction for each 2x2x2 block
+        downsample_sigma = float(config_file.get("downsample-sigma", 0)) # Gaussian prefilter (0: none)
+        check_mode(downsample_mode)
+        if downsample_sigma > 0 and downsample_mode != "mean":
+            raise RuntimeError("downsample-sigma requires mean downsampling")
+
+        # tensorstore limits for the shard writes (0: default, see clients.ts_context)
+        context_limits = (int(config_file.get("ts-data-copy-concurrency", 0)),
+                int(config_file.get("ts-gcs-concurrency", 0)), int(config_file.get("ts-cache-bytes", 0)))
+        if slab_depth <= 0 or (shard_size % slab_depth) != 0:
+            raise RuntimeError("slab depth must divide the shard size")
 
         # extract 1024x1024x1024 cube based on tile chunk
         zstart = max(shard_size*tile_chunk[2], minz)
         zfinish = min(maxz, zstart+shard_size-1)
 
-        #storage_client = storage.Client()
-        #bucket_temp = storage_client.bucket(bucket_tiled_name)
+        # store (and client) is shared by the fetch threads
+        store_temp = open_store(bucket_tiled_name)
+
+        # locations of this tile column for all slices (one request)
+        manifest_tiles = None
+        if use_manifest:
+            manifest_reader = manifest.ManifestReader(store_temp, manifest.manifest_name(tile_chunk[2]))
+            brick_depth = manifest_reader.brick_depth
+            manifest_tiles = {tile.slice: tile for tile in manifest_reader.tile_entries(tile_chunk[0], tile_chunk[1], zstart, zfinish)}
+            if len(manifest_tiles) != (zfinish - zstart + 1):
+                raise RuntimeError(f"manifest does not cover slices {zstart}-{zfinish}")
         
         vol3d = None
-        failure = None
 
         assert((MAX_IMAGE_SIZE % shard_size) == 0)
-        def set_image(slice, zstart, zfinish):
-            try:
-                nonlocal vol3d
-                nonlocal failure
-                
-                storage_client = storage.Client()
-                bucket_temp = storage_client.bucket(bucket_tiled_name)
-                
-                # x and y block location
-                x_block = (tile_chunk[0]*shard_size) // MAX_IMAGE_SIZE
-                y_block = (tile_chunk[1]*shard_size) // MAX_IMAGE_SIZE
-
-                # setup offsets for finding shards
-                chunk_tile_chunk_0 = ((tile_chunk[0]*shard_size) %  MAX_IMAGE_SIZE) // shard_size
-                chunk_tile_chunk_1 = ((tile_chunk[1]*shard_size) %  MAX_IMAGE_SIZE) // shard_size
-                chunk_width = MAX_IMAGE_SIZE // shard_size
-                if (width - x_block*MAX_IMAGE_SIZE) < MAX_IMAGE_SIZE:
-                    chunk_width = ceil((width - x_block*MAX_IMAGE_SIZE) / shard_size)
-
-                # get image block
-                blob = bucket_temp.blob(str(slice))
-                blob = bucket_temp.blob(f"{slice}_{x_block}_{y_block}")
-                
-                # read offset binary
-                pre = 24 # start of index
-            
-                spot = chunk_tile_chunk_1*chunk_width + chunk_tile_chunk_0
-                start_index = pre + spot * 8
-                end_index = start_index + 16 - 1
-
-                im_range = blob.download_as_string(start=start_index, end=end_index)
-                start = int.from_bytes(im_range[0:8], byteorder="little")
-                end = int.from_bytes(im_range[8:16], byteorder="little", signed=False) - 1
-                
-                # png blob
-                tries = 5
-                found = False
-                while not found and tries > 0:
-                    tries -= 1
-                    try:
-                        im_data = blob.download_as_string(start=start, end=end)
-                        found = True
-                    except Exception:
-                        time.sleep(2)
-                        pass
-
-                if not found:
-                    raise Exception("File not found")
-
-                im = Image.open(io.BytesIO(im_data))
-                img_array = np.array(im)
-                height2, width2 = im.height, im.width
-               
-                #with io.BytesIO() as output:
-                #    blob = bucket_temp.blob(str(slice)+".png")
-                #    im.save(output, format="PNG")
-                #    blob.upload_from_string(output.getvalue(), content_type="image/png")
-
-                if slice == zstart:
-                    vol3d = np.zeros((zfinish-zstart+1, height2, width2), dtype=np.uint8)
-                vol3d[(slice-zstart), :, :] = img_array
-
-            except Exception as e:
-                failure = e
-                raise
+
+        # x and y block location of the tile in the per-slice containers
+        x_block = (tile_chunk[0]*shard_size) // MAX_IMAGE_SIZE
+        y_block = (tile_chunk[1]*shard_size) // MAX_IMAGE_SIZE
+
+        def container_name(slice):
+            if brick_depth > 0:
+                return f"brick_{slice // brick_depth}_{tile_chunk[0]}_{tile_chunk[1]}"
+            return f"{slice}_{x_block}_{y_block}"
+
+        def image_job(slice, out):
+            # setup offsets for finding shards
+            chunk_tile_chunk_0 = ((tile_chunk[0]*shard_size) %  MAX_IMAGE_SIZE) // shard_size
+            chunk_tile_chunk_1 = ((tile_chunk[1]*shard_size) %  MAX_IMAGE_SIZE) // shard_size
+            chunk_width = MAX_IMAGE_SIZE // shard_size
+            if (width - x_block*MAX_IMAGE_SIZE) < MAX_IMAGE_SIZE:
+                chunk_width = ceil((width - x_block*MAX_IMAGE_SIZE) / shard_size)
+
+            # the index is fetched once and reused by retries; the tile is decoded
+            # straight into the volume (checksum verified for v2 containers)
+            reader = tilecontainer.ContainerReader(store_temp, container_name(slice), tile_codec, (MAX_IMAGE_SIZE // shard_size)**2)
+            spot = chunk_tile_chunk_1*chunk_width + chunk_tile_chunk_0
+            return lambda: reader.read_tile_into(spot, out)
+
+        def brick_job(zbrick, slices, outs):
+            # the tile column of this cube for the given slices of the brick
+            reader = tilecontainer.ContainerReader(store_temp, container_name(zbrick*brick_depth), tile_codec, brick_depth)
+            return lambda: reader.read_tiles_into([slice - zbrick*brick_depth for slice in slices], outs)
+
+        def manifest_job(name, slices, outs):
+            # a single request for tiles stored next to each other
+            tiles = [manifest_tiles[slice] for slice in slices]
+            return lambda: manifest.fetch_tiles(store_temp, name, tiles, outs, tile_codec)
 
         # number of downsample levels
-        num_levels = 6
+        num_levels = NUM_SCALES
 
-        # fetch 1024x1024 tile from each imagee
-        def set_images(start, finish, zstart_vol, thread_id, num_threads):
-            for slice in range(start, finish+1):
-                if (slice % num_threads) == thread_id:
-                    set_image(slice, zstart_vol, finish)
+        # voxels covered by the shards of each scale (planned by ngmeta, see shardplan.py)
+        info_bytes = open_store(bucket_name).read("neuroglancer/jpeg/info")
+        info = json.loads(info_bytes)
+        shard_extents = [shard_extent(scale) for scale in info["scales"][:num_levels]]
 
-        def _write_shard(level, start, vol3d, format, dataset=None):
+        # the raw info is only read if raw shards are written
+        info_versions = {"jpeg": _info_version(info_bytes)}
+
+        def fetch_jobs(start, finish, zstart_vol):
+            """Transfers that fetch the 1024x1024 tile of each slice in [start, finish] into vol3d.
+            """
+            jobs = []
+            if manifest_tiles is not None:
+                containers = {}
+                for slice in range(start, finish+1):
+                    containers.setdefault(container_name(slice), []).append(slice)
+                for name, slices in containers.items():
+                    jobs.append((f"fetch {name}", manifest_job(name, slices, [vol3d[(slice-zstart_vol), :, :] for slice in slices])))
+            elif brick_depth > 0:
+                for zbrick in range(start // brick_depth, finish // brick_depth + 1):
+                    slices = list(range(max(zbrick*brick_depth, start), min((zbrick+1)*brick_depth - 1, finish) + 1))
+                    jobs.append((f"fetch {container_name(zbrick*brick_depth)}",
+                        brick_job(zbrick, slices, [vol3d[(slice-zstart_vol), :, :] for slice in slices])))
+            else:
+                for slice in range(start, finish+1):
+                    jobs.append((f"fetch {container_name(slice)}", image_job(slice, vol3d[(slice-zstart_vol), :, :])))
+            return jobs
+
+        # writes to each column of shards of a scale are staged in a transaction
+        # that is committed once the layer of shards (the shard depth of the scale)
+        # is complete, so each shard object is uploaded once instead of once per write
+        transactions = {}
+
+        def _write_shard(level, start, vol3d, format):
             """Method to write shard through tensorstore.
             """
-
-            if dataset is None:
-                # get spec for jpeg and post
-                dataset = ts.open({
-                    'driver': 'neuroglancer_precomputed',
-                    'kvstore': {
-                        'driver': 'gcs',
-                        'bucket': bucket_name,
-                        },
-                    'path': f"neuroglancer/{format}",
-                    'recheck_cached_data': 'open',
-                    'scale_index': level
-                }).result()
-                dataset = dataset[ts.d['channel'][0]]
+            extent = shard_extents[level]
+            key = (format, level, start[0] // extent[0], start[1] // extent[1])
+            if key not in transactions:
+                transactions[key] = ts.Transaction()
+            bucket = bucket_name_raw if format == "raw" else bucket_name
+            if format not in info_versions:
+                info_versions[format] = _info_version(open_store(bucket).read(f"neuroglancer/{format}/info"))
+            dataset = _ng_scale(bucket, format, level, context_limits,
+                    info_versions[format]).with_transaction(transactions[key])
 
             size = vol3d.shape
-            dataset[ start[0]:(start[0]+size[0]), start[1]:(start[1]+size[1]), start[2]:(start[2]+size[2]) ] = vol3d 
-            return dataset 
-        
+            dataset[ start[0]:(start[0]+size[0]), start[1]:(start[1]+size[1]), start[2]:(start[2]+size[2]) ].write(vol3d).result()
 
-        storage_client = storage.Client()
-        bucket_raw = storage_client.bucket(bucket_name_raw)
-        def _write_shard_raw(vol3d, offset):
-            """Write gzip 512x512x512 in ng format.
+        def _commit_layer(level, end):
+            """Commit the transactions of a scale if its layer of shards ends before slice end.
             """
+            # (the last slices of the cube will not be followed by more writes)
+            if end % shard_extents[level][2] == 0 or (level == 0 and end == glb_zfinish + 1):
+                for key in [key for key in transactions if key[1] == level]:
+                    transactions.pop(key).commit_sync()
 
-            start = [tile_chunk[0]*shard_size + offset[0]*512, tile_chunk[1]*shard_size + offset[1]*512, glb_zstart + offset[2]*512]
 
-            blob = bucket_raw.blob(f"neuroglancer/raw/{resolution}.0x{resolution}.0x{resolution}.0/{start[0]}-{start[0]+512}_{start[1]}-{start[1]+512}_{start[2]}-{start[2]+512}")
-            blob.content_encoding = "gzip"
-            tarr = np.zeros((512, 512, 512), dtype=np.uint8)
-            tarr[0:vol3d.shape[0], 0:vol3d.shape[1], 0:vol3d.shape[2]] = vol3d
-            blob.upload_from_string(gzip.compress(tarr.tostring()), content_type="application/octet-stream")
-
-        def _downsample(vol, mode="constant"):
-            """Downsample piecewise.
+        store_raw = open_store(bucket_name_raw)
+        raw_uploads = []
+        def raw_chunk_writer(level):
+            """Upload unsharded chunks of a raw scale in ng format.
             """
-            x,y,z = vol.shape
-
-            # just call interpolate over whole volume if large enough
-            if x <= 256 and y <= 256 and z <= 256:
-                #return ndimage.interpolation.zoom(vol, 0.5, order=1, mode=mode)
-                return downscale_local_mean(vol, (2,2,2)).astype(vol.dtype, copy=False)[:x//2, :y//2, :z//2]
-            
-            target = np.zeros((x//2,y//2,z//2), dtype=np.uint8)
-            for xiter in range(0, x, 256):
-                for yiter in range(0, y, 256):
-                    for ziter in range(0, z, 256):
-                        #target[(xiter//2):((xiter+256)//2), (yiter//2):((yiter+256)//2), (ziter//2):((ziter+256)//2)] = ndimage.interpolation.zoom(vol[xiter:(xiter+256),yiter:(yiter+256),ziter:(ziter+256)], 0.5, order=1, mode=mode)
-                        x2, y2, z2 = vol[xiter:(xiter+256),yiter:(yiter+256),ziter:(ziter+256)].shape
-                        target[(xiter//2):((xiter+256)//2), (yiter//2):((yiter+256)//2), (ziter//2):((ziter+256)//2)] = downscale_local_mean(vol[xiter:(xiter+256),yiter:(yiter+256),ziter:(ziter+256)], (2,2,2)).astype(vol.dtype, copy= False)[:x2//2, :y2//2, :z2//2]
-
-            return target 
-        
-        ####### Iterate 512 slices at a time ########
-        glb_zstart = zstart
-        glb_zfinish = zfinish
+            res = int(resolution) << level
+            chunk_size = min(RAW_CHUNK_SIZE, shard_size >> level)
+            def write_chunk(ix, iy, iz, data):
+                start = [((tile_chunk[0]*shard_size) >> level) + ix*chunk_size, ((tile_chunk[1]*shard_size) >> level) + iy*chunk_size, iz*chunk_size]
+                name = (f"neuroglancer/raw/{res}.0x{res}.0x{res}.0/{start[0]}-{start[0]+chunk_size}_"
+                        f"{start[1]}-{start[1]+chunk_size}_{start[2]}-{start[2]+chunk_size}")
+                content_encoding = "gzip" if raw_codec == "gzip" else None
+                job = lambda: store_raw.write(name, data, content_encoding=content_encoding)
+                raw_uploads.append(transfers.engine().submit(job, f"write {name}"))
+            return write_chunk
+
+        def is_dirty(first, last):
+            """True if scale 0 slices [first, last] include changed slices.
+            """
+            return dirty_slices is None or any(first <= dirty_last and dirty_first <= last for dirty_first, dirty_last in dirty_slices)
 
-        for zstart in range(glb_zstart, glb_zfinish+1, 512):
-            zfinish = zstart + 512 - 1
-            if zfinish > glb_zfinish:
-                zfinish = glb_zfinish
+        def write_level(level, z, vol):
+            """Write consecutive (z, y, x) slices of a scale starting at z.
+            """
+            start = ((tile_chunk[0]*shard_size) >> level, (tile_chunk[1]*shard_size) >> level, z)
+            if raw_streams[level] is not None:
+                raw_streams[level].add(vol)
+
+            # shards are rewritten as a whole, so only layers of shards without changes are skipped
+            depth = shard_extents[level][2]
+            first = (z // depth) * depth
+            last = ceil((z + vol.shape[0]) / depth) * depth - 1
+            if not is_dirty(first << level, ((last + 1) << level) - 1):
+                return
+            formats = ["jpeg"]
+            if raw_sharded[level]:
+                formats.append("raw")
 
-            # set first image
-            set_image(zstart, zstart, zfinish)
+            # put in fortran order
+            vol = vol.transpose((2,1,0))
+            for format in formats:
+                if level == 0:
+                    # write 256x256 columns to bound the tensorstore write buffers
+                    for itery in range(0, shard_size, 256):
+                        for iterx in range(0, shard_size, 256):
+                            start_temp = (start[0]+iterx, start[1]+itery, start[2])
+                            _write_shard(level, start_temp, vol[iterx:(iterx+256), itery:(itery+256), :], format)
+                else:
+                    _write_shard(level, start, vol, format)
+            _commit_layer(level, z + vol.shape[2])
 
-            # use 20 threads in parallel to fetch
-            num_threads = 20
-            threads = [threading.Thread(target=set_images, args=(zstart+1, zfinish, zstart, thread_id, num_threads)) for thread_id in range(num_threads)]
-            for thread in threads:
-                thread.start()
-            for thread in threads:
-                thread.join()
+        ####### Stream slab-depth slices at a time through the pyramid ########
+        glb_zstart = zstart
+        glb_zfinish = zfinish
 
-            if failure is not None:
-                raise Exception("tile not fetched")
+        pyramid = SlabPyramid(num_levels, glb_zstart, write_level, mode=downsample_mode, sigma=downsample_sigma)
 
-            # write grayscale for each level
-            start = (tile_chunk[0]*shard_size, tile_chunk[1]*shard_size, zstart)
+        # raw scales reuse the pyramid: sharded scales are written with the jpeg
+        # shards, unsharded chunks are compressed (in parallel) as slices arrive
+        compress_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        raw_sharded = [False]*num_levels
+        raw_streams = [None]*num_levels
+        if write_raw:
+            for level in range(raw_scales):
+                if raw_layout == "sharded" and level < RAW_SHARDED_SCALES:
+                    raw_sharded[level] = True
+                else:
+                    chunk_size = min(RAW_CHUNK_SIZE, shard_size >> level)
+                    def include_layer(iz, level=level, chunk_size=chunk_size):
+                        return is_dirty((iz*chunk_size) << level, (((iz+1)*chunk_size) << level) - 1)
+                    raw_streams[level] = RawChunkStream(shard_size >> level, raw_chunk_writer(level), raw_level,
+                            chunk_size, glb_zstart >> level, raw_codec, compress_executor, include_layer)
+
+        try:
+            # the slab buffer is reused (every slice is overwritten by the fetch)
+            vol3d = np.zeros((slab_depth, shard_size, shard_size), dtype=np.uint8)
+            for zstart in range(glb_zstart, glb_zfinish+1, slab_depth):
+                zfinish = min(zstart + slab_depth - 1, glb_zfinish)
+
+                # fetch with bounded concurrency and retries (raises if a tile cannot be fetched)
+                transfers.engine().run(fetch_jobs(zstart, zfinish, zstart))
+
+                slab = vol3d[0:(zfinish-zstart+1)]
+                pyramid.add(slab)
+                del slab
+
+            pyramid.finish()
+            for key in list(transactions.keys()):
+                transactions.pop(key).commit_sync()
+            for raw_stream in raw_streams:
+                if raw_stream is not None:
+                    raw_stream.finish()
+            for upload in raw_uploads:
+                upload.result()
+        finally:
+            compress_executor.shutdown()
+        del vol3d
+        gc.collect()
 
-            #storage_client2 = storage.Client()
-            #bucket = storage_client2.bucket(bucket_name)
+        r = make_response("success".encode())
+        r.headers.set('Content-Type', 'text/html')
+        return r
+    except Exception as e:
+        return Response(traceback.format_exc(), 400)
 
-            gc.collect()
-            if write_raw:
-                if glb_zstart % shard_size == 0:
-                    # only support shard aligned now
-                    for iterz in range((zstart-glb_zstart), (zstart-glb_zstart) + 512, 512):
-                        for itery in range(0, 1024, 512):
-                            for iterx in range(0, 1024, 512):
-                                vol3d_temp = vol3d[(iterz%512):((iterz%512)+512), itery:(itery+512), iterx:(iterx+512)]
-    
-                                # ignore if empty
-                                currsize = vol3d_temp.shape
-                                if currsize[0] == 0 or currsize[1] == 0 or currsize[2] == 0:
-                                    continue
-                                _write_shard_raw(vol3d_temp, (iterx//512, itery//512, iterz//512))
-            gc.collect()
+@app.route('/ngreduce', methods=["POST"])
+def ngreduce():
+    """Write coarse scales of bucket/neuroglancer/jpeg from a block of a finer scale.
 
-            # put in fortran order
-            vol3d = vol3d.transpose((2,1,0))
+    The block ("start", in units of REDUCE_BLOCK_SIZE) of scale "level" is read
+    and downsampled into the next "levels" scales (see create_meta).  Blocks
+    write disjoint chunks, so the requests of a level can run in parallel once
+    the source scale is complete.
+    """
+    try:
+        config_file  = request.get_json()
 
-            for level in range(num_levels):
-                if level == 0:
-                    # iterate through different 256 cubes since 1024 will not fit in memory
-                    dataset_jpeg = None
-                    for iterz in range((zstart-glb_zstart), (zstart-glb_zstart) + 512, 256):
-                        for itery in range(0, 1024, 256):
-                            for iterx in range(0, 1024, 256):
-                                vol3d_temp = vol3d[iterx:(iterx+256), itery:(itery+256), (iterz%512):((iterz%512)+256)]
-                                currsize = vol3d_temp.shape
-                                if currsize[0] == 0 or currsize[1] == 0 or currsize[2] == 0:
-                                    continue
-                                start_temp = (start[0]+iterx, start[1]+itery, start[2]+(iterz%512)) 
-                                
-                                _ = _write_shard(level, start_temp, vol3d_temp, "jpeg", dataset_jpeg)
-                else:
-                    _ = _write_shard(level, start, vol3d, "jpeg")
-
-                # downsample
-                #vol3d = ndimage.interpolation.zoom(vol3d, 0.5)
-                mode = "constant"
-                if level >= 4:
-                    mode = "nearest" 
-                vol3d = _downsample(vol3d, mode)
-                start = (start[0]//2, start[1]//2, start[2]//2)
-                currsize = vol3d.shape
-                if currsize[0] == 0 or currsize[1] == 0 or currsize[2] == 0:
-                    break
+        bucket_name = config_file["dest"] # contains source and destination
+        level = int(config_file["level"]) # source scale
+        block = config_file["start"]
+        num_levels = int(config_file.get("levels", REDUCE_LEVELS))
+        if num_levels < 1 or num_levels > REDUCE_LEVELS:
+            raise RuntimeError(f"levels must be between 1 and {REDUCE_LEVELS}")
+        downsample_mode = config_file.get("downsample-mode", "mean") # reduction for each 2x2x2 block
+        check_mode(downsample_mode)
+        context_limits = (int(config_file.get("ts-data-copy-concurrency", 0)),
+                int(config_file.get("ts-gcs-concurrency", 0)), int(config_file.get("ts-cache-bytes", 0)))
+
+        # (handles are reopened if ngmeta rewrote the info since they were cached)
+        version = _info_version(open_store(bucket_name).read("neuroglancer/jpeg/info"))
+        source = _ng_scale(bucket_name, "jpeg", level, context_limits, version)
+        size = source.shape
+        start = [block[dim]*REDUCE_BLOCK_SIZE for dim in range(3)]
+        finish = [min(start[dim]+REDUCE_BLOCK_SIZE, size[dim]) for dim in range(3)]
+        if any(start[dim] >= finish[dim] for dim in range(3)):
+            raise RuntimeError(f"block {block} is outside of scale {level}")
+
+        # (z, y, x) block of the source scale
+        vol = source[start[0]:finish[0], start[1]:finish[1], start[2]:finish[2]].read().result()
+        vol = np.ascontiguousarray(vol.transpose((2,1,0)))
+
+        for iter in range(1, num_levels+1):
+            # odd extents (only at the end of the volume) repeat their last plane
+            pad = [(0, dim % 2) for dim in vol.shape]
+            if any(extra for _, extra in pad):
+                vol = np.pad(vol, pad, mode="edge")
+            vol = downsample(vol, downsample_mode)
+            start = [pos // 2 for pos in start]
+
+            # the block covers whole shards of the scale (see shardplan.py), so each is uploaded once
+            transaction = ts.Transaction()
+            dataset = _ng_scale(bucket_name, "jpeg", level+iter, context_limits, version).with_transaction(transaction)
+            size = vol.shape[::-1]
+            dataset[start[0]:(start[0]+size[0]), start[1]:(start[1]+size[1]), start[2]:(start[2]+size[2])].write(
+                    vol.transpose((2,1,0))).result()
+            transaction.commit_sync()
 
         r = make_response("success".encode())
         r.headers.set('Content-Type', 'text/html')
@@ -617,7 +922,56 @@ def ngshard():
     except Exception as e:
         return Response(traceback.format_exc(), 400)
 
-def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
+def coarse_scales(scales, minz, res):
+    """Scales that halve the last scale until the volume fits in one chunk.
+
+    These are written by ngreduce in chunks of COARSE_CHUNK_SIZE (sharded
+    like the other scales, see shardplan.py).
+    """
+    coarse = []
+    last = scales[-1]
+    level = len(scales)
+    while max(last["size"]) > COARSE_CHUNK_SIZE:
+        last = {
+                "chunk_sizes" : [
+                    [ COARSE_CHUNK_SIZE, COARSE_CHUNK_SIZE, COARSE_CHUNK_SIZE ]
+                    ],
+                "encoding" : "jpeg",
+                "key" : f"{res << level}.0x{res << level}.0x{res << level}.0",
+                "resolution" : [ res << level, res << level, res << level ],
+                "size" : [ (size + 1) // 2 for size in last["size"] ],
+                "realsize" : [ size // 2 for size in last["realsize"] ],
+                "offset" : [0, 0, 0],
+                "realoffset" : [0, 0, minz >> level]
+            }
+        coarse.append(last)
+        level += 1
+    return coarse
+
+def _write_sizes(shard_size, num_scales):
+    """Side of the region written by one request (ngshard or ngreduce) for each scale.
+    """
+    sizes = []
+    for level in range(num_scales):
+        if level < NUM_SCALES:
+            sizes.append(shard_size >> level)
+        else:
+            sizes.append(REDUCE_BLOCK_SIZE >> ((level - NUM_SCALES) % REDUCE_LEVELS + 1))
+    return sizes
+
+def create_meta(width, height, minz, maxz, shard_size, isRaw, res, shard_chunks=TARGET_SHARD_CHUNKS,
+        shard_bytes=TARGET_SHARD_BYTES, shard_encoding="jpeg"):
+    """Metadata for the jpeg pyramid (or scale 0 of the raw pyramid if isRaw).
+
+    The first NUM_SCALES scales are written by ngshard, the coarse scales
+    above them by ngreduce (see coarse_scales).  The sharding of each scale
+    is planned from its size (see shardplan.py).
+
+    Args:
+        shard_chunks (int): largest number of chunks in a shard
+        shard_bytes (int): largest estimated size of a shard
+        shard_encoding (str): estimate shard sizes for "jpeg" or "raw" data
+    """
     if (width % shard_size) > 0: 
         width += ( 1024 - (width % shard_size))
     if (height % shard_size) > 0: 
@@ -631,9 +985,8 @@ def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
     # !! make jpeg chunks 256 cubes (return to 512, maybe,
     # when tensorstore issues are addressed)
 
-    # !! refactor to use unsharded format for raw (just save
-    # 256 chunks) and for 64 and 128 cubes for jpeg (currently
-    # a bug with unsharded pieces in ng)
+    # the sharding of every scale (including the coarse scales) is
+    # planned from its size by plan_sharding below
 
     if isRaw:
         return {
@@ -658,7 +1011,7 @@ def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
             }
 
     # load json (don't need tensorflow)
-    return {
+    config = {
        "@type" : "neuroglancer_multiscale_volume",
        "data_type" : "uint8",
        "num_channels" : 1,
@@ -670,14 +1023,6 @@ def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
              "encoding" : "raw" if isRaw else "jpeg",
              "key" : f"{res}.0x{res}.0x{res}.0",
              "resolution" : [ res, res, res ],
-             "sharding" : {
-                "@type" : "neuroglancer_uint64_sharded_v1",
-                "hash" : "identity",
-                "minishard_bits" : 0,
-                "minishard_index_encoding" : "gzip",
-                "preshift_bits" : 6,
-                "shard_bits" : 27
-             },
              "size" : [ width, height, (maxz+1) ],
              "realsize" : [ width, height, (maxz-minz+1) ],
              "offset" : [0, 0, 0],
@@ -690,14 +1035,6 @@ def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
              "encoding" : "raw" if isRaw else "jpeg",
              "key" : f"{res*2}.0x{res*2}.0x{res*2}.0",
              "resolution" : [ res*2, res*2, res*2 ],
-             "sharding" : {
-                "@type" : "neuroglancer_uint64_sharded_v1",
-                "hash" : "identity",
-                "minishard_bits" : 0,
-                "minishard_index_encoding" : "gzip",
-                "preshift_bits" : 6,
-                "shard_bits" : 24
-             },
              "size" : [ width//2+1, height//2+1, (maxz+1)//2+1 ],
              "realsize" : [ width//2, height//2, (maxz-minz+1)//2 ],
              "offset" : [0, 0, 0],
@@ -710,14 +1047,6 @@ def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
              "encoding" : "raw" if isRaw else "jpeg",
              "key" : f"{res*4}.0x{res*4}.0x{res*4}.0",
              "resolution" : [ res*4, res*4, res*4 ],
-             "sharding" : {
-                "@type" : "neuroglancer_uint64_sharded_v1",
-                "hash" : "identity",
-                "minishard_bits" : 0,
-                "minishard_index_encoding" : "gzip",
-                "preshift_bits" : 6,
-                "shard_bits" : 21
-             },
              "size" : [ width//4+2, height//4+2, (maxz+1)//4+2 ],
              "realsize" : [ width//4, height//4, (maxz-minz+1)//4 ],
              "offset" : [0, 0, 0],
@@ -757,12 +1086,67 @@ def create_meta(width, height, minz, maxz, shard_size, isRaw, res):
              "size" : [ width//32+16, height//32+16, (maxz+1)//32+16 ],
              "realsize" : [ width//32, height//32, (maxz-minz+1)//32 ],
              "offset" : [0, 0, 0],
-             "realoffset" : [0, 0, minz//16]
+             "realoffset" : [0, 0, minz//32]
           }
        ],
        "type" : "image"
     }
-
+    config["scales"] += coarse_scales(config["scales"], minz, res)
+    plan_sharding(config["scales"], _write_sizes(shard_size, len(config["scales"])),
+            BYTES_PER_VOXEL[shard_encoding], shard_chunks, shard_bytes)
+    return config
+
+
+def create_raw_meta(width, height, minz, maxz, shard_size, res, num_scales=1, layout="unsharded", codec="gzip",
+        shard_chunks=TARGET_SHARD_CHUNKS, shard_bytes=TARGET_SHARD_BYTES):
+    """Metadata for the raw pyramid.
+
+    Unsharded scales are stored in chunks of up to RAW_CHUNK_SIZE that do not
+    cross a cube of shard_size (so every chunk is written by one ngshard
+    request).  The sharded layout stores the first RAW_SHARDED_SCALES scales
+    in the shards of the jpeg pyramid.
+
+    Args:
+        num_scales (int): number of scales (scale 0 is the only scale by default)
+        layout (str): "unsharded" or "sharded"
+        codec (str): "gzip" or "none" (gzip unsharded chunks are stored with gzip content encoding)
+        shard_chunks (int): shard_chunks given to create_meta for the jpeg pyramid
+        shard_bytes (int): shard_bytes given to create_meta for the jpeg pyramid
+    Returns:
+        info (dict)
+    """
+    config = create_meta(width, height, minz, maxz, shard_size, True, res)
+    # (the shards are sized for raw data if they hold it)
+    jpeg_scales = create_meta(width, height, minz, maxz, shard_size, False, res, shard_chunks, shard_bytes,
+            "raw" if layout == "sharded" else "jpeg")["scales"]
+    scale0 = config["scales"][0]
+
+    scales = []
+    for level in range(num_scales):
+        if layout == "sharded" and level < RAW_SHARDED_SCALES:
+            scale = dict(jpeg_scales[level], encoding="raw")
+            if "sharding" not in scale:
+                raise RuntimeError(f"scale {level} is not sharded (increase shard-chunks or shard-bytes, or use the unsharded raw layout)")
+            scale["sharding"] = dict(scale["sharding"], data_encoding="gzip" if codec == "gzip" else "raw")
+        elif level == 0:
+            scale = scale0
+        else:
+            chunk_size = min(RAW_CHUNK_SIZE, shard_size >> level)
+            scale = {
+                "chunk_sizes" : [
+                    [ chunk_size, chunk_size, chunk_size ]
+                    ],
+                "encoding" : "raw",
+                "key" : f"{res << level}.0x{res << level}.0x{res << level}.0",
+                "resolution" : [ res << level, res << level, res << level ],
+                "size" : [ size >> level for size in scale0["size"] ],
+                "realsize" : [ size >> level for size in scale0["realsize"] ],
+                "offset" : [0, 0, 0],
+                "realoffset" : [0, 0, minz >> level]
+            }
+        scales.append(scale)
+    config["scales"] = scales
+    return config
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+"""Run-level index of where every tile of every slice is stored.
+
+Reading a tile from its container needs the container index first (one
+request) and then the tile (a second request).  To avoid the first
+request, alignedslice(s) publish the index entries of each slice as a
+small fragment (index/{slice}) and /slicemanifest merges the fragments
+of each 1024-slice z range into a manifest (manifest/{zcube}) ordered by
+tile and then slice.  ngshard reads the entries of its tile column for
+all of its slices with one ranged request and then fetches the tile
+data directly, coalescing tiles that are stored next to each other
+(e.g., consecutive slices of a z brick) into one request.
+
+Fragment layout (little endian):
+
+    header (32 bytes): magic "EMSI", version (u32), slice (u32), tiles per row (u32), tile rows (u32), padding
+    entries (16 bytes per tile in row-major tile order): offset (u64), length (u32), crc32c (u32)
+
+Manifest layout:
+
+    header (64 bytes): magic "EMMF", version (u32), first slice (u32), number of slices (u32),
+        tiles per row (u32), tile rows (u32), tile size (u32), brick depth (u32), padding
+    entries (16 bytes): the entry of tile t and slice z is at 64 + 16*(t*nslices + z - first slice)
+
+Offsets are relative to the container holding the tile ({slice}_{x}_{y}
+or brick_{z}_{x}_{y}, see emwrite.py).  Empty tiles have a length of 0.
+"""
+
+import struct
+from collections import namedtuple
+
+import google_crc32c
+import numpy as np
+
+import tilecodec
+
+FRAGMENT_MAGIC = b"EMSI"
+MANIFEST_MAGIC = b"EMMF"
+VERSION = 1
+FRAGMENT_HEADER = struct.Struct("<4sIIII12x")
+MANIFEST_HEADER = struct.Struct("<4sIIIIIII32x")
+ENTRY_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4"), ("crc32c", "<u4")])
+
+# tiles whose data is separated by less than this are fetched with one request
+MAX_GAP = 64*1024
+
+ManifestTile = namedtuple("ManifestTile", ["slice", "offset", "length", "crc32c"])
+
+
+def fragment_name(slice):
+    return f"index/{slice}"
+
+
+def manifest_name(zcube):
+    return f"manifest/{zcube}"
+
+
+def fragment_bytes(slice, ntiles_x, ntiles_y, entries):
+    """Pack the fragment of a slice.
+
+    Args:
+        entries (dict): (tx, ty) -> tilecontainer.TileEntry for every tile of the slice
+    """
+    table = np.zeros(ntiles_x*ntiles_y, dtype=ENTRY_DTYPE)
+    for (tx, ty), entry in entries.items():
+        if not entry.empty:
+            table[ty*ntiles_x + tx] = (entry.offset, entry.length, entry.crc32c)
+    return FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, VERSION, slice, ntiles_x, ntiles_y) + table.tobytes()
+
+
+def parse_fragment(data):
+    """Returns (slice, ntiles_x, ntiles_y, entry table).
+    """
+    magic, version, slice, ntiles_x, ntiles_y = FRAGMENT_HEADER.unpack_from(data)
+    if magic != FRAGMENT_MAGIC or version != VERSION:
+        raise RuntimeError("not a slice index fragment")
+    table = np.frombuffer(data, dtype=ENTRY_DTYPE, count=ntiles_x*ntiles_y, offset=FRAGMENT_HEADER.size)
+    return slice, ntiles_x, ntiles_y, table
+
+
+def manifest_bytes(zstart, nslices, ntiles_x, ntiles_y, tile_size, brick_depth, fragments):
+    """Merge fragments into a manifest.
+
+    Args:
+        fragments (dict): slice -> fragment bytes
+    """
+    table = np.zeros((ntiles_x*ntiles_y, nslices), dtype=ENTRY_DTYPE)
+    for slice, data in fragments.items():
+        frag_slice, frag_x, frag_y, entries = parse_fragment(data)
+        if frag_slice != slice or frag_x != ntiles_x or frag_y != ntiles_y:
+            raise RuntimeError(f"fragment for slice {slice} does not match the manifest")
+        table[:, slice - zstart] = entries
+    header = MANIFEST_HEADER.pack(MANIFEST_MAGIC, VERSION, zstart, nslices, ntiles_x, ntiles_y, tile_size, brick_depth)
+    return header + table.tobytes()
+
+
+class ManifestReader:
+    """Reads the entries of a tile column from a stored manifest.
+
+    Args:
+        store (objectstore.ObjectStore): store containing the manifest
+        name (str): name of the manifest
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        magic, version, self.zstart, self.nslices, self.ntiles_x, self.ntiles_y, self.tile_size, self.brick_depth = \
+                MANIFEST_HEADER.unpack(store.read(name, 0, MANIFEST_HEADER.size))
+        if magic != MANIFEST_MAGIC or version != VERSION:
+            raise RuntimeError(f"{name} is not a slice manifest")
+
+    def tile_entries(self, tx, ty, zstart, zfinish):
+        """Entries of tile (tx, ty) for slices [zstart, zfinish] (one request).
+
+        Returns:
+            list of ManifestTile
+        """
+        first = max(zstart, self.zstart) - self.zstart
+        last = min(zfinish, self.zstart + self.nslices - 1) - self.zstart
+        if last < first:
+            return []
+        base = MANIFEST_HEADER.size + ENTRY_DTYPE.itemsize*((ty*self.ntiles_x + tx)*self.nslices)
+        data = self.store.read(self.name, base + ENTRY_DTYPE.itemsize*first, base + ENTRY_DTYPE.itemsize*(last+1))
+        table = np.frombuffer(data, dtype=ENTRY_DTYPE)
+        return [ManifestTile(self.zstart + first + idx, int(entry["offset"]), int(entry["length"]), int(entry["crc32c"]))
+                for idx, entry in enumerate(table)]
+
+
+def fetch_tiles(store, name, tiles, outs, codec, max_gap=MAX_GAP):
+    """Read tiles of one container into outs with as few requests as possible.
+
+    Tiles that are stored close together are fetched with a single ranged
+    request.  Empty tiles (length 0) are zero-filled.
+
+    Args:
+        store (objectstore.ObjectStore): store containing the container
+        name (str): name of the container
+        tiles (list): ManifestTile for each tile
+        outs (list): uint8 destination for each tile
+        codec (str): tile codec
+    """
+    pending = []
+    for tile, out in zip(tiles, outs):
+        if tile.length == 0:
+            out[...] = 0
+        else:
+            pending.append((tile, out))
+    pending.sort(key=lambda item: item[0].offset)
+
+    # group tiles into ranges
+    groups = []
+    for tile, out in pending:
+        if groups and tile.offset - groups[-1][1] <= max_gap:
+            groups[-1][1] = max(groups[-1][1], tile.offset + tile.length)
+            groups[-1][2].append((tile, out))
+        else:
+            groups.append([tile.offset, tile.offset + tile.length, [(tile, out)]])
+
+    for start, end, members in groups:
+        data = store.read(name, start, end)
+        for tile, out in members:
+            tile_data = data[(tile.offset-start):(tile.offset-start+tile.length)]
+            if google_crc32c.value(tile_data) != tile.crc32c:
+                raise RuntimeError(f"checksum mismatch for slice {tile.slice} in {name}")
+            tilecodec.decode_into(tile_data, out, codec)
@@ -0,0 +1,249 @@
+"""Object storage backends used by the emwrite endpoints.
+
+All storage locations passed to the endpoints (e.g., "dest", "dest-tmp",
+"source") are opened with open_store and can be:
+
+* a bucket name or gs://bucket[/prefix]: Google cloud storage
+* file:///path: a local (or shared NFS/Lustre) filesystem, reads use mmap
+* mem://name: an in-memory store shared by the process (for testing and benchmarking)
+
+Each store supports ranged reads, batched writes, and listing, and
+provides the tensorstore kvstore spec for the same location so that
+neuroglancer volumes and chunked sources are written next to the objects.
+Object names are relative to the store location and use "/" separators.
+Content encoding metadata is only kept by GCS.
+
+The DAG has its own copy in emprocess/objectstore.py (the Airflow image
+has neither tensorstore nor the clients here).  Keep the LocalStore and
+MemoryStore behavior of both in sync.  Deliberate differences: this copy
+adds read_into, content encodings, and the kvstore specs, and the DAG
+copy adds create and is_gcs.
+"""
+
+import mmap
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorstore as ts
+
+import clients
+
+# threads used by write_many for remote stores
+WRITE_THREADS = 8
+
+_memory_stores = {}
+_memory_lock = threading.Lock()
+
+
+def open_store(location):
+    """Open the store for a location (see module documentation).
+    """
+    if location.startswith("file://"):
+        return LocalStore(location[len("file://"):])
+    if location.startswith("mem://"):
+        name = location[len("mem://"):]
+        with _memory_lock:
+            if name not in _memory_stores:
+                _memory_stores[name] = MemoryStore(name)
+            return _memory_stores[name]
+    if location.startswith("gs://"):
+        location = location[len("gs://"):]
+    bucket, _, prefix = location.partition("/")
+    return GCSStore(bucket, prefix)
+
+
+class ObjectStore:
+    """Interface implemented by all storage backends.
+
+    Ranges are given as [start, end) byte offsets (end=None reads to the end).
+    """
+
+    def read(self, name, start=0, end=None):
+        """Read an object (or a range of it) as bytes.
+        """
+        raise NotImplementedError
+
+    def read_into(self, name, fileobj, start=0, end=None):
+        """Stream an object (or a range of it) to a file-like object.
+        """
+        fileobj.write(self.read(name, start, end))
+
+    def write(self, name, data, content_type="application/octet-stream", content_encoding=None):
+        """Write (replace) an object.
+        """
+        raise NotImplementedError
+
+    def write_many(self, items, content_type="application/octet-stream"):
+        """Write several objects given as (name, data) pairs.
+        """
+        for name, data in items:
+            self.write(name, data, content_type)
+
+    def list(self, prefix=""):
+        """Names of all objects starting with prefix.
+        """
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def kvstore(self, path=""):
+        """tensorstore kvstore spec for path within the store.
+        """
+        raise NotImplementedError
+
+
+class GCSStore(ObjectStore):
+    """Google cloud storage bucket (optionally restricted to a prefix).
+    """
+
+    def __init__(self, bucket, prefix=""):
+        self.bucket_name = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") != "" else ""
+        self.bucket = clients.storage_client().bucket(bucket)
+
+    def _blob(self, name):
+        return self.bucket.blob(self.prefix + name)
+
+    def read(self, name, start=0, end=None):
+        if start == 0 and end is None:
+            return self._blob(name).download_as_bytes()
+        return self._blob(name).download_as_bytes(start=start, end=(end-1 if end is not None else None))
+
+    def read_into(self, name, fileobj, start=0, end=None):
+        self._blob(name).download_to_file(fileobj, start=start, end=(end-1 if end is not None else None))
+
+    def write(self, name, data, content_type="application/octet-stream", content_encoding=None):
+        blob = self._blob(name)
+        if content_encoding is not None:
+            blob.content_encoding = content_encoding
+        blob.upload_from_string(data, content_type=content_type)
+
+    def write_many(self, items, content_type="application/octet-stream"):
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=min(WRITE_THREADS, max(len(items), 1))) as executor:
+            list(executor.map(lambda item: self.write(item[0], item[1], content_type), items))
+
+    def list(self, prefix=""):
+        client = clients.storage_client()
+        return [blob.name[len(self.prefix):] for blob in client.list_blobs(self.bucket_name, prefix=self.prefix + prefix)]
+
+    def exists(self, name):
+        return self._blob(name).exists()
+
+    def delete(self, name):
+        self._blob(name).delete()
+
+    def kvstore(self, path=""):
+        return {"driver": "gcs", "bucket": self.bucket_name, "path": self.prefix + path}
+
+
+class LocalStore(ObjectStore):
+    """Directory on a POSIX filesystem.
+
+    Ranged reads map the file instead of reading it and writes are atomic
+    (written to a temporary file that is renamed), so concurrent readers
+    never see partial objects.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def read(self, name, start=0, end=None):
+        with open(self._path(name), "rb") as fin:
+            size = os.fstat(fin.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return b""
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[start:end]
+
+    def read_into(self, name, fileobj, start=0, end=None):
+        CHUNK = 1024*1024
+        with open(self._path(name), "rb") as fin:
+            size = os.fstat(fin.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for pos in range(start, end, CHUNK):
+                    fileobj.write(mapped[pos:min(pos+CHUNK, end)])
+
+    def write(self, name, data, content_type="application/octet-stream", content_encoding=None):
+        if isinstance(data, str):
+            data = data.encode()
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(data)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def list(self, prefix=""):
+        names = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith(".tmp-"):
+                    continue
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def delete(self, name):
+        os.remove(self._path(name))
+
+    def kvstore(self, path=""):
+        return {"driver": "file", "path": os.path.join(self.root, path)}
+
+
+class MemoryStore(ObjectStore):
+    """Objects held in memory (shared by all requests of the process).
+
+    Objects are kept in the memory kvstore of the shared tensorstore
+    context, so volumes written through tensorstore and objects written
+    through this interface see each other (e.g., the neuroglancer info
+    written by ngmeta).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.kv = ts.KvStore.open(self.kvstore(), context=clients.ts_context()).result()
+
+    def read(self, name, start=0, end=None):
+        result = self.kv.read(name).result()
+        if result.state == "missing":
+            raise KeyError(f"{self.name}/{name} does not exist")
+        return result.value[start:end]
+
+    def write(self, name, data, content_type="application/octet-stream", content_encoding=None):
+        if isinstance(data, str):
+            data = data.encode()
+        self.kv.write(name, bytes(data)).result()
+
+    def list(self, prefix=""):
+        return sorted(key.decode() for key in self.kv.list().result() if key.decode().startswith(prefix))
+
+    def exists(self, name):
+        return self.kv.read(name).result().state != "missing"
+
+    def delete(self, name):
+        self.kv.delete_range(ts.KvStore.KeyRange(name, name + "\0")).result()
+
+    def kvstore(self, path=""):
+        return {"driver": "memory", "path": f"{self.name}/{path}"}
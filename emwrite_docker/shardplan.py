@@ -0,0 +1,155 @@
+"""Sharding plan for the scales of the neuroglancer volumes.
+
+create_meta used to hard-code the sharding of scales 0 to 2 (64 chunks of
+64^3 per shard, with shard bits sized for the largest volumes) and left
+the other scales unsharded, so a large dataset was stored as millions of
+small chunks at scales 3 and above.  The planner here derives the
+sharding of every scale from its size instead:
+
+* chunks are grouped into shards of up to "shard-chunks" chunks and
+  about "shard-bytes" bytes (estimated from BYTES_PER_VOXEL)
+* a shard never extends beyond the region written by one request (the
+  1024^3 cube of ngshard or the block of ngreduce), so requests never
+  write the same shard and each shard is written once
+* the chunks of a shard are split into minishards of up to
+  2^MINISHARD_CHUNK_BITS chunks, which bounds the minishard index read
+  for each chunk
+
+neuroglancer orders chunks by compressed morton code (the bits of the
+x, y and z chunk indices interleaved until each runs out), so a shard of
+2^bits chunks is the block given by the first bits of the code.  Scales
+that cannot group at least 2 chunks are left unsharded.
+
+The resulting info is checked by opening every scale with tensorstore
+(in memory) before it is written (see validate).
+"""
+
+import tensorstore as ts
+
+# estimated stored bytes per voxel (jpeg is about 10:1 for EM data)
+BYTES_PER_VOXEL = {"jpeg": 0.1, "raw": 1.0}
+
+# default targets for each shard
+TARGET_SHARD_CHUNKS = 64
+TARGET_SHARD_BYTES = 64*1024*1024
+
+# chunks in each minishard (the rest of the bits of a shard select the minishard)
+MINISHARD_CHUNK_BITS = 6
+
+
+def _grid_bits(scale):
+    # bits of the chunk index in each dimension
+    chunk_size = scale["chunk_sizes"][0]
+    bits = []
+    for size, chunk in zip(scale["size"], chunk_size):
+        grid = (size + chunk - 1) // chunk
+        bits.append(max(grid - 1, 0).bit_length())
+    return bits
+
+
+def _morton_bits(grid_bits, num_bits):
+    """Bits of each dimension among the first num_bits of the compressed morton code.
+    """
+    bits = [0, 0, 0]
+    while num_bits > 0 and any(bits[dim] < grid_bits[dim] for dim in range(3)):
+        for dim in range(3):
+            if num_bits > 0 and bits[dim] < grid_bits[dim]:
+                bits[dim] += 1
+                num_bits -= 1
+    return bits
+
+
+def shard_extent(scale):
+    """Voxels covered by each shard of a scale in x, y and z (the chunk size if unsharded).
+    """
+    chunk_size = scale["chunk_sizes"][0]
+    sharding = scale.get("sharding")
+    if sharding is None:
+        return list(chunk_size)
+    bits = _morton_bits(_grid_bits(scale), sharding["preshift_bits"] + sharding["minishard_bits"])
+    return [chunk << bit for chunk, bit in zip(chunk_size, bits)]
+
+
+def plan_scale(scale, write_size, bytes_per_voxel, target_chunks=TARGET_SHARD_CHUNKS, target_bytes=TARGET_SHARD_BYTES):
+    """Sharding of a scale (None if it should not be sharded).
+
+    Args:
+        scale (dict): scale of the info (size and chunk_sizes are used)
+        write_size (int): side of the aligned region written by one request
+        bytes_per_voxel (float): estimated stored bytes per voxel
+        target_chunks (int): largest number of chunks in a shard
+        target_bytes (int): largest estimated size of a shard
+    Returns:
+        sharding (dict) or None
+    """
+    chunk_size = scale["chunk_sizes"][0]
+    chunk_bytes = chunk_size[0]*chunk_size[1]*chunk_size[2]*bytes_per_voxel
+    grid_bits = _grid_bits(scale)
+
+    # most chunk bits that fit in a write region and the targets
+    shard_chunk_bits = 0
+    for num_bits in range(1, sum(grid_bits) + 1):
+        bits = _morton_bits(grid_bits, num_bits)
+        if any((chunk << bit) > write_size for chunk, bit in zip(chunk_size, bits)):
+            break
+        if (1 << num_bits) > target_chunks or (1 << num_bits)*chunk_bytes > target_bytes:
+            break
+        shard_chunk_bits = num_bits
+    if shard_chunk_bits == 0:
+        return None
+
+    preshift_bits = min(shard_chunk_bits, MINISHARD_CHUNK_BITS)
+    minishard_bits = shard_chunk_bits - preshift_bits
+    return {
+            "@type" : "neuroglancer_uint64_sharded_v1",
+            "hash" : "identity",
+            "minishard_bits" : minishard_bits,
+            "minishard_index_encoding" : "gzip",
+            "preshift_bits" : preshift_bits,
+            "shard_bits" : sum(grid_bits) - shard_chunk_bits
+        }
+
+
+def plan_sharding(scales, write_sizes, bytes_per_voxel, target_chunks=TARGET_SHARD_CHUNKS, target_bytes=TARGET_SHARD_BYTES):
+    """Set (or remove) the sharding of each scale in place (see plan_scale).
+
+    Args:
+        scales (list): scales of the info
+        write_sizes (list): side of the region written by one request for each scale
+    """
+    if target_chunks < 1 or target_bytes < 1:
+        raise RuntimeError("shard targets must be positive")
+    for scale, write_size in zip(scales, write_sizes):
+        sharding = plan_scale(scale, write_size, bytes_per_voxel, target_chunks, target_bytes)
+        if sharding is None:
+            scale.pop("sharding", None)
+        else:
+            scale["sharding"] = sharding
+
+
+def validate(info):
+    """Raise if tensorstore rejects a scale of info (opened in memory, nothing is written).
+    """
+    multiscale = {key: info[key] for key in ("data_type", "num_channels", "type")}
+    for scale in info["scales"]:
+        metadata = {
+                "key": scale["key"],
+                "size": scale["size"],
+                "voxel_offset": scale["offset"],
+                "chunk_size": scale["chunk_sizes"][0],
+                "resolution": scale["resolution"],
+                "encoding": scale["encoding"]
+            }
+        for key in ("sharding", "jpeg_quality"):
+            if key in scale:
+                metadata[key] = scale[key]
+        try:
+            ts.open({
+                "driver": "neuroglancer_precomputed",
+                "kvstore": {"driver": "memory"},
+                "multiscale_metadata": multiscale,
+                "scale_metadata": metadata,
+                "create": True
+            }, context=ts.Context()).result()
+        except Exception as e:
+            raise RuntimeError(f"invalid scale {scale['key']}: {e}")
@@ -0,0 +1,232 @@
+"""Streaming construction of the scale pyramid of a 1024x1024x1024 cube.
+
+ngshard used to fetch 512 slices of the cube at once (512 MB), transpose
+them, and downsample the whole slab through float64 temporaries.  The
+builder here instead consumes the cube as a stream of z slabs (of
+"slab-depth" slices) and keeps one small accumulator per scale:
+
+* scale 0 is written as soon as a slab arrives
+* each slab is downsampled into the accumulator of the next scale, and
+  so on (a slice without its pair is carried over to the next slab)
+* the accumulator of a scale is written once it holds a full layer of
+  shards (SHARD_DEPTH slices), so scales above 0 are written without
+  rewriting shards
+
+Peak memory is therefore about the slab plus the accumulators (64 MB for
+scale 1 and a quarter of that for each scale above) instead of the slab
+of 512 slices.  Slabs smaller than SHARD_DEPTH only cover part of the
+scale 0 shards (ngshard stages those writes in a transaction until the
+layer of shards is complete, which holds up to SHARD_DEPTH slices).
+
+The results are identical to downsampling the cube at once: slices are
+paired from the start of the cube and the last slice of an odd count is
+dropped.  (The optional Gaussian prefilter only sees the slices of the
+current slab.)
+"""
+
+import zlib
+
+import numpy as np
+
+from downsample import downsample
+
+# slices in a shard of every sharded scale (4 chunks of 64)
+SHARD_DEPTH = 256
+
+# largest raw chunks written by RawChunkStream
+RAW_CHUNK_SIZE = 512
+
+# compression of raw chunks
+RAW_CODECS = ("gzip", "none")
+
+
+class SlabPyramid:
+    """Builds the scales of a cube from consecutive z slabs.
+
+    Args:
+        num_levels (int): number of scales (including scale 0)
+        zstart (int): z of the first slice of the first slab
+        write_level (callable): called with (level, z, vol) where vol is a (z, y, x)
+            uint8 array of consecutive slices starting at z (in the scale's coordinates);
+            vol is reused once write_level returns
+        emit_depth (int): slices accumulated per scale above 0 before they are written
+        mode (str): downsampling reduction (see downsample.py)
+        sigma (float): Gaussian prefilter applied before downsampling (0 disables, see downsample.py)
+    """
+
+    def __init__(self, num_levels, zstart, write_level, emit_depth=SHARD_DEPTH, mode="mean", sigma=0):
+        self.num_levels = num_levels
+        self.write_level = write_level
+        self.emit_depth = emit_depth
+        self.mode = mode
+        self.sigma = sigma
+
+        # per level: buffer of slices waiting to be written, number of them, z of the first, unpaired slice
+        self.pending = [None]*num_levels
+        self.pending_count = [0]*num_levels
+        self.pending_z = [zstart >> level for level in range(num_levels)]
+        self.carry = [None]*num_levels
+
+    def add(self, slab):
+        """Add the next slices of the cube ((z, y, x) uint8; may be reused by the caller afterwards).
+        """
+        self._produce(0, slab)
+
+    def finish(self):
+        """Write the slices left in the accumulators (unpaired slices are dropped).
+        """
+        for level in range(1, self.num_levels):
+            self._flush(level)
+
+    def _produce(self, level, vol):
+        if vol.shape[0] == 0:
+            return
+        if level == 0:
+            self.write_level(0, self.pending_z[0], vol)
+            self.pending_z[0] += vol.shape[0]
+        else:
+            if self.pending[level] is None:
+                self.pending[level] = np.zeros((self.emit_depth,) + vol.shape[1:], dtype=np.uint8)
+            pos = 0
+            while pos < vol.shape[0]:
+                count = min(self.emit_depth - self.pending_count[level], vol.shape[0] - pos)
+                self.pending[level][self.pending_count[level]:(self.pending_count[level]+count)] = vol[pos:(pos+count)]
+                self.pending_count[level] += count
+                pos += count
+                if self.pending_count[level] == self.emit_depth:
+                    self._flush(level)
+
+        if level + 1 >= self.num_levels:
+            return
+
+        # pair slices (including one left over from the previous slab)
+        if self.carry[level] is not None:
+            vol = np.concatenate((self.carry[level], vol))
+            self.carry[level] = None
+        if vol.shape[0] % 2 == 1:
+            self.carry[level] = vol[-1:].copy()
+            vol = vol[:-1]
+        if vol.shape[0] > 0:
+            self._produce(level + 1, downsample(vol, self.mode, self.sigma))
+
+    def _flush(self, level):
+        count = self.pending_count[level]
+        if count == 0:
+            return
+        self.write_level(level, self.pending_z[level], self.pending[level][0:count])
+        self.pending_count[level] = 0
+        self.pending_z[level] += count
+
+
+class _Uncompressed:
+    """Stands in for a zlib compressor when chunks are stored without compression.
+    """
+
+    def compress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+class RawChunkStream:
+    """Compresses the raw chunks of one scale of a cube slice by slice.
+
+    Raw neuroglancer chunks are stored in Fortran (x, y, z) order, so the
+    bytes of each z slice of a chunk follow each other and a chunk can be
+    compressed as its slabs arrive instead of holding all of its slices
+    (only the compressed bytes of the current layer of chunks are held).
+    Slices before zstart in the first layer and slices missing from the
+    last layer when the stream finishes are filled with zeros.  The chunks
+    of a layer are compressed in parallel when an executor is given (zlib
+    releases the GIL).
+
+    Args:
+        size (int): x and y size of the cube in this scale
+        write_chunk (callable): called with (ix, iy, iz, data) for every chunk
+            (ix and iy are relative to the cube, iz is the chunk index in the scale)
+        level (int): gzip compression level
+        chunk_size (int): x, y, and z size of the chunks (must divide size)
+        zstart (int): z of the first slice in this scale
+        codec (str): "gzip" or "none" (see RAW_CODECS)
+        executor (Executor): compresses the chunks of a layer in parallel (optional)
+        include_layer (callable): called with the chunk index of each layer, which is
+            skipped (neither compressed nor written) if it returns False (optional)
+    """
+
+    def __init__(self, size, write_chunk, level=9, chunk_size=RAW_CHUNK_SIZE, zstart=0, codec="gzip", executor=None,
+            include_layer=None):
+        self.size = size
+        self.write_chunk = write_chunk
+        self.level = level
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.executor = executor
+        self.include_layer = include_layer
+        self.chunk_z = zstart // chunk_size # chunk index of the current layer
+        self.filled = zstart % chunk_size # slices of the current layer that have been compressed
+        self.compressors = None
+
+    def _map(self, func, blocks):
+        if self.executor is None:
+            return [func(block) for block in blocks]
+        return list(self.executor.map(func, blocks))
+
+    def _start_layer(self):
+        blocks = self.size // self.chunk_size
+        if self.include_layer is not None and not self.include_layer(self.chunk_z):
+            blocks = 0
+        if self.codec == "gzip":
+            self.compressors = {(ix, iy): zlib.compressobj(self.level, zlib.DEFLATED, 31)
+                    for iy in range(blocks) for ix in range(blocks)}
+        else:
+            self.compressors = {(ix, iy): _Uncompressed() for iy in range(blocks) for ix in range(blocks)}
+        self.outputs = {block: [] for block in self.compressors}
+        # slices before the start of the stream
+        self._pad(self.filled)
+
+    def _pad(self, count):
+        if count == 0:
+            return
+        padding = bytes(self.chunk_size*self.chunk_size*count)
+        def pad(block):
+            self.outputs[block].append(self.compressors[block].compress(padding))
+        self._map(pad, list(self.compressors))
+
+    def add(self, slab):
+        """Compress the next slices of the cube ((z, y, x) uint8).
+        """
+        chunk_size = self.chunk_size
+        pos = 0
+        while pos < slab.shape[0]:
+            if self.compressors is None:
+                self._start_layer()
+            count = min(chunk_size - self.filled, slab.shape[0] - pos)
+            def compress(block):
+                ix, iy = block
+                part = slab[pos:(pos+count), (iy*chunk_size):((iy+1)*chunk_size), (ix*chunk_size):((ix+1)*chunk_size)]
+                self.outputs[block].append(self.compressors[block].compress(np.ascontiguousarray(part)))
+            self._map(compress, list(self.compressors))
+            pos += count
+            self.filled += count
+            if self.filled == chunk_size:
+                self._finish_layer()
+
+    def finish(self):
+        """Pad and write the chunks of the last (partial) layer.
+        """
+        if self.compressors is None:
+            return
+        self._pad(self.chunk_size - self.filled)
+        self._finish_layer()
+
+    def _finish_layer(self):
+        def flush(block):
+            self.outputs[block].append(self.compressors[block].flush())
+        self._map(flush, list(self.compressors))
+        for (ix, iy), output in self.outputs.items():
+            self.write_chunk(ix, iy, self.chunk_z, b"".join(output))
+        self.compressors = None
+        self.outputs = None
+        self.chunk_z += 1
+        self.filled = 0
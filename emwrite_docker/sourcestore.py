@@ -0,0 +1,79 @@
+"""Chunked, range-readable storage for the raw source slices.
+
+The optional ingest stage (/ingestslice) decodes each raw PNG once and
+writes it as a 2D zarr array of SOURCE_CHUNK_SIZE chunks through
+tensorstore.  alignedslice can then warp each tile from only the chunks
+that its inverse footprint touches instead of downloading and decoding
+the entire slice, so its memory use and download size scale with the
+output region rather than the source image.
+"""
+
+import numpy as np
+import tensorstore as ts
+
+import clients
+
+SOURCE_CHUNK_SIZE = 512
+
+# decoded chunks are shared by neighboring tiles (the footprints overlap by the
+# resampling margin and generally do not align with the chunk grid)
+SOURCE_CACHE_BYTES = 128*1024*1024
+
+# lz4 is cheap to decode and the chunks are only kept for the run
+COMPRESSOR = {"id": "blosc", "cname": "lz4", "clevel": 5, "shuffle": 0}
+
+
+def source_spec(store, path):
+    """tensorstore spec for the chunked source stored at path in store (objectstore.ObjectStore).
+    """
+    return {
+        "driver": "zarr",
+        "kvstore": store.kvstore(path),
+    }
+
+
+def write_source(image, store, path):
+    """Write a 2D uint8 array as a chunked source (replaces existing data).
+
+    The image is written one row of chunks at a time to bound the size
+    of the write buffers.
+    """
+    height, width = image.shape
+    spec = source_spec(store, path)
+    spec["metadata"] = {
+        "shape": [height, width],
+        "chunks": [SOURCE_CHUNK_SIZE, SOURCE_CHUNK_SIZE],
+        "dtype": "|u1",
+        "compressor": COMPRESSOR,
+        "fill_value": 0,
+    }
+    store = ts.open(spec, create=True, delete_existing=True, context=clients.ts_context()).result()
+    for ystart in range(0, height, SOURCE_CHUNK_SIZE):
+        yfinish = min(ystart + SOURCE_CHUNK_SIZE, height)
+        store[ystart:yfinish, :].write(image[ystart:yfinish, :]).result()
+
+
+class ChunkedSource:
+    """Source image read on demand from a chunked store.
+
+    Provides the region interface used by AffineWarp (shape and read).
+    Regions can be read from several threads at once.
+
+    Args:
+        store (objectstore.ObjectStore): store containing the source
+        path (str): location of the source in the store
+        cache_bytes (int): decoded chunks kept for neighboring tiles
+    """
+
+    def __init__(self, store, path, cache_bytes=SOURCE_CACHE_BYTES):
+        context = ts.Context({"cache_pool": {"total_bytes_limit": cache_bytes}}, parent=clients.ts_context())
+        self.store = ts.open(source_spec(store, path), open=True, context=context).result()
+        self.shape = tuple(self.store.shape)
+
+    def read(self, x0, y0, x1, y1):
+        """Read the region [x0, x1) x [y0, y1) (must be within the source).
+
+        Returns:
+            uint8 numpy array of shape (y1-y0, x1-x0)
+        """
+        return np.asarray(self.store[y0:y1, x0:x1].read().result(), dtype=np.uint8)
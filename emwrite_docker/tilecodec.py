@@ -0,0 +1,133 @@
+"""Codecs for the intermediate tiles written by alignedslice and read by ngshard.
+
+Intermediate tiles only live for a few days, so the codec can be chosen
+per run to trade CPU time for size:
+
+* png: lossless PNG via PIL (level is the zlib compression level, default 6)
+* raw: uncompressed bytes
+* zlib: zlib stream (level 0-9, default 1)
+* lz4: lz4 frame (level 0-16, default 0), requires the lz4 package
+
+Tiles are decoded into a caller provided buffer (e.g., a slice of the
+ngshard volume).  For the streaming codecs (raw, zlib, lz4), the decoder
+is a file-like object so that downloads can be written straight into the
+destination without holding the encoded tile or an intermediate array.
+"""
+
+import io
+import zlib
+
+import numpy as np
+from PIL import Image
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODECS = ("png", "raw", "zlib", "lz4")
+DEFAULT_CODEC = "png"
+
+DEFAULT_LEVELS = {
+    "png": 6,
+    "zlib": 1,
+    "lz4": 0,
+}
+
+
+def check_codec(codec):
+    """Raise an error if the codec is not supported in this environment.
+    """
+    if codec not in CODECS:
+        raise RuntimeError(f"unknown tile codec {codec}")
+    if codec == "lz4" and lz4 is None:
+        raise RuntimeError("lz4 tile codec requires the lz4 package")
+
+
+def encode(tile, codec=DEFAULT_CODEC, level=None):
+    """Encode a 2D uint8 tile.
+
+    Args:
+        tile (np.array): uint8 tile
+        codec (str): one of CODECS
+        level (int): compression level (codec default if None)
+    Returns:
+        bytes
+    """
+    check_codec(codec)
+    if level is None:
+        level = DEFAULT_LEVELS.get(codec)
+
+    if codec == "png":
+        with io.BytesIO() as output:
+            Image.fromarray(tile).save(output, format="PNG", compress_level=level)
+            return output.getvalue()
+
+    tile = np.ascontiguousarray(tile)
+    if codec == "raw":
+        return tile.tobytes()
+    if codec == "zlib":
+        return zlib.compress(tile, level)
+    return lz4.frame.compress(tile, compression_level=level)
+
+
+class TileDecoder:
+    """File-like object that decodes a tile written to it into a buffer.
+
+    Args:
+        out (np.array): contiguous uint8 destination (shape of the tile)
+        codec (str): one of CODECS
+    """
+
+    def __init__(self, out, codec=DEFAULT_CODEC):
+        check_codec(codec)
+        self.out = out
+        self.codec = codec
+        self.view = memoryview(out).cast("B")
+        self.pos = 0
+        self.pending = [] # only used for png
+        self.decompressor = None
+        if codec == "zlib":
+            self.decompressor = zlib.decompressobj()
+        elif codec == "lz4":
+            self.decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def _copy(self, data):
+        size = len(data)
+        if (self.pos + size) > len(self.view):
+            raise RuntimeError("decoded tile is larger than its destination")
+        self.view[self.pos:(self.pos+size)] = data
+        self.pos += size
+
+    def write(self, data):
+        if self.codec == "png":
+            self.pending.append(bytes(data))
+        elif self.codec == "raw":
+            self._copy(data)
+        else:
+            self._copy(self.decompressor.decompress(data))
+        return len(data)
+
+    def close(self):
+        """Finish decoding and check that the whole tile was written.
+        """
+        if self.codec == "png":
+            im = Image.open(io.BytesIO(b"".join(self.pending)))
+            self.pending = []
+            if (im.height, im.width) != self.out.shape:
+                raise RuntimeError(f"tile shape {(im.height, im.width)} does not match {self.out.shape}")
+            self.out[...] = np.asarray(im)
+            self.pos = len(self.view)
+        elif self.codec == "zlib":
+            self._copy(self.decompressor.flush())
+        if self.pos != len(self.view):
+            raise RuntimeError(f"decoded tile has {self.pos} of {len(self.view)} bytes")
+
+
+def decode_into(data, out, codec=DEFAULT_CODEC):
+    """Decode an encoded tile into out.
+    """
+    decoder = TileDecoder(out, codec)
+    decoder.write(data)
+    decoder.close()
+    return out
@@ -0,0 +1,250 @@
+"""Container format for the intermediate tiles of an aligned slice.
+
+alignedslice groups the tiles of each MAX_IMAGE_SIZE region of a slice
+into one object and ngshard reads individual tiles back with ranged
+requests.  Both endpoints use the reader and writer defined here.
+
+Version 2 layout (all integers little endian):
+
+    header (64 bytes):
+        magic "EMTC", version (u32), slice width (u32), slice height (u32),
+        tile size (u32), number of tiles (u32), tiles per row (u32), padding
+    index (32 bytes per tile, starting at byte 64):
+        data offset (u64), data length (u64), crc32c of data (u32),
+        codec id (u8), flags (u8), tile height (u16), tile width (u16), padding
+    tile data
+
+The index entry of tile i is always at 64 + 32*i, so the header and the
+whole index can be fetched with one small ranged request (see
+ContainerReader) and then any tile with a second request.  Empty (all
+zero) tiles are flagged and have no data.
+
+Z bricks written by alignedslices use the same layout with one entry
+per slice of a single tile column (tiles per row is 1), so all slices
+of a brick can be read with one request for the index and one for the
+data (see ContainerReader.read_tiles_into).
+
+Version 1 containers (no magic) are still readable:
+
+    slice width (u64), slice height (u64), tile size (u64),
+    n+1 offsets (u64), n PNG tiles
+
+The 4th-7th bytes of a version 1 container are always zero (the high
+bytes of the width), which can never match the version 2 magic and
+version.
+"""
+
+import struct
+from collections import namedtuple
+
+import google_crc32c
+
+import tilecodec
+
+MAGIC = b"EMTC"
+VERSION = 2
+HEADER = struct.Struct("<4sIIIIII36x")
+ENTRY = struct.Struct("<QQIBBHH6x")
+
+FLAG_EMPTY = 1
+
+CODEC_IDS = {"png": 1, "raw": 2, "zlib": 3, "lz4": 4}
+CODEC_NAMES = {val: key for key, val in CODEC_IDS.items()}
+
+V1_HEADER_SIZE = 24
+
+# enough tiles for a 4096x4096 image with 1024x1024 tiles
+DEFAULT_MAX_TILES = 16
+
+TileEntry = namedtuple("TileEntry", ["offset", "length", "crc32c", "codec", "empty", "height", "width"])
+
+
+def index_size(num_tiles):
+    """Bytes needed to read the header and index of a container.
+    """
+    return max(HEADER.size + ENTRY.size*num_tiles, V1_HEADER_SIZE + (num_tiles+1)*8)
+
+
+class ContainerWriter:
+    """Accumulates encoded tiles and packs them into a version 2 container.
+
+    Args:
+        width, height (int): slice size
+        tile_size (int): size of the (square) tiles
+        columns (int): number of tiles per row in this container
+    """
+
+    def __init__(self, width, height, tile_size, columns):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.columns = columns
+        self.tiles = []
+
+    def add(self, data, codec, shape, empty=False):
+        """Add the next tile (in row-major order).
+
+        Args:
+            data (bytes): encoded tile (ignored if empty)
+            codec (str): codec used to encode the tile
+            shape (tuple): (height, width) of the decoded tile
+            empty (bool): tile is all zero
+        """
+        if empty:
+            data = b""
+        self.tiles.append((data, codec, shape, empty))
+
+    def entries(self):
+        """Index entries (TileEntry) of the tiles added so far.
+        """
+        entries = []
+        offset = HEADER.size + ENTRY.size*len(self.tiles)
+        for data, codec, shape, empty in self.tiles:
+            entries.append(TileEntry(offset, len(data), google_crc32c.value(data), codec, empty, shape[0], shape[1]))
+            offset += len(data)
+        return entries
+
+    def tobytes(self, entries=None):
+        """Pack the container (entries can be passed if already computed).
+        """
+        if entries is None:
+            entries = self.entries()
+        header = HEADER.pack(MAGIC, VERSION, self.width, self.height, self.tile_size, len(self.tiles), self.columns)
+        packed = [ENTRY.pack(entry.offset, entry.length, entry.crc32c, CODEC_IDS[entry.codec],
+            FLAG_EMPTY if entry.empty else 0, entry.height, entry.width) for entry in entries]
+        return b"".join([header] + packed + [data for data, _, _, _ in self.tiles])
+
+
+class ContainerIndex:
+    """Parsed header and index of a container (version 1 or 2).
+    """
+
+    def __init__(self, version, width, height, tile_size, entries, columns=None):
+        self.version = version
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.entries = entries
+        self.columns = columns
+
+    @classmethod
+    def parse(cls, head, default_codec=tilecodec.DEFAULT_CODEC):
+        """Parse the beginning of a container.
+
+        Args:
+            head (bytes): first bytes of the container (see index_size)
+            default_codec (str): codec of version 1 tiles (not recorded in the container)
+        Raises:
+            RuntimeError if head does not contain the whole index
+        """
+        if head[0:4] == MAGIC:
+            _, version, width, height, tile_size, num_tiles, columns = HEADER.unpack_from(head)
+            if version != VERSION:
+                raise RuntimeError(f"unsupported tile container version {version}")
+            if len(head) < HEADER.size + ENTRY.size*num_tiles:
+                raise RuntimeError("tile container index is incomplete")
+            entries = []
+            for tile in range(num_tiles):
+                offset, length, crc, codec_id, flags, tile_height, tile_width = ENTRY.unpack_from(head, HEADER.size + ENTRY.size*tile)
+                entries.append(TileEntry(offset, length, crc, CODEC_NAMES[codec_id], bool(flags & FLAG_EMPTY), tile_height, tile_width))
+            return cls(version, width, height, tile_size, entries, columns)
+
+        # version 1
+        width, height, tile_size, first_offset = struct.unpack_from("<QQQQ", head)
+        num_tiles = (first_offset - V1_HEADER_SIZE) // 8 - 1
+        if len(head) < first_offset:
+            raise RuntimeError("tile container index is incomplete")
+        offsets = struct.unpack_from(f"<{num_tiles+1}Q", head, V1_HEADER_SIZE)
+        entries = [TileEntry(offsets[tile], offsets[tile+1] - offsets[tile], None, default_codec, False, tile_size, tile_size)
+                for tile in range(num_tiles)]
+        return cls(1, width, height, tile_size, entries)
+
+
+class _ChecksumWriter:
+    """Forwards writes to a decoder while computing the crc32c.
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.checksum = google_crc32c.Checksum()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.decoder.write(data)
+
+
+class ContainerReader:
+    """Reads tiles from a stored container with ranged requests.
+
+    The header and index are fetched with a single request on first use and
+    cached, so several tiles can be read with one request each.
+
+    Args:
+        store (objectstore.ObjectStore): store containing the container
+        name (str): name of the container
+        default_codec (str): codec of version 1 tiles
+        max_tiles (int): maximum number of tiles expected in the container
+    """
+
+    def __init__(self, store, name, default_codec=tilecodec.DEFAULT_CODEC, max_tiles=DEFAULT_MAX_TILES):
+        self.store = store
+        self.name = name
+        self.default_codec = default_codec
+        self.max_tiles = max_tiles
+        self._index = None
+
+    def index(self):
+        if self._index is None:
+            head = self.store.read(self.name, 0, index_size(self.max_tiles))
+            self._index = ContainerIndex.parse(head, self.default_codec)
+        return self._index
+
+    def read_tile_into(self, tile, out):
+        """Decode tile into out (uint8 array with the tile shape) and verify its checksum.
+        """
+        entry = self.index().entries[tile]
+        if (entry.height, entry.width) != out.shape:
+            raise RuntimeError(f"tile shape {(entry.height, entry.width)} does not match {out.shape}")
+        if entry.empty:
+            out[...] = 0
+            return out
+
+        decoder = tilecodec.TileDecoder(out, entry.codec)
+        writer = _ChecksumWriter(decoder)
+        self.store.read_into(self.name, writer, entry.offset, entry.offset+entry.length)
+        if entry.crc32c is not None and int.from_bytes(writer.checksum.digest(), "big") != entry.crc32c:
+            raise RuntimeError(f"checksum mismatch for tile {tile}")
+        decoder.close()
+        return out
+
+    def read_tiles_into(self, tiles, outs):
+        """Decode several tiles with a single request for their data.
+
+        Args:
+            tiles (list): tile indices
+            outs (list): uint8 destination for each tile
+        """
+        index = self.index()
+        entries = [index.entries[tile] for tile in tiles]
+        for entry, out in zip(entries, outs):
+            if (entry.height, entry.width) != out.shape:
+                raise RuntimeError(f"tile shape {(entry.height, entry.width)} does not match {out.shape}")
+
+        # fetch the range spanning all non-empty tiles
+        nonempty = [entry for entry in entries if not entry.empty]
+        data = b""
+        start = 0
+        if len(nonempty) > 0:
+            start = min(entry.offset for entry in nonempty)
+            end = max(entry.offset + entry.length for entry in nonempty)
+            data = self.store.read(self.name, start, end)
+
+        for tile, entry, out in zip(tiles, entries, outs):
+            if entry.empty:
+                out[...] = 0
+                continue
+            tile_data = data[(entry.offset-start):(entry.offset-start+entry.length)]
+            if entry.crc32c is not None and google_crc32c.value(tile_data) != entry.crc32c:
+                raise RuntimeError(f"checksum mismatch for tile {tile}")
+            tilecodec.decode_into(tile_data, out, entry.codec)
+        return outs
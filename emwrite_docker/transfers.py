@@ -0,0 +1,127 @@
+"""Asynchronous transfer engine for object store reads and writes.
+
+ngshard fetches up to 1024 tiles per request and alignedslice uploads a
+container per 4096x4096 region.  Instead of a fixed set of threads that
+each retry with a constant sleep, transfers are scheduled by an asyncio
+event loop (running in a background thread of the process) that bounds
+the number of requests in flight, gives every attempt a timeout, and
+retries failed attempts with capped exponential backoff and full jitter
+so that throttled requests do not retry in lock step.
+
+Each transfer is a blocking callable that performs one request through
+the shared store clients (see clients.py) and writes its result where
+it is needed (e.g., decodes a tile straight into the slab).  Attempts run
+on a thread pool the size of the in-flight limit, so a transfer that is
+waiting for its turn or backing off does not hold a connection.
+"""
+
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import clients
+
+# requests in flight at once (matches the HTTP connection pool)
+MAX_IN_FLIGHT = clients.POOL_SIZE
+
+# seconds allowed for a single attempt
+REQUEST_TIMEOUT = 120
+
+MAX_TRIES = 5
+
+# backoff before retry n (from 0) is uniform in [0, min(BACKOFF_MAX, BACKOFF_BASE*2**n)]
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 16
+
+_lock = threading.Lock()
+_engine = None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Seconds to wait before retrying after the given (0-based) failed attempt.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def engine():
+    """Transfer engine shared by all requests of the process.
+    """
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = TransferEngine()
+        return _engine
+
+
+class TransferEngine:
+    """Runs blocking transfers with bounded concurrency, timeouts, and retries.
+
+    Args:
+        max_in_flight (int): maximum number of attempts running at once
+        timeout (float): seconds allowed for each attempt
+        tries (int): attempts per transfer before it fails
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, timeout=REQUEST_TIMEOUT, tries=MAX_TRIES):
+        self.timeout = timeout
+        self.tries = tries
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+        async def make_semaphore():
+            return asyncio.Semaphore(max_in_flight)
+        self.semaphore = asyncio.run_coroutine_threadsafe(make_semaphore(), self.loop).result()
+
+    async def _transfer(self, job, description, attempts):
+        for attempt in range(self.tries):
+            try:
+                async with self.semaphore:
+                    # an attempt that times out keeps running on its thread (attempts tracks it)
+                    future = self.executor.submit(job)
+                    attempts.append(future)
+                    return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except Exception as e:
+                if attempt + 1 == self.tries:
+                    if isinstance(e, asyncio.TimeoutError):
+                        e = RuntimeError(f"timed out after {self.timeout} seconds")
+                    raise RuntimeError(f"{description} failed after {self.tries} tries: {e}") from e
+            await asyncio.sleep(backoff_delay(attempt))
+
+    async def _run(self, jobs):
+        attempts = []
+        tasks = [asyncio.ensure_future(self._transfer(job, description, attempts)) for description, job in jobs]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*[asyncio.wrap_future(future) for future in attempts], return_exceptions=True)
+
+    def submit(self, job, description="transfer"):
+        """Schedule a transfer.
+
+        Args:
+            job (callable): performs the transfer (called without arguments, may be called again on failure)
+            description (str): used in the error message
+        Returns:
+            concurrent.futures.Future with the result of the job
+        """
+        return asyncio.run_coroutine_threadsafe(self._transfer(job, description, []), self.loop)
+
+    def run(self, jobs):
+        """Run transfers and wait for all of them.
+
+        Stops the remaining transfers after the first failure and raises
+        it.  Returns only after every attempt has finished (including
+        attempts that timed out), so a late attempt can never write into a
+        buffer that the caller reuses afterwards.
+
+        Args:
+            jobs (iterable): (description, job) pairs
+        Returns:
+            list of job results in order
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(list(jobs)), self.loop).result()
@@ -0,0 +1,199 @@
+"""Tile-based affine warping of a source slice.
+
+Instead of transforming an entire (super)image at once, each output tile
+is rendered directly from the part of the source that its inverse affine
+footprint touches.  Tiles are independent, so they can be rendered by a
+pool of workers and only a few of them need to be in memory at once.
+
+The affine is given as in the transforms produced by the alignment
+(column order [a, b, c, d, tx, ty]), i.e., it maps source pixels to
+output pixels:
+
+    xout = a*x + c*y + tx
+    yout = b*x + d*y + ty
+
+Pure translations (the common case since the alignment falls back to the
+translation model when rotation is negligible) skip resampling: integer
+shifts are served by slicing the source and sub-pixel shifts use a
+separable 4-tap cubic filter equivalent to PIL's bicubic resampling.
+
+The source is accessed through regions (shape and read(x0, y0, x1, y1)),
+so it can be an array held in memory (ArraySource) or a chunked store
+that only fetches the chunks a tile needs (see sourcestore.ChunkedSource).
+"""
+
+from math import floor, ceil
+
+import numpy as np
+from PIL import Image
+
+# source pixels needed outside of the footprint for the bicubic kernel
+MARGIN = 3
+
+# tolerance for treating a transform as a translation
+LINEAR_EPS = 1e-9
+# shifts closer than this to an integer are not resampled
+SHIFT_EPS = 1e-3
+
+# a parameter of the cubic convolution kernel used by PIL for affine transforms
+CUBIC_A = -1.0
+
+
+def cubic_weights(frac):
+    """Weights of the 4-tap cubic convolution kernel for a fractional offset.
+    """
+    a = CUBIC_A
+    t = frac
+    w0 = ((a*(t+1) - 5*a)*(t+1) + 8*a)*(t+1) - 4*a
+    w1 = ((a+2)*t - (a+3))*t*t + 1
+    w2 = ((a+2)*(1-t) - (a+3))*(1-t)*(1-t) + 1
+    return np.float32(w0), np.float32(w1), np.float32(w2), np.float32(1 - w0 - w1 - w2)
+
+
+class ArraySource:
+    """Source image held in memory (regions are views of the array).
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+
+    def read(self, x0, y0, x1, y1):
+        return self.array[y0:y1, x0:x1]
+
+
+class AffineWarp:
+    """Renders regions of an affine-transformed source image.
+
+    Args:
+        source: source image (uint8 2D array or an object providing shape and read)
+        affine (list): [a, b, c, d, tx, ty] source to output transform
+        fill (int): value for pixels outside of the source
+    """
+
+    def __init__(self, source, affine, fill=0):
+        if isinstance(source, np.ndarray):
+            source = ArraySource(source)
+        self.source = source
+        self.height, self.width = source.shape
+        self.fill = fill
+        affine_mat = np.array([[affine[0], affine[2], affine[4]],
+            [affine[1], affine[3], affine[5]],
+            [0, 0, 1]])
+        # PIL transform implements a pull transform (output -> source)
+        self.mat_inv = np.linalg.inv(affine_mat)
+
+        self.is_translation = (abs(affine[0] - 1) < LINEAR_EPS and abs(affine[1]) < LINEAR_EPS and
+                abs(affine[2]) < LINEAR_EPS and abs(affine[3] - 1) < LINEAR_EPS)
+        self.shift = (affine[4], affine[5])
+
+    def footprint(self, x, y, width, height):
+        """Bounding box in the source (clipped to the source extent) needed
+        to render the output region.
+
+        Returns:
+            (x0, y0, x1, y1) or None if the region does not touch the source
+        """
+        corners = np.array([[x, x + width, x, x + width],
+            [y, y, y + height, y + height],
+            [1, 1, 1, 1]])
+        src = self.mat_inv @ corners
+        x0 = max(floor(src[0].min()) - MARGIN, 0)
+        y0 = max(floor(src[1].min()) - MARGIN, 0)
+        x1 = min(ceil(src[0].max()) + MARGIN, self.width)
+        y1 = min(ceil(src[1].max()) + MARGIN, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, y0, x1, y1
+
+    def render(self, x, y, width, height):
+        """Render the output region [x, x+width) x [y, y+height).
+
+        Returns:
+            uint8 numpy array of shape (height, width) (can be a read-only view of the source)
+        """
+        if self.is_translation:
+            return self._render_translation(x, y, width, height)
+
+        box = self.footprint(x, y, width, height)
+        if box is None:
+            return np.full((height, width), self.fill, dtype=np.uint8)
+        sx0, sy0, _, _ = box
+        region = Image.fromarray(np.ascontiguousarray(self.source.read(*box)))
+
+        # shift the inverse transform to the local coordinates of the output region and source crop
+        (a, b, c), (d, e, f) = self.mat_inv[0], self.mat_inv[1]
+        data = (a, b, a*x + b*y + c - sx0, d, e, d*x + e*y + f - sy0)
+        region = region.transform((width, height), Image.AFFINE, data=data, resample=Image.BICUBIC, fillcolor=self.fill)
+        return np.asarray(region)
+
+    def _render_translation(self, x, y, width, height):
+        dx, dy = self.shift
+        # snap shifts that are (nearly) integral so that axis is not resampled
+        if abs(dx - round(dx)) < SHIFT_EPS:
+            dx = round(dx)
+        if abs(dy - round(dy)) < SHIFT_EPS:
+            dy = round(dy)
+        if isinstance(dx, int) and isinstance(dy, int):
+            return self._render_integer_shift(x - dx, y - dy, width, height)
+        return self._render_subpixel_shift(x - dx, y - dy, width, height)
+
+    def _render_integer_shift(self, sx, sy, width, height):
+        """Copy source region [sx, sx+width) x [sy, sy+height), padding with fill.
+        """
+        if sx >= 0 and sy >= 0 and (sx + width) <= self.width and (sy + height) <= self.height:
+            return self.source.read(sx, sy, sx + width, sy + height)
+
+        out = np.full((height, width), self.fill, dtype=np.uint8)
+        x0, y0 = max(sx, 0), max(sy, 0)
+        x1, y1 = min(sx + width, self.width), min(sy + height, self.height)
+        if x0 < x1 and y0 < y1:
+            out[(y0-sy):(y1-sy), (x0-sx):(x1-sx)] = self.source.read(x0, y0, x1, y1)
+        return out
+
+    def _render_subpixel_shift(self, sx, sy, width, height):
+        """Sample the source at (sx + i, sy + j) with separable cubic interpolation.
+
+        Like PIL, neighbors are clamped at the source border and samples
+        outside of the source are set to fill.  An axis with an integer
+        shift is only copied.
+        """
+        ix, iy = floor(sx), floor(sy)
+        xs = np.arange(ix - 1, ix + width + 2)
+        ys = np.arange(iy - 1, iy + height + 2)
+        valid_x = ((xs[1:-2] - ix + sx + 0.5) >= 0) & ((xs[1:-2] - ix + sx + 0.5) < self.width)
+        valid_y = ((ys[1:-2] - iy + sy + 0.5) >= 0) & ((ys[1:-2] - iy + sy + 0.5) < self.height)
+        if not valid_x.any() or not valid_y.any():
+            return np.full((height, width), self.fill, dtype=np.uint8)
+
+        # read the part within the source and clamp neighbors by repeating the border
+        x0, y0 = max(xs[0], 0), max(ys[0], 0)
+        x1, y1 = min(xs[-1] + 1, self.width), min(ys[-1] + 1, self.height)
+        region = self.source.read(x0, y0, x1, y1).astype(np.float32)
+        if x0 != xs[0] or y0 != ys[0] or x1 != (xs[-1] + 1) or y1 != (ys[-1] + 1):
+            region = np.pad(region, ((y0 - ys[0], ys[-1] + 1 - y1), (x0 - xs[0], xs[-1] + 1 - x1)), mode="edge")
+
+        if sx == ix:
+            temp = region[:, 1:(width+1)]
+        else:
+            w0, w1, w2, w3 = cubic_weights(sx - ix)
+            temp = w0*region[:, 0:width]
+            temp += w1*region[:, 1:(width+1)]
+            temp += w2*region[:, 2:(width+2)]
+            temp += w3*region[:, 3:(width+3)]
+
+        if sy == iy:
+            out = temp[1:(height+1)].copy()
+        else:
+            w0, w1, w2, w3 = cubic_weights(sy - iy)
+            out = w0*temp[0:height]
+            out += w1*temp[1:(height+1)]
+            out += w2*temp[2:(height+2)]
+            out += w3*temp[3:(height+3)]
+
+        # truncate like PIL
+        np.clip(out, 0, 255, out=out)
+        out = out.astype(np.uint8)
+        out[~valid_y, :] = self.fill
+        out[:, ~valid_x] = self.fill
+        return out
@@ -0,0 +1,80 @@
+"""Benchmark the pyramid downsampling kernels.
+
+Compares emwrite_docker/downsample.py with the function ngshard used
+before (skimage downscale_local_mean over 256^3 blocks, which promotes
+to float64 and runs on one core) and checks that the mean results match.
+
+Usage:
+
+% python bench_downsample.py [depth] [repeats]
+
+depth is the number of 1024x1024 slices in the test volume (default 128).
+The baseline is skipped if scikit-image is not installed.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "emwrite_docker"))
+from downsample import downsample, MODES, NUM_THREADS
+
+depth = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+
+def baseline(vol):
+    """Former ngshard _downsample on an (x, y, z) volume.
+    """
+    from skimage.transform import downscale_local_mean
+
+    x, y, z = vol.shape
+    if x <= 256 and y <= 256 and z <= 256:
+        return downscale_local_mean(vol, (2,2,2)).astype(vol.dtype, copy=False)[:x//2, :y//2, :z//2]
+
+    target = np.zeros((x//2,y//2,z//2), dtype=np.uint8)
+    for xiter in range(0, x, 256):
+        for yiter in range(0, y, 256):
+            for ziter in range(0, z, 256):
+                x2, y2, z2 = vol[xiter:(xiter+256),yiter:(yiter+256),ziter:(ziter+256)].shape
+                target[(xiter//2):((xiter+256)//2), (yiter//2):((yiter+256)//2), (ziter//2):((ziter+256)//2)] = downscale_local_mean(vol[xiter:(xiter+256),yiter:(yiter+256),ziter:(ziter+256)], (2,2,2)).astype(vol.dtype, copy= False)[:x2//2, :y2//2, :z2//2]
+    return target
+
+
+def timeit(func):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+rng = np.random.default_rng(0)
+vol = rng.integers(0, 256, (depth, 1024, 1024), dtype=np.uint8)
+labels = rng.integers(0, 16, (depth, 1024, 1024), dtype=np.uint8)
+mvoxels = vol.size / 1e6
+print(f"volume: {depth}x1024x1024 uint8, {NUM_THREADS} threads, best of {repeats}")
+
+reference = None
+try:
+    import skimage # noqa: F401
+    elapsed, reference = timeit(lambda: baseline(vol.transpose((2,1,0))))
+    reference = reference.transpose((2,1,0))
+    print(f"baseline (skimage mean): {elapsed:.3f} s ({mvoxels/elapsed:.0f} Mvoxels/s)")
+except ImportError:
+    print("baseline skipped (scikit-image is not installed)")
+
+for mode in MODES:
+    elapsed, result = timeit(lambda: downsample(labels if mode == "mode" else vol, mode))
+    print(f"{mode}: {elapsed:.3f} s ({mvoxels/elapsed:.0f} Mvoxels/s)")
+    if mode == "mean" and reference is not None:
+        print(f"mean matches baseline: {np.array_equal(result, reference)}")
+
+elapsed, _ = timeit(lambda: downsample(vol, "mean", num_threads=1))
+print(f"mean (1 thread): {elapsed:.3f} s ({mvoxels/elapsed:.0f} Mvoxels/s)")
+elapsed, _ = timeit(lambda: downsample(vol, "mean", sigma=1))
+print(f"mean with sigma=1 prefilter: {elapsed:.3f} s ({mvoxels/elapsed:.0f} Mvoxels/s)")